@@ -0,0 +1,644 @@
+"""
+Controller benchmark：不需要 cluster，在同一個 process 內以 fake 取代外部相依
+- Kubernetes API：FakeKubernetes (可設定 API latency、Pod scheduling / Running 延遲，透過 fake watch 推送事件)
+- Redis：fakeredis (含 Lua，lease script 照常執行)
+- Consul：StubConsul (實作 /v1/health/service 的 blocking query，ConsulCatalogCache 照常運作)
+
+用法：
+    pip install -r requirements.txt -r requirements-bench.txt
+    python benchmark.py --scenarios create_pod,allocate,job --requests 200 --concurrency 20
+
+每個 scenario 回報 p50 / p95 / p99 latency、throughput，以及平均每個 request 的 Kubernetes API / Redis 呼叫次數
+"""
+import argparse
+import asyncio
+import collections
+import copy
+import itertools
+import json
+import math
+import os
+import queue
+import random
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from types import SimpleNamespace
+
+# 在 import app 之前設定，避免 benchmark 時 log 蓋過結果
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import fakeredis
+import httpx
+from kubernetes import client
+
+from app import app
+from controller import consul as consul_cache, informers, kube, store
+
+
+##############################################################
+# Fake Kubernetes API
+
+class FakeKubernetes:
+    """
+    CoreV1Api / BatchV1Api / AppsV1Api 的替身：物件存在記憶體中，每次變更都推送 watch event
+    建立 Pod 後依序模擬 Pending (已排程) → Running (取得 pod IP)；Job 建立 job_duration 秒後完成
+    """
+
+    def __init__(self, api_latency: float, schedule_delay: float, start_delay: float, job_duration: float):
+        self.api_latency = api_latency
+        self.schedule_delay = schedule_delay
+        self.start_delay = start_delay
+        self.job_duration = job_duration
+        self.calls = collections.Counter()
+        self.events = collections.defaultdict(queue.Queue)  # list function 名稱 -> watch events
+        self._lock = threading.RLock()
+        self._resource_version = itertools.count(1)
+        self._store = collections.defaultdict(dict)  # list function 名稱 -> {name: obj}
+        self._pod_ips = itertools.count(1)
+        self._timers = set()
+        self._closed = False
+
+    def _after(self, delay: float, func, *args):
+        """ 延遲推送狀態變化；close() 之後不再推送，避免 event loop 關閉後還有 watch event """
+        def fire():
+            with self._lock:
+                self._timers.discard(timer)
+                if self._closed:
+                    return
+            func(*args)
+
+        timer = threading.Timer(delay, fire)
+        with self._lock:
+            if self._closed:
+                return
+            self._timers.add(timer)
+        timer.start()
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            timers, self._timers = self._timers, set()
+        for timer in timers:
+            timer.cancel()
+
+    def _call(self, method: str):
+        self.calls[method] += 1
+        if self.api_latency:
+            time.sleep(self.api_latency)
+
+    def _emit(self, kind: str, event_type: str, obj):
+        with self._lock:
+            obj.metadata.resource_version = str(next(self._resource_version))
+            if event_type == "DELETED":
+                self._store[kind].pop(obj.metadata.name, None)
+            else:
+                self._store[kind][obj.metadata.name] = obj
+        self.events[kind].put({"type": event_type, "object": obj})
+
+    def _list(self, kind: str):
+        with self._lock:
+            items = list(self._store[kind].values())
+            return SimpleNamespace(items=items, metadata=client.V1ListMeta(resource_version=str(next(self._resource_version))))
+
+    def _conflict(self, kind: str, name: str):
+        with self._lock:
+            if name in self._store[kind]:
+                raise client.exceptions.ApiException(status=409, reason="AlreadyExists")
+
+    def _delete(self, kind: str, name: str):
+        with self._lock:
+            obj = self._store[kind].get(name)
+        if obj is None:
+            raise client.exceptions.ApiException(status=404, reason="NotFound")
+        self._emit(kind, "DELETED", obj)
+
+    # list (informer 使用，方法名稱即 watch stream 的 key)
+    def list_namespaced_pod(self, namespace, **kwargs):
+        self._call("list_namespaced_pod")
+        return self._list("list_namespaced_pod")
+
+    def list_namespaced_persistent_volume_claim(self, namespace, **kwargs):
+        self._call("list_namespaced_persistent_volume_claim")
+        return self._list("list_namespaced_persistent_volume_claim")
+
+    def list_namespaced_service(self, namespace, **kwargs):
+        self._call("list_namespaced_service")
+        return self._list("list_namespaced_service")
+
+    def list_namespaced_job(self, namespace, **kwargs):
+        self._call("list_namespaced_job")
+        return self._list("list_namespaced_job")
+
+    def list_node(self, **kwargs):
+        self._call("list_node")
+        return self._list("list_node")
+
+    def _metadata(self, namespace: str, body: dict):
+        metadata = body["metadata"]
+        return client.V1ObjectMeta(
+            name=metadata["name"], namespace=namespace, uid=str(uuid.uuid4()),
+            labels=dict(metadata.get("labels") or {}), annotations=metadata.get("annotations"),
+            owner_references=[
+                client.V1OwnerReference(api_version=ref["apiVersion"], kind=ref["kind"], name=ref["name"], uid=ref["uid"])
+                for ref in metadata.get("ownerReferences") or []
+            ] or None,
+            creation_timestamp=datetime.utcnow(),
+        )
+
+    def _collect_dependents(self, owner_uid: str):
+        """ 模擬 Kubernetes garbage collector：刪除 ownerReferences 指向 owner 的 PVC / Service """
+        for kind in ("list_namespaced_persistent_volume_claim", "list_namespaced_service"):
+            with self._lock:
+                dependents = [
+                    obj for obj in self._store[kind].values()
+                    if any(ref.uid == owner_uid for ref in obj.metadata.owner_references or [])
+                ]
+            for obj in dependents:
+                self._emit(kind, "DELETED", obj)
+
+    # create
+    def create_namespaced_persistent_volume_claim(self, namespace, body, **kwargs):
+        self._call("create_namespaced_persistent_volume_claim")
+        name = body["metadata"]["name"]
+        self._conflict("list_namespaced_persistent_volume_claim", name)
+        pvc = client.V1PersistentVolumeClaim(
+            metadata=self._metadata(namespace, body),
+            status=client.V1PersistentVolumeClaimStatus(phase="Bound"),
+        )
+        self._emit("list_namespaced_persistent_volume_claim", "ADDED", pvc)
+        return pvc
+
+    def create_namespaced_service(self, namespace, body, **kwargs):
+        self._call("create_namespaced_service")
+        name = body["metadata"]["name"]
+        self._conflict("list_namespaced_service", name)
+        service = client.V1Service(
+            metadata=self._metadata(namespace, body),
+            spec=client.V1ServiceSpec(
+                ports=[client.V1ServicePort(port=port["port"]) for port in body["spec"].get("ports", [])],
+            ),
+        )
+        self._emit("list_namespaced_service", "ADDED", service)
+        return service
+
+    def create_namespaced_pod(self, namespace, body, **kwargs):
+        self._call("create_namespaced_pod")
+        name = body["metadata"]["name"]
+        self._conflict("list_namespaced_pod", name)
+        containers = [
+            client.V1Container(
+                name=container["name"],
+                image=container["image"],
+                ports=[client.V1ContainerPort(container_port=port["containerPort"]) for port in container.get("ports", [])],
+                resources=client.V1ResourceRequirements(limits=(container.get("resources") or {}).get("limits")),
+            )
+            for container in body["spec"]["containers"]
+        ]
+        pod = client.V1Pod(
+            metadata=self._metadata(namespace, body),
+            spec=client.V1PodSpec(containers=containers),
+            status=client.V1PodStatus(phase="Pending"),
+        )
+        self._emit("list_namespaced_pod", "ADDED", pod)
+        self._after(self.schedule_delay, self._schedule_pod, name)
+        return pod
+
+    def _schedule_pod(self, name: str):
+        pod = self._store["list_namespaced_pod"].get(name)
+        if pod is None:
+            return
+        pod.spec.node_name = f"fake-node-{hash(name) % 4}"
+        self._emit("list_namespaced_pod", "MODIFIED", pod)
+        self._after(self.start_delay, self._start_pod, name)
+
+    def _start_pod(self, name: str):
+        pod = self._store["list_namespaced_pod"].get(name)
+        if pod is None:
+            return
+        index = next(self._pod_ips)
+        pod.status = client.V1PodStatus(phase="Running", pod_ip=f"10.0.{index // 250}.{index % 250 + 1}")
+        self._emit("list_namespaced_pod", "MODIFIED", pod)
+
+    def create_namespaced_job(self, namespace, body, **kwargs):
+        self._call("create_namespaced_job")
+        name = body["metadata"]["name"]
+        self._conflict("list_namespaced_job", name)
+        job = client.V1Job(
+            metadata=client.V1ObjectMeta(
+                name=name, namespace=namespace, uid=f"uid-{name}",
+                labels=body["metadata"].get("labels"), annotations=body["metadata"].get("annotations"),
+            ),
+            spec=client.V1JobSpec(
+                template=client.V1PodTemplateSpec(),
+                completions=body["spec"].get("completions"), completion_mode=body["spec"].get("completionMode"),
+            ),
+            status=client.V1JobStatus(active=1),
+        )
+        self._emit("list_namespaced_job", "ADDED", job)
+        self._after(self.job_duration, self._finish_job, name)
+        return job
+
+    def _finish_job(self, name: str):
+        job = self._store["list_namespaced_job"].get(name)
+        if job is None:
+            return
+        job.status = client.V1JobStatus(
+            succeeded=1, conditions=[client.V1JobCondition(type="Complete", status="True")]
+        )
+        self._emit("list_namespaced_job", "MODIFIED", job)
+
+    def create_namespaced_config_map(self, namespace, body, **kwargs):
+        self._call("create_namespaced_config_map")
+        name = body["metadata"]["name"]
+        self._conflict("config_maps", name)
+        config_map = client.V1ConfigMap(metadata=client.V1ObjectMeta(name=name, namespace=namespace), data=body.get("data"))
+        with self._lock:
+            self._store["config_maps"][name] = config_map
+        return config_map
+
+    def create_namespaced_daemon_set(self, namespace, body, **kwargs):
+        self._call("create_namespaced_daemon_set")
+        name = body["metadata"]["name"]
+        self._conflict("daemon_sets", name)
+        daemon_set = client.V1DaemonSet(
+            metadata=client.V1ObjectMeta(name=name, namespace=namespace, labels=body["metadata"].get("labels")),
+            spec=client.V1DaemonSetSpec(
+                selector=client.V1LabelSelector(match_labels=body["spec"]["selector"]["matchLabels"]),
+                template=client.V1PodTemplateSpec(),
+            ),
+            status=client.V1DaemonSetStatus(current_number_scheduled=0, desired_number_scheduled=0, number_misscheduled=0, number_ready=0),
+        )
+        with self._lock:
+            self._store["daemon_sets"][name] = daemon_set
+        return daemon_set
+
+    def read_namespaced_daemon_set_status(self, name, namespace, **kwargs):
+        self._call("read_namespaced_daemon_set_status")
+        daemon_set = self._store["daemon_sets"].get(name)
+        if daemon_set is None:
+            raise client.exceptions.ApiException(status=404, reason="NotFound")
+        return daemon_set
+
+    # patch / delete
+    def patch_namespaced_config_map(self, name, namespace, body, **kwargs):
+        self._call("patch_namespaced_config_map")
+        config_map = self._store["config_maps"].get(name)
+        if config_map is None:
+            raise client.exceptions.ApiException(status=404, reason="NotFound")
+        config_map.metadata.owner_references = body.get("metadata", {}).get("ownerReferences")
+        return config_map
+
+    def delete_namespaced_config_map(self, name, namespace, **kwargs):
+        self._call("delete_namespaced_config_map")
+        with self._lock:
+            if self._store["config_maps"].pop(name, None) is None:
+                raise client.exceptions.ApiException(status=404, reason="NotFound")
+
+    def patch_namespaced_pod(self, name, namespace, body, **kwargs):
+        self._call("patch_namespaced_pod")
+        metadata = body.get("metadata", {})
+        with self._lock:
+            current = self._store["list_namespaced_pod"].get(name)
+            if current is None:
+                raise client.exceptions.ApiException(status=404, reason="NotFound")
+            # metadata.resourceVersion 為 optimistic concurrency 的前提條件
+            if metadata.get("resourceVersion") and metadata["resourceVersion"] != current.metadata.resource_version:
+                raise client.exceptions.ApiException(status=409, reason="Conflict")
+            pod = copy.deepcopy(current)
+            pod.metadata.labels.update(metadata.get("labels", {}))
+            self._emit("list_namespaced_pod", "MODIFIED", pod)
+        return pod
+
+    def delete_namespaced_pod(self, name, namespace, **kwargs):
+        self._call("delete_namespaced_pod")
+        pod = self._store["list_namespaced_pod"].get(name)
+        self._delete("list_namespaced_pod", name)
+        self._collect_dependents(pod.metadata.uid)
+
+    def delete_namespaced_persistent_volume_claim(self, name, namespace, **kwargs):
+        self._call("delete_namespaced_persistent_volume_claim")
+        self._delete("list_namespaced_persistent_volume_claim", name)
+
+    def delete_namespaced_service(self, name, namespace, **kwargs):
+        self._call("delete_namespaced_service")
+        self._delete("list_namespaced_service", name)
+
+    def delete_namespaced_daemon_set(self, name, namespace, **kwargs):
+        self._call("delete_namespaced_daemon_set")
+        with self._lock:
+            if self._store["daemon_sets"].pop(name, None) is None:
+                raise client.exceptions.ApiException(status=404, reason="NotFound")
+
+
+class FakeWatch:
+    """ 取代 kubernetes.watch.Watch：依 list function 名稱讀取 FakeKubernetes 推送的事件 """
+
+    def __init__(self):
+        self.resource_version = None
+        self._stopped = False
+
+    def stream(self, func, **kwargs):
+        events = func.__self__.events[func.__name__]
+        while not self._stopped:
+            try:
+                event = events.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            self.resource_version = event["object"].metadata.resource_version
+            yield event
+
+    def stop(self):
+        self._stopped = True
+
+
+##############################################################
+# Stub Consul / counting Redis
+
+class StubConsul:
+    """ /v1/health/service/{name} 的替身：index 未變動時 blocking，直到 catalog 變動或 wait 到期 """
+
+    def __init__(self, services: dict):
+        self._cond = threading.Condition()
+        self.index = 1
+        self.services = services  # service_name -> [health entry]
+        self.calls = collections.Counter()
+
+    def session(self):
+        return StubConsulSession(self)
+
+
+class StubConsulResponse:
+    def __init__(self, entries: list, index: int):
+        self.status_code = 200
+        self.headers = {"X-Consul-Index": str(index)}
+        self._entries = entries
+
+    def json(self):
+        return self._entries
+
+
+class StubConsulSession:
+    def __init__(self, consul: StubConsul):
+        self.consul = consul
+
+    def get(self, url, params=None, timeout=None):
+        service_name = url.rsplit("/", 1)[-1]
+        index = int((params or {}).get("index") or 0)
+        self.consul.calls["blocking" if index else "initial"] += 1
+        with self.consul._cond:
+            if index >= self.consul.index:
+                self.consul._cond.wait(timeout=min(timeout or 5, 5))
+            return StubConsulResponse(list(self.consul.services.get(service_name, [])), self.consul.index)
+
+
+def stub_health_entries(service_name: str, count: int) -> list:
+    return [
+        {
+            "Node": {"Node": f"node-{i % 4}", "Address": f"192.168.0.{i % 4 + 1}"},
+            "Service": {"ID": f"{service_name}-{i}", "Address": f"10.1.0.{i + 1}", "Port": 8000, "Weights": {"Passing": 1}},
+            "Checks": [{"Status": "passing"}],
+        }
+        for i in range(count)
+    ]
+
+
+class CountingFakeRedis(fakeredis.FakeRedis):
+    """ 以 round trip 為單位計數：單一指令 (含 EVALSHA) 與每個 pipeline.execute() 各算一次 """
+
+    calls = collections.Counter()
+
+    def execute_command(self, *args, **options):
+        CountingFakeRedis.calls[str(args[0]).upper()] += 1
+        return super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        CountingFakeRedis.calls["PIPELINE"] += 1
+        return super().pipeline(transaction=transaction, shard_hint=shard_hint)
+
+
+def install_fakes(args):
+    fake_k8s = FakeKubernetes(args.api_latency, args.schedule_delay, args.start_delay, args.job_duration)
+
+    def init_fake_k8s_clients():
+        kube.v1 = fake_k8s
+        kube.batch_v1 = fake_k8s
+        kube.apps_v1 = fake_k8s
+        kube.k8s_executor = ThreadPoolExecutor(max_workers=kube.K8S_CONNECTION_POOL_SIZE, thread_name_prefix="k8s-api")
+
+    kube.init_k8s_clients = init_fake_k8s_clients
+    informers.watch.Watch = FakeWatch
+
+    store.redis_lock = CountingFakeRedis(decode_responses=True)
+
+    consul = StubConsul({args.service: stub_health_entries(args.service, args.instances)})
+    consul_cache.consul_catalog.stop()
+    consul_cache.consul_catalog = consul_cache.ConsulCatalogCache("http://stub-consul")
+    consul_cache.requests.Session = consul.session
+    return fake_k8s, consul
+
+
+##############################################################
+# Scenarios
+
+def percentile(sorted_values: list, p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    # nearest-rank
+    rank = max(0, min(len(sorted_values) - 1, math.ceil(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = collections.defaultdict(list)
+        self.statuses = collections.defaultdict(collections.Counter)
+        self.sent = 0  # 實際送出的 HTTP request 數 (record() 記錄的衍生量測不算)
+
+    async def request(self, http: httpx.AsyncClient, operation: str, method: str, url: str, **kwargs):
+        start = time.perf_counter()
+        self.sent += 1
+        response = await http.request(method, url, **kwargs)
+        self.latencies[operation].append(time.perf_counter() - start)
+        self.statuses[operation][response.status_code] += 1
+        return response
+
+    def record(self, operation: str, seconds: float, status):
+        self.latencies[operation].append(seconds)
+        self.statuses[operation][status] += 1
+
+
+async def scenario_create_pod(http, recorder, i, args):
+    body = {"image_name": "bench/model", "image_tag": f"v{i % 3}", "export_port": 8000}
+    await recorder.request(http, "create_pod", "POST", "/create_pod", json=body)
+
+
+async def scenario_create_pod_async(http, recorder, i, args):
+    body = {"image_name": "bench/model", "image_tag": f"v{i % 3}", "export_port": 8000}
+    await recorder.request(http, "create_pod_async", "POST", "/create_pod_async", json=body)
+
+
+async def scenario_allocate(http, recorder, i, args):
+    body = {"dag_id": f"bench_dag_{i % 10}", "execution_id": str(i), "wait_timeout": args.allocate_wait}
+    response = await recorder.request(http, "allocate_service", "POST", f"/allocate_service/{args.service}", json=body)
+    if response.status_code != 200:
+        return
+    lease = response.json()
+    if args.hold:
+        await asyncio.sleep(args.hold)
+    await recorder.request(
+        http, "release_service", "POST", f"/release_service/{lease['assigned_service_instance_id']}",
+        json={"dag_id": body["dag_id"], "execution_id": body["execution_id"], "fencing_token": lease["fencing_token"]},
+    )
+
+
+async def scenario_job(http, recorder, i, args):
+    """
+    execute_custom_image 只量到排入 admission queue (202)；
+    job_admitted 另外量從送出到 dispatch 建立 Job (出現在 job informer) 的時間，逾時記為 timeout
+    """
+    body = {"execution_id": f"bench-{args.seed}-{i}", "image_name": "bench/job:latest", "env": {"INDEX": i}}
+    start = time.perf_counter()
+    response = await recorder.request(http, "execute_custom_image", "POST", "/job/execute_custom_image", json=body)
+    if response.status_code != 202:
+        return
+    job = await informers.job_informer.async_wait_for(
+        response.json()["job_name"], lambda job: job is not None, timeout=args.job_admit_timeout
+    )
+    recorder.record("job_admitted", time.perf_counter() - start, "admitted" if job is not None else "timeout")
+
+
+SCENARIOS = {
+    "create_pod": scenario_create_pod,
+    "create_pod_async": scenario_create_pod_async,
+    "allocate": scenario_allocate,
+    "job": scenario_job,
+}
+
+
+async def run_scenario(http, name: str, args):
+    recorder = Recorder()
+    counter = itertools.count()
+
+    async def worker():
+        while True:
+            i = next(counter)
+            if i >= args.requests:
+                return
+            await SCENARIOS[name](http, recorder, i, args)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    return recorder, time.perf_counter() - start
+
+
+def summarize(name: str, recorder: Recorder, elapsed: float, k8s_calls: dict, redis_calls: dict, consul_calls: dict):
+    operations = {}
+    for operation, latencies in recorder.latencies.items():
+        latencies = sorted(latencies)
+        operations[operation] = {
+            "count": len(latencies),
+            "status": dict(recorder.statuses[operation]),
+            "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+            "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+            "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+            "max_ms": round(latencies[-1] * 1000, 2),
+        }
+    requests_sent = max(1, recorder.sent)
+    return {
+        "scenario": name,
+        "elapsed_seconds": round(elapsed, 3),
+        "operations": operations,
+        "k8s_calls": k8s_calls,
+        "k8s_calls_per_request": round(sum(k8s_calls.values()) / requests_sent, 2),
+        "redis_round_trips": redis_calls,
+        "redis_round_trips_per_request": round(sum(redis_calls.values()) / requests_sent, 2),
+        "consul_requests": consul_calls,
+    }
+
+
+def print_report(results: list):
+    header = f"{'operation':<24}{'count':>7}{'rps':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}  status"
+    for result in results:
+        print(f"\n== {result['scenario']} ({result['elapsed_seconds']}s)")
+        print(header)
+        for operation, stats in result["operations"].items():
+            print(
+                f"{operation:<24}{stats['count']:>7}{stats['throughput_rps']:>9}{stats['p50_ms']:>10}"
+                f"{stats['p95_ms']:>10}{stats['p99_ms']:>10}{stats['max_ms']:>10}  {stats['status']}"
+            )
+        print(f"k8s calls/request: {result['k8s_calls_per_request']}  {result['k8s_calls']}")
+        print(f"redis round trips/request: {result['redis_round_trips_per_request']}  {result['redis_round_trips']}")
+        if result["consul_requests"]:
+            print(f"consul requests: {result['consul_requests']}")
+
+
+def diff_counter(after: collections.Counter, before: collections.Counter) -> dict:
+    return {key: after[key] - before[key] for key in sorted(after) if after[key] - before[key]}
+
+
+async def main(args):
+    random.seed(args.seed)
+    fake_k8s, consul = install_fakes(args)
+    transport = httpx.ASGITransport(app=app)
+    results = []
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://controller", timeout=None) as http:
+            # 等 informer 完成初次 LIST
+            while not all(informer.has_synced() for informer in informers.INFORMERS):
+                await asyncio.sleep(0.01)
+            for name in args.scenarios:
+                k8s_before = fake_k8s.calls.copy()
+                redis_before = CountingFakeRedis.calls.copy()
+                consul_before = consul.calls.copy()
+                recorder, elapsed = await run_scenario(http, name, args)
+                results.append(summarize(
+                    name, recorder, elapsed,
+                    diff_counter(fake_k8s.calls, k8s_before),
+                    diff_counter(CountingFakeRedis.calls, redis_before),
+                    diff_counter(consul.calls, consul_before),
+                ))
+            # 先停掉 fake cluster 的狀態變化，lifespan shutdown 再停 informer / job queue 等背景工作
+            fake_k8s.close()
+    consul_cache.consul_catalog.stop()
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the ML serving pod controller against in-process fakes.")
+    parser.add_argument("--scenarios", default="create_pod,create_pod_async,allocate,job",
+                        help=f"comma separated, any of: {', '.join(SCENARIOS)}")
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--api-latency", type=float, default=0.005, help="simulated Kubernetes API latency (seconds)")
+    parser.add_argument("--schedule-delay", type=float, default=0.05, help="pod creation -> scheduled (seconds)")
+    parser.add_argument("--start-delay", type=float, default=0.2, help="scheduled -> Running (seconds)")
+    parser.add_argument("--job-duration", type=float, default=0.5, help="Job creation -> Complete (seconds)")
+    parser.add_argument("--job-admit-timeout", type=float, default=30.0,
+                        help="seconds the job scenario waits for a queued Job to be admitted")
+    parser.add_argument("--service", default="preprocessing", help="service name used by the allocate scenario")
+    parser.add_argument("--instances", type=int, default=8, help="instances registered in the stub Consul catalog")
+    parser.add_argument("--allocate-wait", type=float, default=5.0, help="wait_timeout sent with /allocate_service")
+    parser.add_argument("--hold", type=float, default=0.01, help="seconds a lease is held before release")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", dest="json_path", help="also write the results to this file")
+    args = parser.parse_args(argv)
+    args.scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(unknown)}")
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    results = asyncio.run(main(args))
+    print_report(results)
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump({"args": {k: v for k, v in vars(args).items() if k != "json_path"}, "results": results}, f, indent=2)
+    sys.exit(0)
@@ -0,0 +1,3 @@
+# ML serving controller 的各個子系統，每個模組各有一個 APIRouter (endpoint)；startup / shutdown hook 由 app.py 依序註冊
+# 會在執行期替換的共用 client (kube.v1 / store.redis_lock / consul.consul_catalog 等) 一律以 module 屬性存取，
+# 測試與 benchmark 替換後所有子系統都會用到替身
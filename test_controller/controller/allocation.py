@@ -0,0 +1,381 @@
+from fastapi import APIRouter, HTTPException
+import os
+import uuid
+import time
+import json
+from datetime import datetime
+from pydantic import BaseModel
+from typing import Dict, Optional
+import asyncio
+from fastapi.concurrency import run_in_threadpool
+from . import store, consul
+from .observability import ALLOCATION_QUEUE_DEPTH, ALLOCATION_REQUESTS, ALLOCATION_WAIT_SECONDS
+from .leases import allocation_heartbeat_key, allocation_queue_key, claim_service_instance, claim_service_instances_batch, instance_lock_key, instance_selector, LEASE_EXPIRY_KEY, LEASE_INFO_KEY, LEASE_REQUIRE_FENCING_TOKEN, lease_reaper, lease_response, release_service_instance, renew_service_instance, resolve_lease_ttl
+
+router = APIRouter()
+
+
+##############################################################
+# Allocation wait queue：所有 instance 都被鎖定時排隊 (long-poll)，佇列存在 Redis，所有 replica / worker 共用同一個順序
+
+ALLOCATION_QUEUE_MODE = os.getenv("ALLOCATION_QUEUE_MODE", "fifo")  # fifo | priority
+ALLOCATION_PRIORITIES = json.loads(os.getenv("ALLOCATION_PRIORITIES", "{}"))  # {dag_id: priority}，數字越大越優先
+ALLOCATION_QUEUE_MAX_WAIT = float(os.getenv("ALLOCATION_QUEUE_MAX_WAIT", "300"))
+ALLOCATION_QUEUE_POLL_INTERVAL = float(os.getenv("ALLOCATION_QUEUE_POLL_INTERVAL", "1"))
+ALLOCATION_QUEUE_STATS_KEY = "allocation_queue_stats"  # hash：enqueued / served / timeouts / wait_seconds_sum / wait_seconds_max
+
+# KEYS[1]: stats hash；ARGV[1]: 這次排隊等待的秒數 (累加並更新最大值)
+RECORD_ALLOCATION_WAIT_LUA = """
+redis.call("HINCRBY", KEYS[1], "served", 1)
+redis.call("HINCRBYFLOAT", KEYS[1], "wait_seconds_sum", ARGV[1])
+local current = tonumber(redis.call("HGET", KEYS[1], "wait_seconds_max") or "0")
+if tonumber(ARGV[1]) > current then
+    redis.call("HSET", KEYS[1], "wait_seconds_max", ARGV[1])
+end
+return 1
+"""
+
+record_allocation_wait_script = store.redis_lock.register_script(RECORD_ALLOCATION_WAIT_LUA)
+
+
+class AllocationQueue:
+    """
+    每個 service 一個等待佇列 (Redis zset)，score = -priority * 1e13 + 排入時間 (ms)：
+    1. 佇列非空時新來的 request 一律排隊，不能插隊搶 instance (在 claim script 內檢查，atomic)
+    2. 排隊中的 request 只有排頭能鎖定；本 process 收到 lease 釋放 / 過期事件時立即重試，
+       其他 replica 釋放的 instance 則由每 ALLOCATION_QUEUE_POLL_INTERVAL 秒一次的重試接手
+    3. 每次重試同時更新心跳；request 離開或 process 掛掉後，心跳過期的等待者由下一次 claim 清除，不會卡住佇列
+    (所有方法皆在 event loop 內呼叫)
+    """
+
+    def __init__(self):
+        self._wakeups = {}  # service_name -> 本 process 內等待中的 asyncio.Event
+        self._loop = None
+
+    def start(self, loop):
+        self._loop = loop
+        lease_reaper.listeners.append(self._on_lease_event)
+
+    def stop(self):
+        if self._on_lease_event in lease_reaper.listeners:
+            lease_reaper.listeners.remove(self._on_lease_event)
+
+    def priority_of(self, dag_id: str) -> int:
+        if ALLOCATION_QUEUE_MODE != "priority":
+            return 0
+        return int(ALLOCATION_PRIORITIES.get(dag_id, 0))
+
+    async def wait(self, service_name: str, dag_id: str, dag_unique_id: str, lease_ttl: int, timeout: float, strategy: str = None):
+        """ 排隊等待下一台被釋放的 instance，逾時回傳 None """
+        enqueued_at = time.time()
+        waiter = {"id": uuid.uuid4().hex, "score": -self.priority_of(dag_id) * 1e13 + int(enqueued_at * 1000)}
+        wakeup = asyncio.Event()
+        self._wakeups.setdefault(service_name, set()).add(wakeup)
+        await run_in_threadpool(store.incr_stats, ALLOCATION_QUEUE_STATS_KEY, {"enqueued": 1})
+        deadline = self._loop.time() + timeout
+        claimed = None
+        enqueued = False
+        try:
+            while True:
+                wakeup.clear()
+                service_instances = await consul.consul_catalog.aget(service_name)
+                claimed = await run_in_threadpool(
+                    claim_service_instance, service_name, service_instances, dag_unique_id, lease_ttl, strategy, waiter
+                )
+                if claimed is not None:
+                    break
+                if not enqueued:
+                    enqueued = True  # 第一次 claim 失敗時 claim script 已把 waiter 排進佇列
+                    await run_in_threadpool(self._record_depth, service_name)
+                remaining = deadline - self._loop.time()
+                if remaining <= 0:
+                    await run_in_threadpool(store.incr_stats, ALLOCATION_QUEUE_STATS_KEY, {"timeouts": 1})
+                    ALLOCATION_WAIT_SECONDS.labels(service_name, "timeout").observe(time.time() - enqueued_at)
+                    return None
+                try:
+                    await asyncio.wait_for(wakeup.wait(), timeout=min(ALLOCATION_QUEUE_POLL_INTERVAL, remaining))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self._wakeups[service_name].discard(wakeup)
+            if not self._wakeups[service_name]:
+                self._wakeups.pop(service_name)
+            if claimed is None:
+                await run_in_threadpool(self._leave, service_name, waiter["id"])
+            elif enqueued:
+                await run_in_threadpool(self._record_depth, service_name)
+        waited = time.time() - enqueued_at
+        ALLOCATION_WAIT_SECONDS.labels(service_name, "served").observe(waited)
+        await run_in_threadpool(record_allocation_wait_script, keys=[ALLOCATION_QUEUE_STATS_KEY], args=[waited], client=store.redis_lock)
+        return claimed
+
+    @staticmethod
+    def _leave(service_name: str, waiter_id: str):
+        pipe = store.redis_lock.pipeline(transaction=False)
+        pipe.zrem(allocation_queue_key(service_name), waiter_id)
+        pipe.zrem(allocation_heartbeat_key(service_name), waiter_id)
+        pipe.zcard(allocation_queue_key(service_name))
+        AllocationQueue._record_depth(service_name, pipe.execute()[-1])
+
+    @staticmethod
+    def _record_depth(service_name: str, depth: int = None):
+        if depth is None:
+            depth = store.redis_lock.zcard(allocation_queue_key(service_name))
+        ALLOCATION_QUEUE_DEPTH.labels(service_name).set(depth)
+
+    def notify(self, service_name: str):
+        for wakeup in self._wakeups.get(service_name, ()):
+            wakeup.set()
+
+    def _on_lease_event(self, event: dict):
+        # 可能由 reaper thread 呼叫
+        if self._loop is not None and event.get("service_name"):
+            self._loop.call_soon_threadsafe(self.notify, event["service_name"])
+
+    def snapshot(self):
+        stats = store.load_stats(ALLOCATION_QUEUE_STATS_KEY, ("enqueued", "served", "timeouts", "wait_seconds_sum", "wait_seconds_max"))
+        prefix = len(allocation_queue_key(""))
+        depth = {key[prefix:]: store.redis_lock.zcard(key) for key in store.redis_lock.scan_iter(match=allocation_queue_key("*"))}
+        for service_name, count in depth.items():
+            self._record_depth(service_name, count)
+        return {
+            **stats,
+            "mode": ALLOCATION_QUEUE_MODE,
+            "wait_seconds_avg": (stats["wait_seconds_sum"] / stats["served"]) if stats["served"] else 0.0,
+            "depth": depth,
+        }
+
+
+allocation_queue = AllocationQueue()
+
+
+async def start_allocation_queue():
+    allocation_queue.start(asyncio.get_running_loop())
+
+
+def stop_allocation_queue():
+    allocation_queue.stop()
+
+
+@router.get("/allocation_queue/stats")
+def allocation_queue_stats():
+    return allocation_queue.snapshot()
+
+
+class AllocateExternalServiceRequest(BaseModel):
+    dag_id: str
+    execution_id: str
+    lease_ttl: Optional[int] = None  # 預設 LEASE_TTL_SECONDS；持有期間需以 /renew_service 續約
+    wait_timeout: Optional[float] = None  # 全部被鎖定時最多排隊等待幾秒 (long-poll)，不帶則直接回 404
+    strategy: Optional[str] = None  # first | healthy | lru | weighted | latency，預設 ALLOCATION_STRATEGY
+
+
+# Allocate External Service
+@router.post("/allocate_service/{service_name}")
+async def allocate__service(service_name:str, request: AllocateExternalServiceRequest):
+    """
+    DAG 來請求 Server：
+    1. 查詢 Consul 獲取所有可用的機器
+    2. 確保機器未被其他 DAG 鎖定
+    3. 若可用，則鎖定機器(through resdis)並 回傳 IP、Port、Execution ID 與 fencing token
+    """
+    
+    
+    dag_id = request.dag_id
+    execution_id = request.execution_id
+
+    # 確認 Image Name 格式
+    if not (dag_id and execution_id ):
+        raise HTTPException(status_code=400, detail="Dag id nd Execution_id required.")
+
+    dag_unique_id = f"{dag_id}_{execution_id}"
+    lease_ttl = resolve_lease_ttl(request.lease_ttl)
+    strategy = instance_selector.validate(request.strategy)
+
+    service_name = service_name
+
+    # 1️⃣ 從本地 Consul catalog cache 取得所有註冊的 Server (不需每次打 Consul)
+    service_instances = await consul.consul_catalog.aget(service_name)
+
+    if not service_instances:
+        raise HTTPException(status_code=404, detail="❌ 沒有可用的 Service_Instance")
+
+    # 2️⃣ + 3️⃣ 以 Lua script 一次 round trip 原子地鎖定第一台未被鎖定的機器 (已有人排隊時不可插隊)
+    claimed = await run_in_threadpool(claim_service_instance, service_name, service_instances, dag_unique_id, lease_ttl, strategy)
+
+    result = "allocated"
+    # 4️⃣ 全部被鎖定時，有帶 wait_timeout 就排隊等下一台被釋放的機器
+    if claimed is None and request.wait_timeout:
+        wait_timeout = min(request.wait_timeout, ALLOCATION_QUEUE_MAX_WAIT)
+        claimed = await allocation_queue.wait(service_name, dag_id, dag_unique_id, lease_ttl, wait_timeout, strategy)
+        result = "queued"
+
+    if claimed is None:
+        ALLOCATION_REQUESTS.labels(service_name, "rejected").inc()
+        raise HTTPException(status_code=404, detail="所有 Preprocessing Server 皆被鎖定，請稍後重試")
+
+    ALLOCATION_REQUESTS.labels(service_name, result).inc()
+
+    instance, fencing_token = claimed
+    return {
+        **lease_response(instance, fencing_token, lease_ttl),
+        "For_Dag": dag_unique_id
+    }
+
+class BatchAllocateServiceRequest(BaseModel):
+    dag_id: str
+    execution_id: str
+    count: int = 1
+    services: Dict[str, int] = {}  # 可選：同時 lease 其他 service，{service_name: count}
+    lease_ttl: Optional[int] = None
+    strategy: Optional[str] = None
+
+
+# Batch Allocate External Service：一次 lease 多台 instance (全有或全無)
+@router.post("/allocate_service/{service_name}/batch")
+async def allocate_service_batch(service_name: str, request: BatchAllocateServiceRequest):
+    """
+    DAG fan-out 時一次取得多台 Server：
+    1. 從 Consul catalog cache 取得每個 service 的 instance
+    2. 每個 service 以 Lua script 鎖定 count 台，所有 script 以 pipeline 一次送出
+    3. 任何一個 service 數量不足就釋放全部已鎖定的 instance，回傳 404
+    """
+    dag_id = request.dag_id
+    execution_id = request.execution_id
+
+    if not (dag_id and execution_id ):
+        raise HTTPException(status_code=400, detail="Dag id nd Execution_id required.")
+
+    counts = dict(request.services)
+    counts[service_name] = counts.get(service_name, 0) + request.count
+    if any(count < 1 for count in counts.values()):
+        raise HTTPException(status_code=400, detail="Count must be at least 1.")
+
+    dag_unique_id = f"{dag_id}_{execution_id}"
+    lease_ttl = resolve_lease_ttl(request.lease_ttl)
+    strategy = instance_selector.validate(request.strategy)
+
+    requested = {}
+    for name, count in counts.items():
+        service_instances = await consul.consul_catalog.aget(name)
+        if len(service_instances) < count:
+            raise HTTPException(status_code=404, detail=f"❌ {name} 只有 {len(service_instances)} 個 Service_Instance，不足 {count} 個")
+        requested[name] = (service_instances, count)
+
+    leases, failed = await run_in_threadpool(claim_service_instances_batch, requested, dag_unique_id, lease_ttl, strategy)
+    ALLOCATION_REQUESTS.labels(service_name, "batch_rejected" if failed else "batch_allocated").inc()
+    if failed:
+        raise HTTPException(status_code=404, detail=f"{', '.join(failed)} 可用的 Server 數量不足，請稍後重試")
+
+    return {
+        "leases": [
+            {"service_name": lease["service_name"], **lease_response(lease["instance"], lease["fencing_token"], lease_ttl)}
+            for lease in leases
+        ],
+        "For_Dag": dag_unique_id
+    }
+
+
+class LeaseRequest(AllocateExternalServiceRequest):
+    fencing_token: Optional[int] = None
+
+
+# Renew External Service：lease heartbeat
+@router.post("/renew_service/{assigned_service_instance_id}")
+async def renew_service(assigned_service_instance_id: str, request: LeaseRequest):
+    """
+    DAG 執行期間定期呼叫以延長 lease，需帶 allocate 時拿到的 fencing token
+    """
+    dag_id = request.dag_id
+    execution_id = request.execution_id
+
+    if not (dag_id and execution_id ):
+        raise HTTPException(status_code=400, detail="Dag id nd Execution_id required.")
+    if request.fencing_token is None:
+        raise HTTPException(status_code=400, detail="fencing_token is required.")
+
+    dag_unique_id = f"{dag_id}_{execution_id}"
+    lease_ttl = resolve_lease_ttl(request.lease_ttl)
+
+    status, detail = await run_in_threadpool(
+        renew_service_instance, assigned_service_instance_id, dag_unique_id, request.fencing_token, lease_ttl
+    )
+    if status == 0:
+        raise HTTPException(status_code=409, detail=f"Service Instance : {assigned_service_instance_id} 的 lease 已過期或已釋放")
+    if status < 0:
+        raise HTTPException(status_code=409, detail=f"Service Instance : {assigned_service_instance_id} 目前被 {detail} 持有，{dag_unique_id} 無法續約")
+
+    return {
+        "status": "Renewed",
+        "assigned_service_instance_id": assigned_service_instance_id,
+        "fencing_token": request.fencing_token,
+        "lease_ttl": lease_ttl,
+        "lease_expires_at": datetime.utcfromtimestamp(int(detail) / 1000).isoformat(),
+    }
+
+
+# Release External Service
+@router.post("/release_service/{assigned_service_instance_id}")
+async def release_service(assigned_service_instance_id: str, request: LeaseRequest):
+    """
+    DAG 完成後，釋放  Server
+    (fencing_token 必須與目前 lease 相符，避免過期的 DAG 釋放掉別人的 lease；LEASE_REQUIRE_FENCING_TOKEN=false 時可省略)
+    """
+    dag_id = request.dag_id
+    execution_id = request.execution_id
+
+    # 確認 Image Name 格式
+    if not (dag_id and execution_id ):
+        raise HTTPException(status_code=400, detail="Dag id nd Execution_id required.")
+    if request.fencing_token is None and LEASE_REQUIRE_FENCING_TOKEN:
+        raise HTTPException(status_code=400, detail="fencing_token is required.")
+
+    dag_unique_id = f"{dag_id}_{execution_id}"
+
+    # 比對 owner / token 與解除鎖定在同一個 Lua script 內完成，避免檢查後被別人搶走
+    status, locked_dag, lease_info = await run_in_threadpool(
+        release_service_instance, assigned_service_instance_id, dag_unique_id, request.fencing_token
+    )
+
+    if status == 0:
+        return {"status": "No Lock Exists", "message": "目前沒有鎖定的機器"}
+
+    if status == -1:
+        return {
+            "status": "Unauthorized",
+            "message": f"Service Instance : {assigned_service_instance_id} 目前被 {locked_dag} 鎖定，{dag_unique_id} 無法解除鎖。"
+        }
+
+    if status == -2:
+        return {
+            "status": "Stale Token",
+            "message": f"Service Instance : {assigned_service_instance_id} 的 fencing token 已變更，lease 已被重新分配。"
+        }
+
+    lease_reaper.emit("released", instance_lock_key(assigned_service_instance_id), lease_info)
+    return {"status": "Unlocked", "message": f"Service Instance : {assigned_service_instance_id} 已釋放，由 {dag_unique_id} 釋放"}
+
+
+@router.get("/leases")
+def list_leases():
+    """ 目前所有有效的 lease 與到期時間 """
+    infos = store.redis_lock.hgetall(LEASE_INFO_KEY)
+    expiries = dict(store.redis_lock.zrange(LEASE_EXPIRY_KEY, 0, -1, withscores=True))
+    leases = []
+    for lock_key, info in infos.items():
+        owner, token, service_name, granted_ms = info.rsplit("|", 3)
+        expires_at = expiries.get(lock_key)
+        leases.append({
+            "service_instance_id": lock_key[len(instance_lock_key("")):],
+            "service_name": service_name,
+            "owner": owner,
+            "fencing_token": int(token),
+            "lease_granted_at": datetime.utcfromtimestamp(int(granted_ms) / 1000).isoformat(),
+            "lease_expires_at": datetime.utcfromtimestamp(expires_at / 1000).isoformat() if expires_at else None,
+        })
+    return {"leases": leases}
+
+
+@router.get("/leases/events")
+def list_lease_events():
+    return {"events": lease_reaper.recent_events(), **lease_reaper.counts()}
@@ -0,0 +1,154 @@
+from fastapi import APIRouter, HTTPException
+import os
+import time
+import requests
+import threading
+from fastapi.concurrency import run_in_threadpool
+from .observability import logger, observe_call
+
+router = APIRouter()
+
+
+##############################################################
+# Consul catalog cache：以 blocking query (?index=) 維持本地 service instance 列表 (含 health check 狀態)
+
+CONSUL_HOST = "http://consul-consul-server.consul.svc.cluster.local:8500"
+
+CONSUL_BLOCKING_WAIT = os.getenv("CONSUL_BLOCKING_WAIT", "5m")
+CONSUL_BLOCKING_TIMEOUT = int(os.getenv("CONSUL_BLOCKING_TIMEOUT", "330"))  # 需大於 CONSUL_BLOCKING_WAIT
+CONSUL_INITIAL_FETCH_TIMEOUT = float(os.getenv("CONSUL_INITIAL_FETCH_TIMEOUT", "5"))
+
+
+def normalize_consul_health_entry(item: dict) -> dict:
+    """ 將 /v1/health/service 的回應轉成 catalog 格式，並附上健康狀態 """
+    service = item.get("Service", {})
+    node = item.get("Node", {})
+    checks = item.get("Checks", [])
+    return {
+        "ServiceID": service.get("ID"),
+        "ServiceAddress": service.get("Address") or node.get("Address"),
+        "ServicePort": service.get("Port"),
+        "ServiceMeta": service.get("Meta") or {},
+        "ServiceWeights": service.get("Weights") or {},
+        "Node": node.get("Node"),
+        "Healthy": all(check.get("Status") == "passing" for check in checks),
+    }
+
+
+class ConsulCatalogCache:
+    """
+    每個 service 由一條背景 thread 發 blocking query：
+    1. Consul 在 catalog 變動 (或 wait 到期) 時才回應，回應後立即以新的 X-Consul-Index 再發下一次
+    2. /allocate_service 直接讀本地快取，不需要任何網路往返
+    3. 第一次查詢某個 service 時 (cache miss) 才會等待初次同步
+    """
+
+    def __init__(self, consul_host: str):
+        self.consul_host = consul_host
+        self._lock = threading.Lock()
+        self._services = {}  # service_name -> {"instances", "index", "last_contact", "ready", "error"}
+        self._stop = threading.Event()
+        self.stats = {"hits": 0, "misses": 0, "refreshes": 0, "errors": 0}
+
+    def _ensure_watch(self, service_name: str):
+        with self._lock:
+            entry = self._services.get(service_name)
+            if entry is not None:
+                return entry, False
+            entry = {"instances": None, "index": 0, "last_contact": None, "ready": threading.Event(), "error": None}
+            self._services[service_name] = entry
+        threading.Thread(target=self._watch, args=(service_name, entry), name=f"consul-{service_name}", daemon=True).start()
+        return entry, True
+
+    def get(self, service_name: str):
+        entry, created = self._ensure_watch(service_name)
+        if not created and entry["ready"].is_set():
+            with self._lock:
+                self.stats["hits"] += 1
+            return entry["instances"]
+        with self._lock:
+            self.stats["misses"] += 1
+        if not entry["ready"].wait(timeout=CONSUL_INITIAL_FETCH_TIMEOUT):
+            raise HTTPException(status_code=500, detail="❌ 無法從 Consul 獲取可用機器")
+        return entry["instances"]
+
+    def cached(self, service_name: str) -> list:
+        """ 只讀取已同步的快取，不啟動新的 watch 也不等待 """
+        with self._lock:
+            entry = self._services.get(service_name)
+            return list(entry["instances"] or []) if entry is not None else []
+
+    async def aget(self, service_name: str):
+        """ 命中時直接回傳；只有第一次 (cache miss) 才丟到 threadpool 等待，避免阻塞 event loop """
+        with self._lock:
+            entry = self._services.get(service_name)
+            if entry is not None and entry["ready"].is_set():
+                self.stats["hits"] += 1
+                return entry["instances"]
+        return await run_in_threadpool(self.get, service_name)
+
+    def stop(self):
+        self._stop.set()
+
+    def _watch(self, service_name: str, entry: dict):
+        session = requests.Session()
+        backoff = 1
+        while not self._stop.is_set():
+            try:
+                # index=0 是立即回傳的首次查詢；之後的 blocking query 耗時主要是等待變更，分開統計
+                operation = "health_blocking" if entry["index"] else "health"
+                with observe_call("consul", operation):
+                    response = session.get(
+                        f"{self.consul_host}/v1/health/service/{service_name}",
+                        params={"index": entry["index"], "wait": CONSUL_BLOCKING_WAIT},
+                        timeout=CONSUL_BLOCKING_TIMEOUT,
+                    )
+                    if response.status_code != 200:
+                        raise RuntimeError(f"Consul responded {response.status_code}")
+                index = int(response.headers.get("X-Consul-Index", 0))
+                with self._lock:
+                    # index 倒退時 (Consul 重啟 / snapshot restore) 需重設為 0
+                    entry["index"] = 0 if index < entry["index"] or index <= 0 else index
+                    entry["instances"] = [normalize_consul_health_entry(item) for item in response.json()]
+                    entry["last_contact"] = time.time()
+                    entry["error"] = None
+                    self.stats["refreshes"] += 1
+                entry["ready"].set()
+                backoff = 1
+            except Exception as e:
+                with self._lock:
+                    entry["error"] = str(e)
+                    self.stats["errors"] += 1
+                logger.error("Consul blocking query failed", extra={"service_name": service_name, "error": str(e)})
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 30)
+
+    def snapshot(self):
+        now = time.time()
+        with self._lock:
+            lookups = self.stats["hits"] + self.stats["misses"]
+            return {
+                **self.stats,
+                "hit_rate": (self.stats["hits"] / lookups) if lookups else 0.0,
+                "services": {
+                    name: {
+                        "instances": len(entry["instances"] or []),
+                        "index": entry["index"],
+                        "staleness_seconds": round(now - entry["last_contact"], 3) if entry["last_contact"] else None,
+                        "last_error": entry["error"],
+                    }
+                    for name, entry in self._services.items()
+                },
+            }
+
+
+consul_catalog = ConsulCatalogCache(CONSUL_HOST)
+
+
+def stop_consul_catalog():
+    consul_catalog.stop()
+
+
+@router.get("/consul_cache/stats")
+def consul_cache_stats():
+    return consul_catalog.snapshot()
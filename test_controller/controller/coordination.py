@@ -0,0 +1,163 @@
+from fastapi import APIRouter
+import os
+import time
+import redis
+from typing import Optional
+import hashlib
+import threading
+import socket
+from . import store
+from .observability import CONTROLLER_LEADER, logger, observe_call
+
+router = APIRouter()
+
+
+##############################################################
+# 多 replica 協調：controller 以 N 個 replica x M 個 uvicorn worker 執行，request handling 不依賴 process 內狀態
+# 1. 全域只能有一份的背景工作 (reaper / GC / pre-pull / warm pool 補充 / job queue 輪詢) 只在 leader 執行
+#    leader 由 Redis lease 選出 (SET NX PX + 定期續約)，leader 掛掉時 lease 到期後由其他 process 接手
+# 2. 可以依資源名稱切分的工作 (ServingInstance reconcile) 以 rendezvous hashing 分給所有存活的 process
+#    replica 增減時只有少數名稱會換手
+
+REPLICA_ID = f"{os.getenv('POD_NAME') or socket.gethostname()}-{os.getpid()}"  # 每個 uvicorn worker 是獨立的 process
+LEADER_KEY = "controller_leader"
+REPLICAS_KEY = "controller_replicas"  # zset：replica id -> 最後一次 heartbeat
+LEADER_LEASE_SECONDS = int(os.getenv("LEADER_LEASE_SECONDS", "15"))
+LEADER_RENEW_INTERVAL = float(os.getenv("LEADER_RENEW_INTERVAL", "5"))
+
+# 取得或續約 leader lease 時回傳 1；lease 由其他 replica 持有時回傳 0
+ACQUIRE_LEADER_LUA = """
+local holder = redis.call('GET', KEYS[1])
+if holder == ARGV[1] then
+    redis.call('PEXPIRE', KEYS[1], ARGV[2])
+    return 1
+end
+if holder then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+return 1
+"""
+
+RELEASE_LEADER_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+acquire_leader_script = store.redis_lock.register_script(ACQUIRE_LEADER_LUA)
+release_leader_script = store.redis_lock.register_script(RELEASE_LEADER_LUA)
+
+
+class ReplicaCoordinator:
+    """
+    背景 thread 每 LEADER_RENEW_INTERVAL 秒以一個 pipeline 完成：
+    heartbeat (zset)、清除過期的 replica、取得 / 續約 leader lease、讀取存活的 replica 清單
+    is_leader() 在 lease 到期前一秒就視為失效，避免與下一任 leader 重疊
+    (leader-only 的工作大多是 Kubernetes API 呼叫，無法以 fencing token 擋下，因此只依賴這個時間差)
+    leader 身分或 replica 清單改變時呼叫 listeners (由 coordinator thread 呼叫)
+    """
+
+    def __init__(self):
+        self._stop = threading.Event()
+        self._thread = None
+        self._leader_until = 0.0
+        self.members = []
+        self.listeners = []
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        # 先同步做一次，startup 後 (單一 replica 時) 立即成為 leader
+        self._heartbeat()
+        self._thread = threading.Thread(target=self._run, name="replica-coordinator", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        # 主動交出 lease，rolling update 時其他 replica 不必等到 lease 到期
+        try:
+            pipe = store.redis_lock.pipeline(transaction=False)
+            release_leader_script(keys=[LEADER_KEY], args=[REPLICA_ID], client=pipe)
+            pipe.zrem(REPLICAS_KEY, REPLICA_ID)
+            pipe.execute()
+        except redis.RedisError as e:
+            logger.warning("Failed to release leader lease", extra={"error": str(e)})
+        self._set_state(False, 0.0, [member for member in self.members if member != REPLICA_ID])
+
+    def is_leader(self) -> bool:
+        return time.monotonic() < self._leader_until
+
+    def owner_of(self, name: str) -> Optional[str]:
+        """ rendezvous hashing：分數最高的 replica 負責這個名稱 """
+        if not self.members:
+            return None
+        return max(self.members, key=lambda member: hashlib.sha1(f"{member}/{name}".encode()).digest())
+
+    def owns(self, name: str) -> bool:
+        return self.owner_of(name) == REPLICA_ID
+
+    def _run(self):
+        while not self._stop.wait(LEADER_RENEW_INTERVAL):
+            self._heartbeat()
+
+    def _heartbeat(self):
+        started = time.monotonic()
+        now = time.time()
+        try:
+            pipe = store.redis_lock.pipeline(transaction=False)
+            pipe.zadd(REPLICAS_KEY, {REPLICA_ID: now})
+            pipe.zremrangebyscore(REPLICAS_KEY, "-inf", now - LEADER_LEASE_SECONDS)
+            acquire_leader_script(keys=[LEADER_KEY], args=[REPLICA_ID, LEADER_LEASE_SECONDS * 1000], client=pipe)
+            pipe.zrange(REPLICAS_KEY, 0, -1)
+            with observe_call("redis", "replica_heartbeat"):
+                _, _, leader, members = pipe.execute()
+        except redis.RedisError as e:
+            # 連不到 Redis 時保留原狀態，leader 身分會隨 lease 自然失效
+            logger.warning("Replica heartbeat failed", extra={"error": str(e)})
+            return
+        leader = bool(int(leader))
+        self._set_state(leader, started + LEADER_LEASE_SECONDS - 1 if leader else 0.0, sorted(members))
+
+    def _set_state(self, leader: bool, leader_until: float, members: list):
+        was_leader = self.is_leader()
+        self._leader_until = leader_until
+        changed = members != self.members or was_leader != leader
+        self.members = members
+        CONTROLLER_LEADER.set(1 if leader else 0)
+        if not changed:
+            return
+        if was_leader != leader:
+            logger.info("Leadership changed", extra={"replica_id": REPLICA_ID, "leader": leader})
+        for listener in self.listeners:
+            try:
+                listener()
+            except Exception:
+                logger.exception("Replica coordinator listener failed")
+
+    def snapshot(self) -> dict:
+        return {
+            "replica_id": REPLICA_ID,
+            "is_leader": self.is_leader(),
+            "leader": store.redis_lock.get(LEADER_KEY),
+            "members": self.members,
+            "lease_seconds": LEADER_LEASE_SECONDS,
+        }
+
+
+coordinator = ReplicaCoordinator()
+
+
+def start_coordinator():
+    coordinator.start()
+
+
+def stop_coordinator():
+    coordinator.stop()
+
+
+@router.get("/replicas")
+def replicas():
+    return coordinator.snapshot()
@@ -0,0 +1,163 @@
+from fastapi import HTTPException
+import os
+import uuid
+import time
+import json
+from typing import Optional
+import hashlib
+import asyncio
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse
+import contextlib
+from . import store
+from .observability import observe_call
+from .informers import POD_READY_TIMEOUT
+
+
+##############################################################
+# Idempotency：同一個 key 的重試 / 並行請求共用同一次 provisioning，記錄存在 Redis (含 TTL)
+# 第一個請求搶到 key 後執行，其他請求等待結果；完成後在 IDEMPOTENCY_TTL 內重送都回傳同一個結果
+
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", str(24 * 3600)))
+# 執行中的記錄在這段時間後過期 (controller 中途重啟時讓重試可以重新執行)，需大於最長的 provisioning 時間
+IDEMPOTENCY_IN_FLIGHT_TTL = int(os.getenv("IDEMPOTENCY_IN_FLIGHT_TTL", "1800"))
+IDEMPOTENCY_WAIT_TIMEOUT = int(os.getenv("IDEMPOTENCY_WAIT_TIMEOUT", str(POD_READY_TIMEOUT + 120)))
+IDEMPOTENCY_POLL_INTERVAL = 0.5
+IDEMPOTENCY_KEY_PREFIX = "idempotency:"
+
+# KEYS[1]: idempotency key；ARGV: 新的 in_flight 記錄, TTL
+# 沒有記錄或上一次失敗才寫入並回傳 nil；否則回傳目前的記錄
+CLAIM_IDEMPOTENCY_LUA = """
+local current = redis.call("GET", KEYS[1])
+if current and cjson.decode(current)["state"] ~= "failed" then
+    return current
+end
+redis.call("SET", KEYS[1], ARGV[1], "EX", tonumber(ARGV[2]))
+return false
+"""
+
+# KEYS[1]: idempotency key；ARGV: owner, 最終記錄, TTL；只有仍由自己持有時才寫入
+COMPLETE_IDEMPOTENCY_LUA = """
+local current = redis.call("GET", KEYS[1])
+if current and cjson.decode(current)["owner"] ~= ARGV[1] then
+    return 0
+end
+redis.call("SET", KEYS[1], ARGV[2], "EX", tonumber(ARGV[3]))
+return 1
+"""
+claim_idempotency_script = store.redis_lock.register_script(CLAIM_IDEMPOTENCY_LUA)
+complete_idempotency_script = store.redis_lock.register_script(COMPLETE_IDEMPOTENCY_LUA)
+
+
+def resolve_idempotency_key(header_key: Optional[str], request) -> Optional[str]:
+    """ 優先使用 Idempotency-Key header，其次 body 的 idempotency_key，最後由 dag_id + execution_id 推導 """
+    key = header_key or getattr(request, "idempotency_key", None)
+    if key:
+        return key
+    execution_id = getattr(request, "execution_id", None)
+    if execution_id:
+        return f"{getattr(request, 'dag_id', None) or ''}/{execution_id}"
+    return None
+
+
+def request_fingerprint(request) -> str:
+    payload = request.model_dump(exclude={"idempotency_key"})
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class IdempotencyStore:
+
+    def __init__(self):
+        self._events = {}  # 本 process 內執行中的 key -> asyncio.Event，讓同一個 replica 的等待者立即被喚醒
+
+    def redis_key(self, scope: str, key: str) -> str:
+        return f"{IDEMPOTENCY_KEY_PREFIX}{scope}:{hashlib.sha256(key.encode()).hexdigest()[:32]}"
+
+    def claim(self, redis_key: str, fingerprint: str, detail: dict):
+        """ 回傳 (owner token 或 None, 目前記錄)：搶到時 owner token 不為 None """
+        owner = uuid.uuid4().hex
+        record = {"state": "in_flight", "owner": owner, "fingerprint": fingerprint, "created_at": time.time(), **detail}
+        with observe_call("redis", "claim_idempotency"):
+            current = claim_idempotency_script(keys=[redis_key], args=[json.dumps(record), IDEMPOTENCY_IN_FLIGHT_TTL], client=store.redis_lock)
+        if current is None:
+            return owner, record
+        return None, json.loads(current)
+
+    def complete(self, redis_key: str, owner: str, fingerprint: str, status_code: int, body):
+        record = {
+            "state": "succeeded" if status_code < 400 else "failed",
+            "owner": owner,
+            "fingerprint": fingerprint,
+            "status_code": status_code,
+            "body": body,
+            "completed_at": time.time(),
+        }
+        with observe_call("redis", "complete_idempotency"):
+            complete_idempotency_script(keys=[redis_key], args=[owner, json.dumps(record, default=str), IDEMPOTENCY_TTL], client=store.redis_lock)
+
+    def get(self, redis_key: str) -> Optional[dict]:
+        value = store.redis_lock.get(redis_key)
+        return json.loads(value) if value else None
+
+    @staticmethod
+    def _replay(record: dict, fingerprint: str):
+        """ 回傳已完成記錄的結果；仍在執行中回傳 None """
+        if record["fingerprint"] != fingerprint:
+            raise HTTPException(status_code=422, detail="Idempotency key was already used with a different request body.")
+        if record["state"] == "in_flight":
+            return None
+        if record["state"] == "failed":
+            raise HTTPException(status_code=record["status_code"], detail=record["body"])
+        return JSONResponse(content=record["body"], status_code=record["status_code"], headers={"Idempotent-Replayed": "true"})
+
+    def _in_flight_timeout(self, record: dict):
+        detail = {k: v for k, v in record.items() if k not in ("owner", "fingerprint", "state")}
+        return HTTPException(status_code=409, detail={"message": "A request with this idempotency key is still in progress.", **detail})
+
+    async def run(self, scope: str, key: Optional[str], request, handler, detail: dict = None, status_code: int = 200):
+        """ handler() 為實際執行的 coroutine function；key 為 None 時直接執行 """
+        if key is None:
+            return await handler()
+        redis_key = self.redis_key(scope, key)
+        fingerprint = request_fingerprint(request)
+        deadline = time.monotonic() + IDEMPOTENCY_WAIT_TIMEOUT
+        while True:
+            owner, record = await run_in_threadpool(self.claim, redis_key, fingerprint, detail or {})
+            if owner is not None:
+                break
+            response = self._replay(record, fingerprint)
+            if response is not None:
+                return response
+            if time.monotonic() >= deadline:
+                raise self._in_flight_timeout(record)
+            # 等待中的記錄可能因為 owner 失敗而變成 failed，或因 TTL 過期消失，下一輪會重新 claim
+            event = self._events.get(redis_key)
+            if event is not None:
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(event.wait(), timeout=max(deadline - time.monotonic(), 0))
+            else:
+                await asyncio.sleep(IDEMPOTENCY_POLL_INTERVAL)
+            record = await run_in_threadpool(self.get, redis_key)
+            if record is not None:
+                response = self._replay(record, fingerprint)
+                if response is not None:
+                    return response
+
+        event = self._events[redis_key] = asyncio.Event()
+        try:
+            try:
+                body = await handler()
+            except HTTPException as e:
+                await run_in_threadpool(self.complete, redis_key, owner, fingerprint, e.status_code, e.detail)
+                raise
+            except Exception as e:
+                await run_in_threadpool(self.complete, redis_key, owner, fingerprint, 500, str(e))
+                raise
+            await run_in_threadpool(self.complete, redis_key, owner, fingerprint, status_code, body)
+            return body
+        finally:
+            event.set()
+            self._events.pop(redis_key, None)
+
+
+idempotency = IdempotencyStore()
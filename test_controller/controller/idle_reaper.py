@@ -0,0 +1,246 @@
+from fastapi import APIRouter, HTTPException
+import os
+from kubernetes import client
+import time
+import redis
+import json
+import threading
+from fastapi.concurrency import run_in_threadpool
+from . import kube, store, consul
+from .observability import logger, observe_call
+from .kube import k8s_request
+from .coordination import coordinator
+from .informers import DAG_LABEL, is_serving_pod, pod_image_ref, pod_informer
+from .images import image_tag
+from .locality import pod_gpu_count
+from .model_cache import MODEL_URI_ANNOTATION
+from .provisioning import build_serving_pod_plan, delete_serving_resources, POD_ACTIVITY_KEY, provision_serving_pod
+from .leases import instance_lock_key, LEASE_INFO_KEY
+
+router = APIRouter()
+
+
+##############################################################
+# Idle reaper：追蹤每個 Pod 最後一次收到 request 的時間，閒置過久就回收 (serving Pod 可 scale-to-zero 再喚醒)
+
+IDLE_POD_TTL = int(os.getenv("IDLE_POD_TTL", "3600"))
+TASK_POD_IDLE_TTL = int(os.getenv("TASK_POD_IDLE_TTL", "1800"))
+IDLE_REAPER_INTERVAL = int(os.getenv("IDLE_REAPER_INTERVAL", "60"))
+IDLE_REAPER_HISTORY_SIZE = 1000
+SCALED_TO_ZERO_KEY = "scaled_to_zero"         # hash：pod name -> 重新建立所需的 spec
+IDLE_REAPER_HISTORY_KEY = "idle_reaper_history"
+IDLE_REAPER_OPT_OUT_LABEL = "ml-serving/idle-reaper"  # 設為 disabled 的 Pod 不會被回收
+
+
+def serving_spec_from_pod(pod) -> dict:
+    """ 由現有的 serving Pod 反推 create_pod 參數 (harbor.pdc.tw/{image_name}:{image_tag}) """
+    container = pod.spec.containers[0]
+    image = pod_image_ref(pod)
+    image = image[len("harbor.pdc.tw/"):] if image.startswith("harbor.pdc.tw/") else image
+    image_name, image_tag = image.rsplit(":", 1)
+    return {
+        "image_name": image_name,
+        "image_tag": image_tag,
+        "export_port": container.ports[0].container_port,
+        "dag_id": (pod.metadata.labels or {}).get(DAG_LABEL),
+        "model_uri": (pod.metadata.annotations or {}).get(MODEL_URI_ANNOTATION),
+    }
+
+
+class IdleReaper:
+    """
+    1. Pod 透過 POST /pods/{pod_name}/activity 回報活動 (test_mlserving / test_taskpod 的 middleware 會自動回報)
+    2. 背景 thread 定期檢查：serving Pod 閒置超過 IDLE_POD_TTL、task Pod 超過 TASK_POD_IDLE_TTL 即回收
+       - 只回收至少回報過一次活動的 Pod (image 沒有回報 middleware 的 Pod 無從判斷是否閒置)
+       - Running 的 task Pod 不回收 (訓練中不會收到 request，沒有活動不代表閒置)
+       - 持有有效 allocation lease 的 instance 不回收
+    3. serving Pod 連同 PVC / Service 一起刪除，並記下 spec；之後 POST /pods/{pod_name}/wake 以同名重新建立
+    4. 累計被回收的 GPU-hours (從回收時間算到重新喚醒或現在)
+    """
+
+    def __init__(self):
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="idle-reaper", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def touch(self, pod_name: str):
+        with observe_call("redis", "touch_activity"):
+            store.redis_lock.zadd(POD_ACTIVITY_KEY, {pod_name: time.time()})
+
+    def _run(self):
+        while not self._stop.is_set():
+            if pod_informer.has_synced() and coordinator.is_leader():
+                try:
+                    self.reap()
+                except Exception:
+                    logger.exception("Idle reaper error")
+            self._stop.wait(IDLE_REAPER_INTERVAL)
+
+    def _candidates(self):
+        for pod in pod_informer.list():
+            labels = pod.metadata.labels or {}
+            if labels.get(IDLE_REAPER_OPT_OUT_LABEL) == "disabled" or labels.get("warm-pool") == "idle":
+                continue
+            if pod.metadata.deletion_timestamp is not None:
+                continue
+            if is_serving_pod(pod):
+                yield pod, "serving", IDLE_POD_TTL
+            elif labels.get("app") == "task-pod" and not (pod.status and pod.status.phase == "Running"):
+                yield pod, "task", TASK_POD_IDLE_TTL
+
+    @staticmethod
+    def _leased(lease_infos: dict) -> set:
+        """ 有效 lease 對應的 instance id 與位址 (由 Consul 快取查出) """
+        leased = set()
+        for lock_key, info in lease_infos.items():
+            instance_id = lock_key[len(instance_lock_key("")):]
+            leased.add(instance_id)
+            service_name = info.rsplit("|", 3)[2] if info.count("|") >= 3 else ""
+            for instance in consul.consul_catalog.cached(service_name):
+                if instance["ServiceID"] == instance_id:
+                    leased.add(instance["ServiceAddress"])
+        return leased
+
+    def reap(self) -> int:
+        now = time.time()
+        candidates = list(self._candidates())
+        if not candidates:
+            return 0
+        pipe = store.redis_lock.pipeline(transaction=False)
+        for pod, _, _ in candidates:
+            pipe.zscore(POD_ACTIVITY_KEY, pod.metadata.name)
+        pipe.hgetall(LEASE_INFO_KEY)
+        *last_seen, lease_infos = pipe.execute()
+        leased = self._leased(lease_infos)
+
+        reaped = 0
+        for (pod, kind, ttl), last_active in zip(candidates, last_seen):
+            if last_active is None:
+                continue  # 從未回報活動
+            if pod.metadata.name in leased or (pod.status and pod.status.pod_ip in leased):
+                continue
+            started = pod.metadata.creation_timestamp.timestamp() if pod.metadata.creation_timestamp else now
+            idle_seconds = now - max(last_active, started)
+            if idle_seconds < ttl:
+                continue
+            self._reap_pod(pod, kind, idle_seconds)
+            reaped += 1
+        return reaped
+
+    def _reap_pod(self, pod, kind: str, idle_seconds: float):
+        pod_name = pod.metadata.name
+        record = {
+            "pod_name": pod_name,
+            "kind": kind,
+            "gpus": pod_gpu_count(pod),
+            "idle_seconds": int(idle_seconds),
+            "reaped_at": time.time(),
+            "woken_at": None,
+        }
+        logger.info("Reaping idle pod", extra={"pod_name": pod_name, "kind": kind, "idle_seconds": int(idle_seconds)})
+        if kind == "serving":
+            store.redis_lock.hset(SCALED_TO_ZERO_KEY, pod_name, json.dumps({**serving_spec_from_pod(pod), **record}))
+            delete_serving_resources(pod_name)
+        else:
+            try:
+                k8s_request(kube.v1.delete_namespaced_pod, name=pod_name, namespace="ml-serving", propagation_policy="Background")
+            except client.exceptions.ApiException as e:
+                if e.status != 404:
+                    raise
+            self._record_history(record)
+        store.redis_lock.zrem(POD_ACTIVITY_KEY, pod_name)
+
+    def _record_history(self, record: dict):
+        pipe = store.redis_lock.pipeline(transaction=False)
+        pipe.lpush(IDLE_REAPER_HISTORY_KEY, json.dumps(record))
+        pipe.ltrim(IDLE_REAPER_HISTORY_KEY, 0, IDLE_REAPER_HISTORY_SIZE - 1)
+        pipe.execute()
+
+    def on_pod_event(self, event_type: str, pod):
+        # 其他路徑 (bulk delete / orphan GC / reconciler / 手動 kubectl) 刪掉的 Pod 也要清掉活動記錄
+        if event_type == "DELETED" and coordinator.is_leader():
+            try:
+                store.redis_lock.zrem(POD_ACTIVITY_KEY, pod.metadata.name)
+            except redis.RedisError as e:
+                logger.warning("Failed to clear pod activity", extra={"pod_name": pod.metadata.name, "error": str(e)})
+
+    def scaled_to_zero(self, pod_name: str):
+        spec = store.redis_lock.hget(SCALED_TO_ZERO_KEY, pod_name)
+        return json.loads(spec) if spec else None
+
+    def mark_woken(self, pod_name: str, spec: dict):
+        spec["woken_at"] = time.time()
+        pipe = store.redis_lock.pipeline(transaction=False)
+        pipe.hdel(SCALED_TO_ZERO_KEY, pod_name)
+        pipe.zadd(POD_ACTIVITY_KEY, {pod_name: spec["woken_at"]})
+        pipe.execute()
+        self._record_history(spec)
+
+    def snapshot(self):
+        now = time.time()
+        history = [json.loads(item) for item in store.redis_lock.lrange(IDLE_REAPER_HISTORY_KEY, 0, -1)]
+        sleeping = [json.loads(item) for item in store.redis_lock.hvals(SCALED_TO_ZERO_KEY)]
+        gpu_seconds = sum(r["gpus"] * ((r["woken_at"] or now) - r["reaped_at"]) for r in history + sleeping)
+        idle_gpu_seconds = sum(r["gpus"] * r["idle_seconds"] for r in history + sleeping)
+        return {
+            "idle_pod_ttl": IDLE_POD_TTL,
+            "task_pod_idle_ttl": TASK_POD_IDLE_TTL,
+            "reaped": len(history) + len(sleeping),
+            "scaled_to_zero": sorted(r["pod_name"] for r in sleeping),
+            "reclaimed_gpu_hours": round(gpu_seconds / 3600, 3),
+            "idle_gpu_hours_before_reap": round(idle_gpu_seconds / 3600, 3),
+        }
+
+
+idle_reaper = IdleReaper()
+pod_informer.add_handler(idle_reaper.on_pod_event)
+
+
+def start_idle_reaper():
+    idle_reaper.start()
+
+
+def stop_idle_reaper():
+    idle_reaper.stop()
+
+
+# Pod 回報活動 (heartbeat)
+@router.post("/pods/{pod_name}/activity")
+def report_pod_activity(pod_name: str):
+    idle_reaper.touch(pod_name)
+    return {"pod_name": pod_name, "scaled_to_zero": idle_reaper.scaled_to_zero(pod_name) is not None}
+
+
+# 喚醒已被 scale-to-zero 的 serving Pod (沿用原本的 Pod / Service 名稱，DNS 不變)
+@router.post("/pods/{pod_name}/wake")
+async def wake_pod(pod_name: str):
+    spec = await run_in_threadpool(idle_reaper.scaled_to_zero, pod_name)
+    if spec is None:
+        pod = pod_informer.get(pod_name)
+        if pod is not None:
+            return {"message": "Pod is already running", "pod_name": pod_name, "phase": pod.status.phase if pod.status else None}
+        raise HTTPException(status_code=404, detail=f"{pod_name} is not scaled to zero.")
+    if pod_informer.get(pod_name) is not None:
+        raise HTTPException(status_code=409, detail=f"{pod_name} is still terminating, retry later.")
+
+    plan = await run_in_threadpool(
+        build_serving_pod_plan, spec["image_name"], spec["image_tag"], spec["export_port"], spec.get("dag_id"),
+        pod_name=pod_name, model_uri=spec.get("model_uri")
+    )
+    response = await provision_serving_pod(plan)
+    await run_in_threadpool(idle_reaper.mark_woken, pod_name, spec)
+    return {**response, "message": "Pod woken", "scaled_to_zero_seconds": int(spec["woken_at"] - spec["reaped_at"])}
+
+
+@router.get("/idle_reaper/stats")
+def idle_reaper_stats():
+    return idle_reaper.snapshot()
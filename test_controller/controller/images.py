@@ -0,0 +1,313 @@
+from fastapi import APIRouter, HTTPException
+import os
+from kubernetes import client
+import time
+import redis
+import json
+from datetime import datetime
+from pydantic import BaseModel
+from typing import Dict, List, Optional
+import hashlib
+import threading
+from fastapi.concurrency import run_in_threadpool
+from . import kube, store
+from .observability import logger
+from .kube import k8s_request
+from .coordination import coordinator
+from .informers import CONTROLLER_LABELS, node_informer
+
+router = APIRouter()
+
+
+##############################################################
+# Image pre-pull：以短暫的 DaemonSet 把常用 image 預先拉到目標 node，並由 node informer 追蹤每個 node 上的 image digest
+# image 已在 node 上時改用 digest + IfNotPresent，Pod 啟動不需再從 harbor 拉取數 GB 的 image
+
+# e.g. [{"image": "moa_ncu/task-pod:latest", "node_selector": {"gpu-node": "true"}}]
+PREPULL_IMAGES = os.getenv("PREPULL_IMAGES", '[{"image": "moa_ncu/task-pod:latest", "node_selector": {"gpu-node": "true"}}]')
+PREPULL_INTERVAL = int(os.getenv("PREPULL_INTERVAL", "1800"))  # 定期檢查 / 重新拉取 mutable tag 的間隔
+PREPULL_TIMEOUT = int(os.getenv("PREPULL_TIMEOUT", "1800"))
+PREPULL_PAUSE_IMAGE = os.getenv("PREPULL_PAUSE_IMAGE", "registry.k8s.io/pause:3.9")
+# 這些 tag 可能被重新 push，只有在最近一次 pre-pull 之後 PREPULL_INTERVAL 內才以 digest 固定
+MUTABLE_IMAGE_TAGS = set(os.getenv("MUTABLE_IMAGE_TAGS", "latest").split(","))
+PREPULL_LABEL = "ml-serving/prepull"
+PREPULLED_AT_KEY = "image_prepulled_at"  # hash：image -> 最近一次 pre-pull 完成時間
+PREPULL_RUNS_KEY = "image_prepull_runs"  # hash：DaemonSet name -> {images, node_selector, state, started_at, finished_at, nodes}
+PREPULL_STATS_KEY = "image_prepull_stats"  # hash：started / succeeded / timed_out
+PREPULL_RUN_RETENTION = int(os.getenv("PREPULL_RUN_RETENTION", "86400"))  # 已結束的 run 保留多久供 GET /prepull 查詢
+
+
+def qualify_image(image: str) -> str:
+    return image if image.startswith("harbor.pdc.tw/") else f"harbor.pdc.tw/{image}"
+
+
+def image_tag(image: str) -> Optional[str]:
+    last = image.split("@")[0].rsplit("/", 1)[-1]
+    return last.rsplit(":", 1)[1] if ":" in last else None
+
+
+def node_image_digests(image: str) -> dict:
+    """ 回傳 {node name: digest reference}，只包含已經有這個 image (name:tag) 的 node """
+    repository = image.split("@")[0].rsplit(":", 1)[0] if image_tag(image) else image
+    digests = {}
+    for node in node_informer.by_index("image", image):
+        for entry in (node.status.images or []):
+            names = entry.names or []
+            if image in names:
+                digest = next((name for name in names if name.startswith(f"{repository}@sha256:")), None)
+                if digest:
+                    digests[node.metadata.name] = digest
+                break
+    return digests
+
+
+def resolve_image(image: str):
+    """
+    回傳 (Pod 使用的 image, imagePullPolicy)：
+    所有持有此 image 的 node 都是同一個 digest 時，改用 digest + IfNotPresent；否則維持原本的 tag + Always
+    """
+    digests = set(node_image_digests(image).values())
+    if len(digests) != 1:
+        return image, "Always"
+    if image_tag(image) in MUTABLE_IMAGE_TAGS and time.time() - image_prepuller.pulled_at.get(image, 0) > PREPULL_INTERVAL:
+        return image, "Always"
+    return digests.pop(), "IfNotPresent"
+
+
+def node_matches_selector(node, node_selector: dict) -> bool:
+    labels = node.metadata.labels or {}
+    return all(labels.get(key) == value for key, value in node_selector.items())
+
+
+class PrePullRequest(BaseModel):
+    images: List[str]  # e.g. ["moa_ncu/task-pod:latest"]，可省略 harbor.pdc.tw/
+    node_selector: Dict[str, str] = {}
+
+
+class ImagePrePuller:
+    """
+    1. 每組 (images, node_selector) 建立一個 DaemonSet：每個 image 是一個只執行 exit 0 的 initContainer，主 container 為 pause
+    2. 所有目標 node 的 status 都出現該 image (或 DaemonSet 全部 Ready) 即完成，刪除 DaemonSet
+    3. PREPULL_IMAGES 設定的 image 每 PREPULL_INTERVAL 檢查一次：有 node 缺少或 mutable tag 需要更新就重新 pre-pull
+    run 的狀態與計數存在 Redis，任何 replica 都能建立 run；追蹤完成 / 逾時只由 leader 執行
+    """
+
+    def __init__(self):
+        self._stop = threading.Event()
+        self._thread = None
+        self.targets = [
+            {"images": [qualify_image(item["image"])], "node_selector": item.get("node_selector", {})}
+            for item in json.loads(PREPULL_IMAGES)
+        ]
+        self.pulled_at = {}  # image -> 最近一次 pre-pull 完成時間
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        try:
+            self._load_pulled_at()
+        except redis.RedisError as e:
+            logger.warning("Failed to load pre-pull history", extra={"error": str(e)})
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="image-prepuller", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _load_pulled_at(self):
+        # 其他 replica (leader) 完成的 pre-pull 也要算進來，resolve_image 才會一致地以 digest 固定
+        self.pulled_at.update({image: float(ts) for image, ts in store.redis_lock.hgetall(PREPULLED_AT_KEY).items()})
+
+    def target_nodes(self, node_selector: dict) -> list:
+        return [node.metadata.name for node in node_informer.list() if node_matches_selector(node, node_selector)]
+
+    def missing_nodes(self, image: str, node_selector: dict) -> list:
+        present = set(node_informer.index_keys("image", image))
+        return [name for name in self.target_nodes(node_selector) if name not in present]
+
+    def request(self, images: list, node_selector: dict) -> dict:
+        images = sorted(qualify_image(image) for image in images)
+        name = "prepull-" + hashlib.sha1(json.dumps([images, node_selector], sort_keys=True).encode()).hexdigest()[:10]
+        run = self.get_run(name)
+        if run is not None and run["state"] == "running":
+            return {"name": name, **run}
+        manifest = self._daemon_set_manifest(name, images, node_selector)
+        try:
+            k8s_request(kube.apps_v1.create_namespaced_daemon_set, namespace="ml-serving", body=manifest)
+        except client.exceptions.ApiException as e:
+            if e.status != 409:
+                raise
+            # 上一次 (或其他 replica) 建立的 DaemonSet 還在，直接接手
+        run = {
+            "images": images, "node_selector": node_selector, "state": "running",
+            "started_at": time.time(), "finished_at": None, "nodes": self.target_nodes(node_selector),
+        }
+        pipe = store.redis_lock.pipeline(transaction=False)
+        pipe.hset(PREPULL_RUNS_KEY, name, json.dumps(run))
+        store.incr_stats(PREPULL_STATS_KEY, {"started": 1}, pipe)
+        pipe.execute()
+        logger.info("Pre-pulling images", extra={"daemon_set": name, "images": images, "nodes": len(run["nodes"])})
+        return {"name": name, **run}
+
+    @staticmethod
+    def get_run(name: str):
+        run = store.redis_lock.hget(PREPULL_RUNS_KEY, name)
+        return json.loads(run) if run else None
+
+    @staticmethod
+    def load_runs() -> dict:
+        return {name: json.loads(run) for name, run in store.redis_lock.hgetall(PREPULL_RUNS_KEY).items()}
+
+    def _daemon_set_manifest(self, name: str, images: list, node_selector: dict) -> dict:
+        labels = {**CONTROLLER_LABELS, PREPULL_LABEL: name}
+        return {
+            "apiVersion": "apps/v1",
+            "kind": "DaemonSet",
+            "metadata": {"name": name, "namespace": "ml-serving", "labels": labels},
+            "spec": {
+                "selector": {"matchLabels": {PREPULL_LABEL: name}},
+                "template": {
+                    "metadata": {"labels": labels},
+                    "spec": {
+                        "nodeSelector": node_selector,
+                        "tolerations": [{"operator": "Exists", "effect": "NoSchedule"}],
+                        "terminationGracePeriodSeconds": 0,
+                        "imagePullSecrets": [{"name": "harbor-secret"}],
+                        # 只需要觸發 kubelet 拉取 image，container 本身立即結束
+                        "initContainers": [
+                            {
+                                "name": f"pull-{index}",
+                                "image": image,
+                                "imagePullPolicy": "Always",
+                                "command": ["/bin/sh", "-c", "exit 0"],
+                                "resources": {"requests": {"cpu": "10m", "memory": "16Mi"}, "limits": {"cpu": "100m", "memory": "64Mi"}},
+                            }
+                            for index, image in enumerate(images)
+                        ],
+                        "containers": [
+                            {
+                                "name": "pause",
+                                "image": PREPULL_PAUSE_IMAGE,
+                                "resources": {"requests": {"cpu": "1m", "memory": "8Mi"}, "limits": {"cpu": "10m", "memory": "16Mi"}},
+                            }
+                        ],
+                    },
+                },
+            },
+        }
+
+    def _run(self):
+        while not node_informer.has_synced() and not self._stop.is_set():
+            time.sleep(1)
+        last_ensure = 0
+        while not self._stop.is_set():
+            try:
+                self._load_pulled_at()
+                # PREPULL_IMAGES 的定期檢查與所有 run (包含其他 replica 收到的 POST /prepull) 的追蹤只由 leader 執行
+                if coordinator.is_leader():
+                    if time.time() - last_ensure >= PREPULL_INTERVAL:
+                        last_ensure = time.time()
+                        self._ensure_targets()
+                    self._check_runs()
+            except Exception:
+                logger.exception("Image pre-pull error")
+            self._stop.wait(10)
+
+    def _ensure_targets(self):
+        for target in self.targets:
+            stale = [
+                image for image in target["images"]
+                if self.missing_nodes(image, target["node_selector"])
+                or (image_tag(image) in MUTABLE_IMAGE_TAGS and time.time() - self.pulled_at.get(image, 0) > PREPULL_INTERVAL)
+            ]
+            if stale and self.target_nodes(target["node_selector"]):
+                self.request(stale, target["node_selector"])
+
+    def _check_runs(self):
+        runs = self.load_runs()
+        expired = [name for name, run in runs.items()
+                   if run["state"] != "running" and time.time() - run["finished_at"] > PREPULL_RUN_RETENTION]
+        if expired:
+            store.redis_lock.hdel(PREPULL_RUNS_KEY, *expired)
+        for name, run in runs.items():
+            if run["state"] != "running":
+                continue
+            done = all(not self.missing_nodes(image, run["node_selector"]) for image in run["images"])
+            if not done:
+                daemon_set = k8s_request(kube.apps_v1.read_namespaced_daemon_set_status, name=name, namespace="ml-serving")
+                status = daemon_set.status
+                done = bool(status and status.desired_number_scheduled and status.number_ready == status.desired_number_scheduled)
+            # 因為 DaemonSet 是為了 pre-pull 才建立的：node status 更新間隔內就算已拉好也可能要等到下一輪
+            if not done and time.time() - run["started_at"] < PREPULL_TIMEOUT:
+                continue
+            state = "succeeded" if done else "timed_out"
+            run["state"] = state
+            run["finished_at"] = time.time()
+            pipe = store.redis_lock.pipeline(transaction=False)
+            pipe.hset(PREPULL_RUNS_KEY, name, json.dumps(run))
+            store.incr_stats(PREPULL_STATS_KEY, {state: 1}, pipe)
+            if done:
+                for image in run["images"]:
+                    self.pulled_at[image] = run["finished_at"]
+                    pipe.hset(PREPULLED_AT_KEY, image, run["finished_at"])
+            pipe.execute()
+            logger.info("Image pre-pull finished", extra={"daemon_set": name, "state": state,
+                                                          "seconds": round(run["finished_at"] - run["started_at"], 1)})
+            try:
+                k8s_request(kube.apps_v1.delete_namespaced_daemon_set, name=name, namespace="ml-serving")
+            except client.exceptions.ApiException as e:
+                if e.status != 404:
+                    raise
+
+    def snapshot(self):
+        runs = [{"name": name, **run} for name, run in sorted(self.load_runs().items(), key=lambda item: item[1]["started_at"])]
+        self._load_pulled_at()
+        return {
+            **store.load_stats(PREPULL_STATS_KEY, ("started", "succeeded", "timed_out")),
+            "targets": [
+                {**target, "missing_nodes": {image: self.missing_nodes(image, target["node_selector"]) for image in target["images"]}}
+                for target in self.targets
+            ],
+            "runs": runs,
+            "pulled_at": {image: datetime.utcfromtimestamp(ts).isoformat() for image, ts in self.pulled_at.items()},
+        }
+
+
+image_prepuller = ImagePrePuller()
+
+
+def start_image_prepuller():
+    image_prepuller.start()
+
+
+def stop_image_prepuller():
+    image_prepuller.stop()
+
+
+# 手動 pre-pull 指定 image 到符合 node_selector 的 node
+@router.post("/prepull", status_code=202)
+async def prepull_images(request: PrePullRequest):
+    if not request.images:
+        raise HTTPException(status_code=400, detail="images is required.")
+    if not node_informer.has_synced():
+        raise HTTPException(status_code=503, detail="Node cache is not synced yet.")
+    return await run_in_threadpool(image_prepuller.request, request.images, request.node_selector)
+
+
+@router.get("/prepull")
+def prepull_status():
+    return image_prepuller.snapshot()
+
+
+# 查詢某個 image 在哪些 node 上 (以及 Pod 會使用的 image / pull policy)
+@router.get("/images/nodes")
+def image_nodes(image: str):
+    image = qualify_image(image)
+    pinned_image, pull_policy = resolve_image(image)
+    return {
+        "image": image,
+        "nodes": node_image_digests(image),
+        "resolved_image": pinned_image,
+        "image_pull_policy": pull_policy,
+    }
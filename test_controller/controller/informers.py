@@ -0,0 +1,307 @@
+import os
+from kubernetes import client
+import time
+import re
+import asyncio
+import threading
+from kubernetes import watch
+from . import kube
+from .observability import INFORMER_EVENTS, INFORMER_SYNCED, logger
+from .kube import k8s_request
+
+
+##############################################################
+# Watch-based informer：一條共用的 watch stream 取代每個 request 各自輪詢
+
+POD_READY_TIMEOUT = int(os.getenv("POD_READY_TIMEOUT", "60"))
+WATCH_TIMEOUT_SECONDS = 300
+
+
+class ResourceInformer:
+    """
+    Informer-style 的 watch cache：
+    1. 啟動時 LIST 一次，取得目前物件與 resourceVersion
+    2. 之後透過單一 watch stream 持續更新本地快取 (410 Gone 時重新 LIST)
+    3. 物件變動時喚醒等待中的 request，sync (thread) 與 async (event loop) 皆支援
+    4. 可註冊 index (例如 image / phase)，查詢時不需掃描整個快取
+    5. 可註冊 event handler(event_type, obj)，由 watch thread 在快取更新後呼叫 (重新 LIST 時以 "SYNC" 逐一呼叫)
+    """
+
+    def __init__(self, kind: str, list_func_factory, namespace: str = "ml-serving", label_selector: str = None):
+        self.kind = kind
+        self.list_func_factory = list_func_factory  # startup 後才取得 API 物件，所以延遲解析
+        self.list_func = None
+        self.namespace = namespace
+        self.label_selector = label_selector
+        self._store = {}
+        self._cond = threading.Condition()
+        self._async_waiters = {}  # object name -> [(predicate, loop, future)]
+        self._indexers = {}  # index name -> key_func(obj) -> [keys]
+        self._indices = {}  # index name -> {key: set(object name)}
+        self._handlers = []
+        self._synced = threading.Event()
+        self._stop = threading.Event()
+        self._watch = None
+        self._thread = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self.list_func = self.list_func_factory()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name=f"{self.kind}-informer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._watch is not None:
+            self._watch.stop()
+
+    def has_synced(self) -> bool:
+        return self._synced.is_set()
+
+    def get(self, name: str):
+        with self._cond:
+            return self._store.get(name)
+
+    def list(self):
+        with self._cond:
+            return list(self._store.values())
+
+    def add_index(self, index_name: str, key_func):
+        with self._cond:
+            self._indexers[index_name] = key_func
+            self._indices[index_name] = {}
+            for name, obj in self._store.items():
+                self._index_object(index_name, name, obj)
+
+    def add_handler(self, handler):
+        self._handlers.append(handler)
+
+    def _dispatch(self, event_type: str, obj):
+        for handler in self._handlers:
+            try:
+                handler(event_type, obj)
+            except Exception:
+                logger.exception("Informer event handler failed", extra={"kind": self.kind, "object": obj.metadata.name})
+
+    def index_keys(self, index_name: str, key: str) -> set:
+        """ 回傳 index 中符合 key 的物件名稱 """
+        with self._cond:
+            return set(self._indices[index_name].get(key, ()))
+
+    def by_index(self, index_name: str, key: str):
+        with self._cond:
+            return [self._store[name] for name in self._indices[index_name].get(key, ()) if name in self._store]
+
+    def _index_object(self, index_name: str, name: str, obj):
+        for key in self._indexers[index_name](obj) or ():
+            self._indices[index_name].setdefault(key, set()).add(name)
+
+    def _unindex_object(self, index_name: str, name: str, obj):
+        for key in self._indexers[index_name](obj) or ():
+            bucket = self._indices[index_name].get(key)
+            if bucket is not None:
+                bucket.discard(name)
+                if not bucket:
+                    del self._indices[index_name][key]
+
+    def _list_kwargs(self):
+        # namespace=None 表示 cluster-scoped 資源 (e.g. Node)
+        kwargs = {"namespace": self.namespace} if self.namespace else {}
+        if self.label_selector:
+            kwargs["label_selector"] = self.label_selector
+        return kwargs
+
+    def _relist(self) -> str:
+        result = k8s_request(self.list_func, **self._list_kwargs())
+        with self._cond:
+            self._store = {obj.metadata.name: obj for obj in result.items}
+            for index_name in self._indexers:
+                self._indices[index_name] = {}
+                for name, obj in self._store.items():
+                    self._index_object(index_name, name, obj)
+            self._cond.notify_all()
+            for name, obj in self._store.items():
+                self._wake_async_waiters(name, obj)
+        self._synced.set()
+        INFORMER_SYNCED.labels(self.kind).set(1)
+        for obj in result.items:
+            self._dispatch("SYNC", obj)
+        return result.metadata.resource_version
+
+    def _apply(self, event_type: str, obj):
+        name = obj.metadata.name
+        with self._cond:
+            previous = self._store.get(name)
+            if previous is not None:
+                for index_name in self._indexers:
+                    self._unindex_object(index_name, name, previous)
+            if event_type == "DELETED":
+                self._store.pop(name, None)
+                current = None
+            else:
+                self._store[name] = obj
+                current = obj
+                for index_name in self._indexers:
+                    self._index_object(index_name, name, obj)
+            self._cond.notify_all()
+            self._wake_async_waiters(name, current)
+        self._dispatch(event_type, obj)
+
+    def _wake_async_waiters(self, name: str, obj):
+        # 需在持有 self._cond 時呼叫
+        for predicate, loop, future in self._async_waiters.get(name, []):
+            if predicate(obj):
+                loop.call_soon_threadsafe(_resolve_future, future, obj)
+
+    def _run(self):
+        resource_version = None
+        backoff = 1
+        while not self._stop.is_set():
+            try:
+                if resource_version is None:
+                    resource_version = self._relist()
+                self._watch = watch.Watch()
+                for event in self._watch.stream(
+                    self.list_func,
+                    resource_version=resource_version,
+                    timeout_seconds=WATCH_TIMEOUT_SECONDS,
+                    allow_watch_bookmarks=True,
+                    **self._list_kwargs()
+                ):
+                    INFORMER_EVENTS.labels(self.kind, event["type"]).inc()
+                    if event["type"] != "BOOKMARK":
+                        self._apply(event["type"], event["object"])
+                    resource_version = self._watch.resource_version or resource_version
+                    if self._stop.is_set():
+                        break
+                backoff = 1
+            except client.exceptions.ApiException as e:
+                if e.status == 410:
+                    # resourceVersion 過期，重新 LIST
+                    logger.info("Informer resourceVersion expired, relisting", extra={"kind": self.kind})
+                    resource_version = None
+                    continue
+                logger.error("Informer watch failed", extra={"kind": self.kind, "status": e.status, "error": e.reason})
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 30)
+            except Exception as e:
+                logger.exception("Informer error", extra={"kind": self.kind})
+                resource_version = None
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 30)
+
+    def wait_for(self, name: str, predicate, timeout: float):
+        """ 阻塞目前 thread，直到 predicate(obj) 成立或逾時 (逾時回傳 None) """
+        with self._cond:
+            ok = self._cond.wait_for(lambda: predicate(self._store.get(name)), timeout=timeout)
+            return self._store.get(name) if ok else None
+
+    async def async_wait_for(self, name: str, predicate, timeout: float):
+        """ 不佔用 thread 的等待版本，由 watch thread 透過 call_soon_threadsafe 喚醒 """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        waiter = (predicate, loop, future)
+        with self._cond:
+            obj = self._store.get(name)
+            if predicate(obj):
+                return obj
+            self._async_waiters.setdefault(name, []).append(waiter)
+        try:
+            return await asyncio.wait_for(future, timeout=timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            with self._cond:
+                waiters = self._async_waiters.get(name, [])
+                if waiter in waiters:
+                    waiters.remove(waiter)
+                if not waiters:
+                    self._async_waiters.pop(name, None)
+
+
+def _resolve_future(future, value):
+    if not future.done():
+        future.set_result(value)
+
+
+CONTROLLER_LABELS = {"app.kubernetes.io/managed-by": "ml-serving-pod-controller"}
+ROLE_LABEL = "ml-serving/role"
+DAG_LABEL = "ml-serving/dag-id"
+EXECUTION_LABEL = "ml-serving/execution-id"
+PROVISIONING_LABEL = "ml-serving/provisioning-id"  # 同一次 provisioning 建立的 PVC / Pod / Service 共用
+
+
+def sanitize_label_value(value: str) -> str:
+    value = re.sub(r"[^A-Za-z0-9_.-]+", "-", value)[:63]
+    return value.strip("-_.")
+
+
+def image_index_keys(image: str) -> list:
+    """ 同時以完整 image 與不含 registry / tag 的 image name 建 index """
+    name = image.split("@")[0]
+    if ":" in name.rsplit("/", 1)[-1]:
+        name = name.rsplit(":", 1)[0]
+    if name.startswith("harbor.pdc.tw/"):
+        name = name[len("harbor.pdc.tw/"):]
+    return [image, name]
+
+
+IMAGE_REF_ANNOTATION = "ml-serving/image-ref"  # digest pin 之前的原始 image (name:tag)
+
+
+def pod_image_ref(pod) -> str:
+    return (pod.metadata.annotations or {}).get(IMAGE_REF_ANNOTATION) or pod.spec.containers[0].image
+
+
+def pod_image_keys(pod) -> list:
+    keys = []
+    for container in pod.spec.containers or []:
+        keys.extend(image_index_keys(container.image))
+    ref = (pod.metadata.annotations or {}).get(IMAGE_REF_ANNOTATION)
+    if ref:
+        keys.extend(image_index_keys(ref))
+    return keys
+
+
+def node_image_names(node) -> list:
+    """ Node status 回報的 image (kubelet 預設只回報最大的 50 個)，包含 tag 與 digest 兩種名稱 """
+    images = (node.status.images or []) if node.status else []
+    return [name for image in images for name in (image.names or [])]
+
+
+def is_serving_pod(pod) -> bool:
+    labels = pod.metadata.labels or {}
+    return labels.get(ROLE_LABEL) == "serving" or pod.metadata.name.startswith("mlpod-")
+
+
+# ml-serving namespace 內的 Pod / PVC / Service / Job 各自共用一條 watch
+pod_informer = ResourceInformer("pod", lambda: kube.v1.list_namespaced_pod)
+pvc_informer = ResourceInformer("pvc", lambda: kube.v1.list_namespaced_persistent_volume_claim)
+service_informer = ResourceInformer("service", lambda: kube.v1.list_namespaced_service)
+job_informer = ResourceInformer("job", lambda: kube.batch_v1.list_namespaced_job)
+# Node 為 cluster-scoped，用來追蹤每個 node 上已有的 image digest
+node_informer = ResourceInformer("node", lambda: kube.v1.list_node, namespace=None)
+INFORMERS = [pod_informer, pvc_informer, service_informer, job_informer, node_informer]
+
+pod_informer.add_index("image", pod_image_keys)
+pod_informer.add_index("dag", lambda pod: [(pod.metadata.labels or {}).get(DAG_LABEL)] if (pod.metadata.labels or {}).get(DAG_LABEL) else [])
+pod_informer.add_index("phase", lambda pod: [pod.status.phase] if pod.status and pod.status.phase else [])
+pod_informer.add_index("role", lambda pod: ["serving"] if is_serving_pod(pod) else [])
+node_informer.add_index("image", node_image_names)
+pod_informer.add_index("job", lambda pod: [(pod.metadata.labels or {}).get("job-name")] if (pod.metadata.labels or {}).get("job-name") else [])
+pod_informer.add_index("node", lambda pod: [pod.spec.node_name] if pod.spec.node_name else [])
+pod_informer.add_index("pvc", lambda pod: [
+    volume.persistent_volume_claim.claim_name for volume in (pod.spec.volumes or []) if volume.persistent_volume_claim
+])
+
+
+def start_informers():
+    for informer in INFORMERS:
+        informer.start()
+
+
+def stop_informers():
+    for informer in INFORMERS:
+        informer.stop()
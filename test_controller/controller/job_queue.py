@@ -0,0 +1,392 @@
+from fastapi import APIRouter, Header, HTTPException
+import os
+from kubernetes import client
+import time
+import redis
+import json
+from typing import Optional
+import asyncio
+from fastapi.concurrency import run_in_threadpool
+from . import kube, store
+from .observability import logger, observe_call
+from .kube import k8s_call, parse_cpu_quantity, parse_memory_quantity
+from .coordination import coordinator
+from .informers import DAG_LABEL, job_informer, ROLE_LABEL, sanitize_label_value
+from .idempotency import idempotency, resolve_idempotency_key
+from .jobs import build_custom_job, CustomImageJobRequest, delete_config_map, job_owner_reference, JOB_RESOURCE_ANNOTATION, job_state, job_status_store, JOB_TERMINAL_STATES
+
+router = APIRouter()
+
+
+##############################################################
+# Job admission queue：依 namespace / DAG quota (jobs 數、GPU、CPU、memory) 控制同時執行的 Job
+# 排隊中的 Job 存在 Redis (controller 重啟不會遺失)；用量由 job informer 中尚未結束的 Job annotation 計算
+
+JOB_QUEUE_KEY = "job_queue"  # zset：job name -> 排入時間 (ms)
+JOB_QUEUE_ITEMS_KEY = "job_queue_items"  # hash：job name -> {namespace, dag_id, manifest, demand, enqueued_at}
+JOB_QUEUE_SUBMITTED_KEY = "job_queue_submitted"  # hash：job name -> [namespace, dag label, demand, submitted_at]
+JOB_QUEUE_SUBMITTED_TTL = 60  # 送出後這段時間內 informer 一定已看到 Job
+JOB_QUEUE_STATS_KEY = "job_queue_stats"  # hash：enqueued / admitted / submit_failures (所有 replica 累計)
+JOB_QUEUE_OWNER_PATCH_KEY = "job_queue_owner_patches"  # hash：sweep ConfigMap -> [namespace, job name]，ownerReference 尚未設定成功
+JOB_QUEUE_DISPATCH_LOCK = "job_queue_dispatch_lock"
+JOB_QUEUE_DISPATCH_LOCK_TTL = 30
+JOB_QUEUE_POLL_INTERVAL = float(os.getenv("JOB_QUEUE_POLL_INTERVAL", "5"))
+# e.g. {"ml-serving": {"jobs": 20, "gpu": 4, "cpu": "32", "memory": "128Gi"}}，未列出的資源不限制
+JOB_NAMESPACE_QUOTAS = os.getenv("JOB_NAMESPACE_QUOTAS", '{"ml-serving": {"jobs": 20, "gpu": 4}}')
+# 每個 DAG 各自的上限，e.g. {"jobs": 5, "gpu": 2}
+JOB_DAG_QUOTA = os.getenv("JOB_DAG_QUOTA", '{"jobs": 5}')
+
+
+def normalize_job_quota(quota: dict) -> dict:
+    normalized = {}
+    for resource, limit in quota.items():
+        if resource == "cpu":
+            normalized["cpu_m"] = parse_cpu_quantity(limit)
+        elif resource == "memory":
+            normalized["memory"] = parse_memory_quantity(limit)
+        else:
+            normalized[resource] = int(limit)
+    return normalized
+
+
+def job_demand(job) -> dict:
+    try:
+        return json.loads((job.metadata.annotations or {}).get(JOB_RESOURCE_ANNOTATION, "{}"))
+    except ValueError:
+        return {}
+
+
+def add_demand(usage: dict, demand: dict):
+    for resource, amount in demand.items():
+        usage[resource] = usage.get(resource, 0) + amount
+
+
+def fits_quota(usage: dict, demand: dict, quota: dict) -> bool:
+    return all(usage.get(resource, 0) + demand.get(resource, 0) <= limit for resource, limit in quota.items())
+
+
+class JobAdmissionQueue:
+    """
+    1. /job/execute_custom_image 把 Job 排進 Redis (zset 決定順序、hash 存 manifest)
+    2. dispatch 依排隊順序檢查 namespace 與 DAG quota，放得下的才建立 Job；放不下的留在佇列
+       (後面較小的 Job 可以先行，不會被前面的大 Job 卡住)
+    3. Job 狀態變化 (job informer) 或每 JOB_QUEUE_POLL_INTERVAL 秒觸發一次 dispatch (只在 leader)；
+       收到 request 的 replica 也會在背景 dispatch 一次 (request 本身不等待)，各 replica 之間以 Redis lock 互斥
+    """
+
+    def __init__(self):
+        self.namespace_quotas = {ns: normalize_job_quota(q) for ns, q in json.loads(JOB_NAMESPACE_QUOTAS).items()}
+        self.dag_quota = normalize_job_quota(json.loads(JOB_DAG_QUOTA))
+        self._loop = None
+        self._wakeup = None
+        self._lock = None
+        self._task = None
+        self._kick = None
+        self._kick_again = False
+
+    def start(self, loop):
+        self._loop = loop
+        self._wakeup = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task = loop.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+        self._loop = None
+
+    def on_job_event(self, event_type: str, job):
+        # 由 job informer 的 watch thread 呼叫：Job 結束 / 被刪除時釋放了 quota
+        loop = self._loop
+        if loop is None:
+            return
+        try:
+            loop.call_soon_threadsafe(self._wakeup.set)
+        except RuntimeError:
+            pass  # shutdown 時 event loop 已關閉，informer thread 可能還在送最後幾個事件
+
+    def check_admissible(self, namespace: str, dag_id: Optional[str], demand: dict):
+        """ 單一 Job 的需求就超過 quota 時永遠排不進去，直接拒絕 """
+        quotas = [self.namespace_quotas.get(namespace, {})] + ([self.dag_quota] if dag_id else [])
+        for quota in quotas:
+            if not fits_quota({}, demand, quota):
+                raise HTTPException(status_code=400, detail=f"Job resources {demand} exceed the quota {quota}.")
+
+    def enqueue(self, job_name: str, namespace: str, dag_id: Optional[str], manifest: dict, demand: dict,
+                owned_configmap: str = None) -> Optional[int]:
+        """ 排入佇列並回傳排隊位置；同名 Job 已在佇列中時回傳 None """
+        item = {"namespace": namespace, "dag_id": dag_id, "manifest": manifest, "demand": demand, "enqueued_at": time.time()}
+        if owned_configmap:
+            item["owned_configmap"] = owned_configmap
+        with observe_call("redis", "job_enqueue"):
+            if not store.redis_lock.hsetnx(JOB_QUEUE_ITEMS_KEY, job_name, json.dumps(item)):
+                return None
+            pipe = store.redis_lock.pipeline()
+            pipe.zadd(JOB_QUEUE_KEY, {job_name: int(item["enqueued_at"] * 1000)}, nx=True)
+            pipe.zrank(JOB_QUEUE_KEY, job_name)
+            store.incr_stats(JOB_QUEUE_STATS_KEY, {"enqueued": 1}, pipe)
+            rank = pipe.execute()[1]
+        return rank + 1
+
+    def remove(self, job_name: str) -> bool:
+        pipe = store.redis_lock.pipeline()
+        pipe.zrem(JOB_QUEUE_KEY, job_name)
+        pipe.hdel(JOB_QUEUE_ITEMS_KEY, job_name)
+        return bool(pipe.execute()[1])
+
+    def position(self, job_name: str):
+        rank = store.redis_lock.zrank(JOB_QUEUE_KEY, job_name)
+        return None if rank is None else rank + 1
+
+    def get(self, job_name: str):
+        item = store.redis_lock.hget(JOB_QUEUE_ITEMS_KEY, job_name)
+        return json.loads(item) if item else None
+
+    def _load(self):
+        names = store.redis_lock.zrange(JOB_QUEUE_KEY, 0, -1)
+        items = store.redis_lock.hmget(JOB_QUEUE_ITEMS_KEY, names) if names else []
+        return [(name, json.loads(item)) for name, item in zip(names, items) if item]
+
+    def load_submitted(self) -> dict:
+        """ 任一 replica 已送出、但 informer 可能還沒看到的 Job：job name -> [namespace, dag label, demand, submitted_at] """
+        submitted = {name: json.loads(value) for name, value in store.redis_lock.hgetall(JOB_QUEUE_SUBMITTED_KEY).items()}
+        expired = [name for name, record in submitted.items() if time.time() - record[3] > JOB_QUEUE_SUBMITTED_TTL]
+        if expired:
+            store.redis_lock.hdel(JOB_QUEUE_SUBMITTED_KEY, *expired)
+        return {name: record for name, record in submitted.items() if name not in expired}
+
+    def _admit(self, job_name: str, namespace: str, dag_label: Optional[str], demand: dict):
+        pipe = store.redis_lock.pipeline()
+        pipe.zrem(JOB_QUEUE_KEY, job_name)
+        pipe.hdel(JOB_QUEUE_ITEMS_KEY, job_name)
+        pipe.hset(JOB_QUEUE_SUBMITTED_KEY, job_name, json.dumps([namespace, dag_label, demand, time.time()]))
+        store.incr_stats(JOB_QUEUE_STATS_KEY, {"admitted": 1}, pipe)
+        pipe.execute()
+
+    def usage(self, submitted: dict):
+        """ 回傳 ({namespace: usage}, {dag_id: usage})，只計算尚未結束的 custom job """
+        namespace_usage = {}
+        dag_usage = {}
+        jobs = [
+            (job.metadata.namespace or "ml-serving", (job.metadata.labels or {}).get(DAG_LABEL), job_demand(job))
+            for job in job_informer.list()
+            if (job.metadata.labels or {}).get(ROLE_LABEL) == "custom-job" and job_state(job) not in JOB_TERMINAL_STATES
+        ]
+        # informer 已看到的 Job 不重複計算
+        pending = [tuple(record[:3]) for name, record in submitted.items() if job_informer.get(name) is None]
+        for namespace, dag_label, demand in jobs + pending:
+            add_demand(namespace_usage.setdefault(namespace, {}), demand)
+            if dag_label:
+                add_demand(dag_usage.setdefault(dag_label, {}), demand)
+        return namespace_usage, dag_usage
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=JOB_QUEUE_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if not coordinator.is_leader():
+                continue
+            try:
+                await self.dispatch()
+            except Exception:
+                logger.exception("Job queue dispatch failed")
+
+    def kick(self):
+        """ 在背景 dispatch 一次 (由 event loop 呼叫)；執行中又被觸發時，結束後再跑一次 """
+        if self._kick is not None and not self._kick.done():
+            self._kick_again = True
+            return
+        self._kick = self._loop.create_task(self._dispatch_in_background())
+
+    async def _dispatch_in_background(self):
+        self._kick_again = True
+        while self._kick_again:
+            self._kick_again = False
+            try:
+                await self.dispatch()
+            except Exception:
+                logger.exception("Job queue dispatch failed")
+
+    async def dispatch(self) -> int:
+        if not job_informer.has_synced():
+            return 0
+        async with self._lock:
+            # 跨 replica 互斥：quota 計算才會包含其他 replica 剛送出的 Job
+            # acquire / release 在不同的 threadpool thread 執行，token 不能存在 thread-local
+            lock = store.redis_lock.lock(JOB_QUEUE_DISPATCH_LOCK, timeout=JOB_QUEUE_DISPATCH_LOCK_TTL, thread_local=False)
+            if not await run_in_threadpool(lock.acquire, blocking_timeout=JOB_QUEUE_DISPATCH_LOCK_TTL):
+                return 0
+            try:
+                return await self._dispatch_locked()
+            finally:
+                try:
+                    await run_in_threadpool(lock.release)
+                except redis.exceptions.LockError:
+                    logger.warning("Job queue dispatch lock expired before release")
+
+    def _record_owner_patch(self, configmap: str, namespace: str, job_name: str):
+        store.redis_lock.hset(JOB_QUEUE_OWNER_PATCH_KEY, configmap, json.dumps([namespace, job_name]))
+
+    async def _patch_owner(self, configmap: str, namespace: str, job) -> bool:
+        """ 把 sweep 參數 ConfigMap 的 owner 設為 Job (跟著 Job 一起被 garbage collect)，成功 (或 ConfigMap 已不在) 時清掉重試記錄 """
+        if job is None:
+            return False
+        try:
+            await k8s_call(
+                kube.v1.patch_namespaced_config_map, name=configmap, namespace=namespace,
+                body={"metadata": {"ownerReferences": [job_owner_reference(job)]}},
+            )
+        except client.exceptions.ApiException as e:
+            if e.status != 404:
+                logger.warning("Setting config map owner failed, will retry", extra={"config_map": configmap, "job_name": job.metadata.name,
+                                                                                   "status": e.status, "error": e.reason})
+                return False
+        await run_in_threadpool(store.redis_lock.hdel, JOB_QUEUE_OWNER_PATCH_KEY, configmap)
+        return True
+
+    async def _retry_owner_patches(self, queued: list, submitted: dict):
+        pending = await run_in_threadpool(store.redis_lock.hgetall, JOB_QUEUE_OWNER_PATCH_KEY)
+        queued_names = {job_name for job_name, _ in queued}
+        for configmap, record in pending.items():
+            namespace, job_name = json.loads(record)
+            job = job_informer.get(job_name)
+            if job_name in queued_names:
+                continue  # 建立前就重啟了，Job 還在佇列中
+            if job is None and job_name not in submitted:
+                # Job 已被刪除 (或 TTL 回收)，ConfigMap 不會再被用到
+                await delete_config_map(configmap)
+                await run_in_threadpool(store.redis_lock.hdel, JOB_QUEUE_OWNER_PATCH_KEY, configmap)
+                continue
+            await self._patch_owner(configmap, namespace, job)
+
+    async def _dispatch_locked(self) -> int:
+        admitted = 0
+        queued = await run_in_threadpool(self._load)
+        submitted = await run_in_threadpool(self.load_submitted)
+        await self._retry_owner_patches(queued, submitted)
+        namespace_usage, dag_usage = self.usage(submitted)
+        for job_name, item in queued:
+            if job_informer.get(job_name) is not None or job_name in submitted:
+                # 上次送出後還沒從佇列移除就重啟了
+                await run_in_threadpool(self.remove, job_name)
+                continue
+            namespace, demand = item["namespace"], item["demand"]
+            dag_label = sanitize_label_value(item["dag_id"]) if item["dag_id"] else None
+            if not fits_quota(namespace_usage.get(namespace, {}), demand, self.namespace_quotas.get(namespace, {})):
+                continue
+            if dag_label and not fits_quota(dag_usage.get(dag_label, {}), demand, self.dag_quota):
+                continue
+            if item.get("owned_configmap"):
+                # 先記下待設定的 ownerReference：Job 建立後不論 patch 失敗或 controller 重啟，之後的 dispatch 都會補上
+                await run_in_threadpool(self._record_owner_patch, item["owned_configmap"], namespace, job_name)
+            created = None
+            try:
+                created = await k8s_call(kube.batch_v1.create_namespaced_job, namespace=namespace, body=item["manifest"])
+            except client.exceptions.ApiException as e:
+                if e.status != 409:
+                    logger.error("Submitting queued job failed", extra={"job_name": job_name, "status": e.status, "error": e.reason})
+                    await run_in_threadpool(job_status_store.archive_submit_failure, job_name, item, str(e.reason))
+                    if item.get("owned_configmap") and job_informer.get(job_name) is None:
+                        await delete_config_map(item["owned_configmap"])
+                        await run_in_threadpool(store.redis_lock.hdel, JOB_QUEUE_OWNER_PATCH_KEY, item["owned_configmap"])
+                    await run_in_threadpool(store.incr_stats, JOB_QUEUE_STATS_KEY, {"submit_failures": 1})
+                    await run_in_threadpool(self.remove, job_name)
+                    continue
+            if item.get("owned_configmap"):
+                # Job 已建立：ownerReference 補不上只影響 ConfigMap 的回收，留給之後的 dispatch 重試，不能把 Job 當成送出失敗
+                await self._patch_owner(item["owned_configmap"], namespace, created or job_informer.get(job_name))
+            submitted[job_name] = [namespace, dag_label, demand, time.time()]
+            add_demand(namespace_usage.setdefault(namespace, {}), demand)
+            if dag_label:
+                add_demand(dag_usage.setdefault(dag_label, {}), demand)
+            await run_in_threadpool(self._admit, job_name, namespace, dag_label, demand)
+            admitted += 1
+            logger.info("Admitted queued job", extra={"job_name": job_name, "dag_id": item["dag_id"], "demand": demand,
+                                                      "waited_seconds": round(time.time() - item["enqueued_at"], 3)})
+        return admitted
+
+    def snapshot(self):
+        namespace_usage, dag_usage = self.usage(self.load_submitted())
+        queued = self._load()
+        return {
+            **store.load_stats(JOB_QUEUE_STATS_KEY, ("enqueued", "admitted", "submit_failures")),
+            "namespace_quotas": self.namespace_quotas,
+            "dag_quota": self.dag_quota,
+            "namespace_usage": namespace_usage,
+            "dag_usage": dag_usage,
+            "queued": [
+                {"job_name": name, "position": position, "dag_id": item["dag_id"], "demand": item["demand"],
+                 "waiting_seconds": round(time.time() - item["enqueued_at"], 3)}
+                for position, (name, item) in enumerate(queued, start=1)
+            ],
+        }
+
+
+job_queue = JobAdmissionQueue()
+job_informer.add_handler(job_queue.on_job_event)
+
+
+async def start_job_queue():
+    job_queue.start(asyncio.get_running_loop())
+
+
+def stop_job_queue():
+    job_queue.stop()
+
+
+@router.get("/job_queue")
+async def job_queue_stats():
+    return await run_in_threadpool(job_queue.snapshot)
+
+
+# 取消尚在排隊的 Job
+@router.delete("/job_queue/{job_name}")
+async def cancel_queued_job(job_name: str):
+    item = await run_in_threadpool(job_queue.get, job_name)
+    if not await run_in_threadpool(job_queue.remove, job_name):
+        raise HTTPException(status_code=404, detail=f"Job {job_name} is not queued.")
+    if item:
+        await run_in_threadpool(job_status_store.archive_cancelled, job_name, item)
+    if item and item.get("owned_configmap"):
+        await delete_config_map(item["owned_configmap"])
+    return {"message": "Job removed from queue", "job_name": job_name}
+
+
+# 單一 custom image Job：組好 manifest 後排進 admission queue
+@router.post("/job/execute_custom_image", status_code=202)
+async def run_custom_image_job(req: CustomImageJobRequest, idempotency_key: Optional[str] = Header(None)):
+    """
+    Job 排進 admission queue (Redis) 後立即回傳 queued 與排隊位置，不等待送出；
+    namespace / DAG quota 還有空間時由背景 dispatch 送出到 cluster，之後以 status_url 查詢 (送出失敗也記錄在那裡)
+    同一個 idempotency key (預設為 dag_id / execution_id) 重送時回傳第一次的結果，不再回應 409
+    """
+    return await idempotency.run("execute_custom_image", resolve_idempotency_key(idempotency_key, req), req,
+                                 lambda: submit_custom_image_job(req), status_code=202)
+
+
+async def submit_custom_image_job(req: CustomImageJobRequest):
+    namespace = "ml-serving"
+    job_name, job_manifest, demand = build_custom_job(req, namespace)
+    job_queue.check_admissible(namespace, req.dag_id, demand)
+
+    if job_informer.get(job_name) is not None:
+        raise HTTPException(status_code=409, detail=f"Job {job_name} already exists.")
+    # 排入佇列是最後一個可能失敗的步驟：回應成功就代表 Job 已在佇列中，idempotency 記錄與佇列不會不一致
+    position = await run_in_threadpool(job_queue.enqueue, job_name, namespace, req.dag_id, job_manifest, demand)
+    if position is None:
+        raise HTTPException(status_code=409, detail=f"Job {job_name} is already queued.")
+
+    job_queue.kick()
+    return {
+        "status": "queued",
+        "position": position,
+        "job_name": job_name,
+        "image": req.image_name,
+        "namespace": namespace,
+        "resources": demand,
+        "status_url": f"/job/{job_name}/status",
+        "wait_url": f"/job/{job_name}/wait",
+    }
@@ -0,0 +1,416 @@
+from fastapi import APIRouter, HTTPException, Query
+import os
+from kubernetes import client
+import uuid
+import json
+from datetime import datetime
+from pydantic import BaseModel
+from typing import Optional
+import re
+import hashlib
+import time
+import collections
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from . import kube, store
+from .observability import logger, observe_call
+from .kube import k8s_call, parse_cpu_quantity, parse_memory_quantity
+from .informers import CONTROLLER_LABELS, DAG_LABEL, EXECUTION_LABEL, IMAGE_REF_ANNOTATION, job_informer, pod_informer, POD_READY_TIMEOUT, ROLE_LABEL, sanitize_label_value
+from .images import resolve_image
+from .locality import preferred_node_affinity
+
+router = APIRouter()
+
+
+##############################################################
+# Job lifecycle：狀態 / log / 等待完成，全部由 job & pod informer 提供
+# Job 結束時把最終狀態 (含 exit code) 寫進 Redis，ttlSecondsAfterFinished 刪掉 Job 之後仍可查詢
+# 單一 Job 與 sweep (Indexed Job) 共用的 manifest 組裝 / index 狀態也在這裡
+
+JOB_STATUS_RETENTION_SECONDS = int(os.getenv("JOB_STATUS_RETENTION_SECONDS", str(7 * 24 * 3600)))
+JOB_WAIT_MAX_TIMEOUT = int(os.getenv("JOB_WAIT_MAX_TIMEOUT", "3600"))
+JOB_WAIT_RECHECK_SECONDS = float(os.getenv("JOB_WAIT_RECHECK_SECONDS", "5"))
+JOB_STATUS_KEY_PREFIX = "job_status:"
+JOB_TERMINAL_STATES = ("succeeded", "failed")
+JOB_RESOURCE_ANNOTATION = "ml-serving/resources"
+JOB_COMPLETION_INDEX_ANNOTATION = "batch.kubernetes.io/job-completion-index"
+
+
+class CustomImageJobRequest(BaseModel):
+    execution_id: str
+    image_name: str  # e.g., "myteam/exp-image:v1"
+    env: dict = {}   # 可選：MLFLOW_TRACKING_URI、MINIO_ENDPOINT 等
+    dag_id: Optional[str] = None  # 用於 per-DAG quota
+    gpu: int = 0  # nvidia.com/gpu 數量
+    cpu: Optional[str] = None  # CPU request/limit，Kubernetes quantity (e.g., "2", "500m")
+    memory: Optional[str] = None  # memory request/limit，Kubernetes quantity (e.g., "8Gi")
+    use_gpu: bool = False  # 舊欄位，等同 gpu=1
+    idempotency_key: Optional[str] = None  # 未指定時由 dag_id / execution_id 推導
+
+def generate_safe_job_name(execution_id: str, prefix="custom-job"):
+    raw_name = f"{prefix}-{execution_id}-{uuid.uuid4().hex[:6]}"
+    safe = re.sub(r'[^a-z0-9\-]+', '', raw_name.lower().replace('_', '-'))
+    if len(safe) > 63:
+        hash_suffix = hashlib.sha1(safe.encode()).hexdigest()[:6]
+        safe = f"{safe[:56]}-{hash_suffix}"
+    return safe
+
+
+def sanitize_job_name(raw_name: str, max_len: int = 63) -> str:
+    """ 處理 job 名稱合法性與長度限制 (超過時截斷並加上 hash 避免撞名) """
+    job_name = re.sub(r"[^a-z0-9\-]", "-", raw_name.lower())
+    if len(job_name) > max_len:
+        job_name = f"{job_name[:max_len - 7]}-{hashlib.sha1(job_name.encode()).hexdigest()[:6]}"
+    return job_name
+
+
+def build_custom_job(req: CustomImageJobRequest, namespace: str, job_name: str = None):
+    """
+    回傳 (job_name, Job manifest, 資源需求)，資源需求同時寫進 annotation 供 admission 計算用量
+    job_name 未指定時為 job-{execution_id}
+    """
+    if ":" not in req.image_name:
+        raise HTTPException(status_code=400, detail="Image name must include a tag (e.g., rss-job:latest)")
+    if req.gpu < 0:
+        raise HTTPException(status_code=400, detail="gpu must not be negative.")
+
+    job_name = job_name or sanitize_job_name(f"job-{req.execution_id}")
+
+    # 環境變數轉換
+    env_list = [{"name": k, "value": str(v)} for k, v in req.env.items() if v is not None]
+    env_list.append({"name": "EXECUTION_ID", "value": req.execution_id})
+
+    demand = {
+        "jobs": 1,
+        "gpu": max(req.gpu, 1 if req.use_gpu else 0),
+        "cpu_m": parse_cpu_quantity(req.cpu) if req.cpu else 0,
+        "memory": parse_memory_quantity(req.memory) if req.memory else 0,
+    }
+
+    full_image_name = f"harbor.pdc.tw/{req.image_name}"
+    pinned_image, pull_policy = resolve_image(full_image_name)
+    container_spec = {
+        "name": "job-container",
+        "image": pinned_image,
+        "imagePullPolicy": pull_policy,
+        "env": env_list
+    }
+    requests_spec = {}
+    if req.cpu:
+        requests_spec["cpu"] = req.cpu
+    if req.memory:
+        requests_spec["memory"] = req.memory
+    limits_spec = dict(requests_spec)
+    if demand["gpu"]:
+        limits_spec["nvidia.com/gpu"] = str(demand["gpu"])
+    if limits_spec:
+        container_spec["resources"] = {"requests": requests_spec, "limits": limits_spec} if requests_spec else {"limits": limits_spec}
+
+    job_labels = {**CONTROLLER_LABELS, ROLE_LABEL: "custom-job", EXECUTION_LABEL: sanitize_label_value(req.execution_id)}
+    if req.dag_id:
+        job_labels[DAG_LABEL] = sanitize_label_value(req.dag_id)
+
+    # 組 Job manifest
+    job_manifest = {
+        "apiVersion": "batch/v1",
+        "kind": "Job",
+        "metadata": {
+            "name": job_name,
+            "namespace": namespace,
+            "labels": job_labels,
+            "annotations": {JOB_RESOURCE_ANNOTATION: json.dumps(demand)}
+        },
+        "spec": {
+            "ttlSecondsAfterFinished": 300,
+            "backoffLimit": 1,
+            "template": {
+                "metadata": {"labels": dict(job_labels), "annotations": {IMAGE_REF_ANNOTATION: full_image_name}},
+                "spec": {
+                    "restartPolicy": "Never",
+                    "containers": [container_spec]
+                }
+            }
+        }
+    }
+    affinity = preferred_node_affinity(full_image_name, gpu=demand["gpu"])
+    if affinity:
+        job_manifest["spec"]["template"]["spec"]["affinity"] = affinity
+    return job_name, job_manifest, demand
+
+
+def job_state(job) -> str:
+    status = job.status
+    if status is None:
+        return "pending"
+    for condition in status.conditions or []:
+        if condition.status != "True":
+            continue
+        if condition.type == "Complete":
+            return "succeeded"
+        if condition.type == "Failed":
+            return "failed"
+    if status.active:
+        return "running"
+    return "pending"
+
+
+def isoformat_or_none(value):
+    return value.isoformat() if value else None
+
+
+def job_pod_view(pod) -> dict:
+    """ Pod 的 phase 與每個 container 的結束資訊 (exit code / reason) """
+    containers = []
+    for container_status in (pod.status.container_statuses or []) if pod.status else []:
+        state = container_status.state
+        terminated = state.terminated if state else None
+        waiting = state.waiting if state else None
+        containers.append({
+            "name": container_status.name,
+            "restart_count": container_status.restart_count,
+            "exit_code": terminated.exit_code if terminated else None,
+            "reason": (terminated.reason if terminated else waiting.reason if waiting else None),
+            "message": (terminated.message if terminated else waiting.message if waiting else None),
+            "finished_at": isoformat_or_none(terminated.finished_at) if terminated else None,
+        })
+    return {
+        "pod_name": pod.metadata.name,
+        "phase": pod.status.phase if pod.status else None,
+        "node": pod.spec.node_name if pod.spec else None,
+        "containers": containers,
+    }
+
+
+def parse_index_ranges(ranges: Optional[str]) -> set:
+    """ "0-2,5" -> {0, 1, 2, 5} (Job status 的 completedIndexes / failedIndexes 格式) """
+    indexes = set()
+    for part in (ranges or "").split(","):
+        if not part:
+            continue
+        start, _, end = part.partition("-")
+        indexes.update(range(int(start), int(end or start) + 1))
+    return indexes
+
+
+def sweep_index_view(job, pods: list) -> dict:
+    completed = parse_index_ranges(job.status.completed_indexes if job.status else None)
+    failed = parse_index_ranges(getattr(job.status, "failed_indexes", None) if job.status else None)
+    attempts = collections.defaultdict(list)
+    for pod in pods:
+        index = (pod.metadata.annotations or {}).get(JOB_COMPLETION_INDEX_ANNOTATION)
+        if index is not None:
+            attempts[int(index)].append(pod)
+
+    counts = collections.Counter()
+    indexes = []
+    for index in range(job.spec.completions or 0):
+        latest = attempts[index][-1] if attempts[index] else None
+        if index in completed:
+            state = "succeeded"
+        elif index in failed:
+            state = "failed"
+        elif latest is None:
+            state = "pending"
+        else:
+            state = {"Running": "running", "Failed": "failed", "Succeeded": "succeeded"}.get(latest.status.phase if latest.status else None, "pending")
+        exit_code = None
+        if latest is not None and latest.status is not None:
+            for container_status in latest.status.container_statuses or []:
+                terminated = container_status.state.terminated if container_status.state else None
+                if terminated is not None:
+                    exit_code = terminated.exit_code
+        counts[state] += 1
+        indexes.append({"index": index, "state": state, "attempts": len(attempts[index]), "exit_code": exit_code,
+                        "pod_name": latest.metadata.name if latest is not None else None})
+    return {"total": job.spec.completions or 0, **{state: counts[state] for state in ("pending", "running", "succeeded", "failed")},
+            "items": indexes}
+
+
+def job_owner_reference(job) -> dict:
+    return {"apiVersion": "batch/v1", "kind": "Job", "name": job.metadata.name, "uid": job.metadata.uid}
+
+
+async def delete_config_map(name: str):
+    try:
+        await k8s_call(kube.v1.delete_namespaced_config_map, name=name, namespace="ml-serving")
+    except client.exceptions.ApiException as e:
+        if e.status != 404:
+            logger.error("Failed to delete config map", extra={"config_map": name, "status": e.status})
+
+
+def job_status_view(job) -> dict:
+    status = job.status
+    pods = sorted(pod_informer.by_index("job", job.metadata.name), key=lambda pod: pod.metadata.creation_timestamp or datetime.min)
+    failed_condition = next(
+        (c for c in (status.conditions or []) if c.type == "Failed" and c.status == "True"), None
+    ) if status else None
+    return {
+        "job_name": job.metadata.name,
+        "execution_id": (job.metadata.labels or {}).get(EXECUTION_LABEL),
+        "state": job_state(job),
+        "active": (status.active or 0) if status else 0,
+        "succeeded": (status.succeeded or 0) if status else 0,
+        "failed": (status.failed or 0) if status else 0,
+        "start_time": isoformat_or_none(status.start_time) if status else None,
+        "completion_time": isoformat_or_none(status.completion_time) if status else None,
+        "failure_reason": failed_condition.reason if failed_condition else None,
+        "failure_message": failed_condition.message if failed_condition else None,
+        **(
+            # Indexed Job (sweep) 只保留每個 index 的精簡狀態，不逐一列出 Pod
+            {"pods": [], "indexes": sweep_index_view(job, pods)}
+            if job.spec is not None and job.spec.completion_mode == "Indexed"
+            else {"pods": [job_pod_view(pod) for pod in pods]}
+        ),
+    }
+
+
+class JobStatusStore:
+    """
+    Job 進入終止狀態 (Complete / Failed) 時，把精簡過的最終狀態寫進 Redis (保留 JOB_STATUS_RETENTION_SECONDS)
+    Job 被 TTL controller 刪除後，/job/{job_name}/status 與 /wait 仍能回傳結果
+    """
+
+    def key(self, job_name: str) -> str:
+        return f"{JOB_STATUS_KEY_PREFIX}{job_name}"
+
+    def get(self, job_name: str):
+        record = store.redis_lock.get(self.key(job_name))
+        return json.loads(record) if record else None
+
+    def on_job_event(self, event_type: str, job):
+        # 由 job informer 的 watch thread 呼叫
+        if event_type == "DELETED" or job_state(job) not in JOB_TERMINAL_STATES:
+            return
+        record = {**job_status_view(job), "archived_at": datetime.utcnow().isoformat()}
+        with observe_call("redis", "archive_job_status"):
+            # 同一個 Job 只保留第一次觀察到的最終狀態 (之後 Pod 可能已被清掉)
+            store.redis_lock.set(self.key(job.metadata.name), json.dumps(record), nx=True, ex=JOB_STATUS_RETENTION_SECONDS)
+
+
+    def archive_submit_failure(self, job_name: str, item: dict, reason: str):
+        """ 排隊中的 Job 送出失敗 (非 409)，記錄為 failed 讓 /status 與 /wait 可以回報 """
+        self._archive_unsubmitted(job_name, item, "SubmitFailed", reason)
+
+    def archive_cancelled(self, job_name: str, item: dict):
+        """ 排隊中的 Job 被取消，同樣記錄為 failed，等待中的 /wait 才會結束而不是回 404 """
+        self._archive_unsubmitted(job_name, item, "Cancelled", "Job was removed from the admission queue.")
+
+    def _archive_unsubmitted(self, job_name: str, item: dict, reason: str, message: str):
+        record = {
+            "job_name": job_name,
+            "state": "failed",
+            "dag_id": item["dag_id"],
+            "failure_reason": reason,
+            "failure_message": message,
+            "pods": [],
+            "archived_at": datetime.utcnow().isoformat(),
+        }
+        store.redis_lock.set(self.key(job_name), json.dumps(record), ex=JOB_STATUS_RETENTION_SECONDS)
+
+
+job_status_store = JobStatusStore()
+job_informer.add_handler(job_status_store.on_job_event)
+
+
+async def resolve_job_status(job_name: str):
+    job = job_informer.get(job_name)
+    if job is not None:
+        return {**job_status_view(job), "source": "live"}
+    from .job_queue import job_queue  # job_queue 依賴本模組 (job_state / job_status_store)
+    queued = await run_in_threadpool(job_queue.get, job_name)
+    if queued is not None:
+        return {
+            "job_name": job_name,
+            "state": "queued",
+            "dag_id": queued["dag_id"],
+            "resources": queued["demand"],
+            "position": await run_in_threadpool(job_queue.position, job_name),
+            "enqueued_at": datetime.utcfromtimestamp(queued["enqueued_at"]).isoformat(),
+            "source": "queue",
+        }
+    record = await run_in_threadpool(job_status_store.get, job_name)
+    if record is not None:
+        return {**record, "source": "archived"}
+    return None
+
+
+# 查詢 Job 狀態 (Job 已被 TTL 刪除時回傳保存的最終狀態)
+@router.get("/job/{job_name}/status")
+async def get_job_status(job_name: str):
+    status = await resolve_job_status(job_name)
+    if status is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_name} not found.")
+    return status
+
+
+# 等待 Job 完成 (long-poll，由 job watch 喚醒，不輪詢 API Server)
+@router.get("/job/{job_name}/wait")
+async def wait_job(job_name: str, timeout: float = Query(300, gt=0)):
+    timeout = min(timeout, JOB_WAIT_MAX_TIMEOUT)
+    status = await resolve_job_status(job_name)
+    if status is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_name} not found.")
+    deadline = time.monotonic() + timeout
+    while status["state"] not in JOB_TERMINAL_STATES:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        # 還在排隊的 Job 尚未出現在 informer，需等它被建立並結束；
+        # 排隊中被取消 / 送出失敗 (可能發生在其他 worker) 不會有 watch 事件，每 JOB_WAIT_RECHECK_SECONDS 重新查一次 queue / Redis
+        queued = status["state"] == "queued"
+        await job_informer.async_wait_for(
+            job_name,
+            lambda job: (job is None and not queued) or (job is not None and job_state(job) in JOB_TERMINAL_STATES),
+            timeout=min(remaining, JOB_WAIT_RECHECK_SECONDS),
+        )
+        status = await resolve_job_status(job_name)
+        if status is None:
+            raise HTTPException(status_code=404, detail=f"Job {job_name} was deleted before it finished.")
+    return {**status, "done": status["state"] in JOB_TERMINAL_STATES}
+
+
+def relay_log_stream(response):
+    """ 逐塊轉送 kubelet 的 log stream，follow 時直到 container 結束或 client 斷線 """
+    try:
+        for chunk in response.stream(4096):
+            yield chunk
+    finally:
+        response.release_conn()
+
+
+# Job log (follow=true 時持續串流直到 Job 的 Pod 結束)
+@router.get("/job/{job_name}/logs")
+async def get_job_logs(
+    job_name: str,
+    follow: bool = False,
+    tail_lines: Optional[int] = Query(None, ge=1),
+    container: Optional[str] = None,
+):
+    pods = sorted(pod_informer.by_index("job", job_name), key=lambda pod: pod.metadata.creation_timestamp or datetime.min)
+    if not pods:
+        if job_informer.get(job_name) is None and await run_in_threadpool(job_status_store.get, job_name) is not None:
+            raise HTTPException(status_code=410, detail=f"Job {job_name} has been cleaned up, logs are no longer available.")
+        raise HTTPException(status_code=404, detail=f"No pods found for job {job_name}.")
+
+    # 最新一次重試的 Pod；container 還沒啟動前無法讀 log，先等它離開 Pending
+    pod_name = pods[-1].metadata.name
+    pod = await pod_informer.async_wait_for(
+        pod_name, lambda pod: pod is None or (pod.status is not None and pod.status.phase != "Pending"), timeout=POD_READY_TIMEOUT
+    )
+    if pod is None:
+        raise HTTPException(status_code=409, detail=f"Pod {pod_name} of job {job_name} has not started yet.")
+
+    try:
+        response = await k8s_call(
+            kube.v1.read_namespaced_pod_log,
+            name=pod_name, namespace="ml-serving", container=container,
+            follow=follow, tail_lines=tail_lines, _preload_content=False,
+        )
+    except client.exceptions.ApiException as e:
+        raise HTTPException(status_code=e.status if e.status in (400, 404) else 500, detail=f"Read logs failed: {e.reason}")
+
+    return StreamingResponse(
+        relay_log_stream(response),
+        media_type="text/plain",
+        headers={"X-Pod-Name": pod_name},
+    )
@@ -0,0 +1,124 @@
+from fastapi import HTTPException
+import os
+from kubernetes import client, config
+import uuid
+import re
+import hashlib
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from .observability import logger, observe_call
+
+
+def load_k8s_config():
+    """ 自動偵測 Kubernetes 環境，選擇合適的 config """
+    try:
+        if "KUBERNETES_SERVICE_HOST" in os.environ:
+            # Pod 內部環境：使用 InCluster Config
+            config.load_incluster_config()
+            logger.info("Running inside Kubernetes: Using InCluster Config")
+        else:
+            # 本機開發環境：使用 Kube Config
+            config.load_kube_config()
+            logger.warning("Running locally: Using Kube Config")
+    except config.ConfigException as e:
+        logger.error("Failed to load Kubernetes config", extra={"error": str(e)})
+
+
+def sanitize_k8s_name(name: str) -> str:
+    # 將 `/`, `_` 轉成 `-`，再移除其他不合法字元
+    name = name.replace("/", "-").replace("_", "-")
+    name = re.sub(r"[^a-z0-9-]+", "", name.lower())
+    name = re.sub(r"-+", "-", name).strip("-")  # 避免多個 dash 或首尾 dash
+    return name
+
+def generate_safe_name(base_name: str, prefix: str, suffix: str = "", rand_len: int = 6, max_len: int = 45):
+    """
+    安全產生 pod/service name，避免超過 63  字元
+    base_name: 來源名稱（如 image）
+    prefix/suffix: 前綴/後綴字串
+    set max_len =45 for pod name, 45+4 for pvc & svc
+    """
+    base = base_name.split("/")[-1].replace("_", "-").replace(".", "-")
+    rand_str = uuid.uuid4().hex[:rand_len]
+    hash_part = hashlib.sha1(base.encode()).hexdigest()[:6]
+
+    # 預估長度
+    fixed_len = len(prefix) + len(suffix) + len(rand_str) + len(hash_part) + 4  # 多 4 個 "-"
+    max_base_len = max_len - fixed_len
+    short_base = base[:max_base_len]
+
+    return f"{prefix}-{short_base}-{hash_part}-{rand_str}{('-' + suffix) if suffix else ''}"
+
+
+##############################################################
+# Kubernetes client：FastAPI startup 時建立單一 ApiClient，Core / Batch / Apps API 共用同一個 connection pool
+
+K8S_CONNECTION_POOL_SIZE = int(os.getenv("K8S_CONNECTION_POOL_SIZE", "32"))
+
+# Kubernetes API 物件 (startup 後才可使用)
+k8s_api_client = None
+v1 = None
+batch_v1 = None
+apps_v1 = None
+# 專用的 thread pool：async handler 的 API Server I/O 不佔用 FastAPI 的 worker threadpool
+k8s_executor = None
+
+
+def init_k8s_clients():
+    global k8s_api_client, v1, batch_v1, apps_v1, k8s_executor
+    # 讀取 Kubernetes 設定
+    load_k8s_config()
+    configuration = client.Configuration.get_default_copy()
+    configuration.connection_pool_maxsize = K8S_CONNECTION_POOL_SIZE
+    k8s_api_client = client.ApiClient(configuration)
+    v1 = client.CoreV1Api(k8s_api_client)
+    batch_v1 = client.BatchV1Api(k8s_api_client)
+    apps_v1 = client.AppsV1Api(k8s_api_client)
+    k8s_executor = ThreadPoolExecutor(max_workers=K8S_CONNECTION_POOL_SIZE, thread_name_prefix="k8s-api")
+
+
+def k8s_request(func, *args, **kwargs):
+    """ 同步呼叫 Kubernetes API 並記錄 latency / error metrics (operation 為 API method 名稱) """
+    with observe_call("kubernetes", getattr(func, "__name__", "unknown")):
+        return func(*args, **kwargs)
+
+
+async def k8s_call(func, *args, **kwargs):
+    """ 在專用 thread pool 執行 Kubernetes API 呼叫，await 期間不阻塞 event loop """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(k8s_executor, functools.partial(k8s_request, func, *args, **kwargs))
+
+
+def start_k8s_clients():
+    init_k8s_clients()
+
+
+def close_k8s_clients():
+    if k8s_executor is not None:
+        k8s_executor.shutdown(wait=False)
+    if k8s_api_client is not None:
+        k8s_api_client.close()
+
+
+# Kubernetes resource quantity (Job resources / model cache 容量)
+CPU_QUANTITY_RE = re.compile(r"^([0-9.]+)(m?)$")
+MEMORY_QUANTITY_RE = re.compile(r"^([0-9.]+)(Ki|Mi|Gi|Ti|K|M|G|T)?$")
+MEMORY_UNITS = {None: 1, "K": 10 ** 3, "M": 10 ** 6, "G": 10 ** 9, "T": 10 ** 12, "Ki": 2 ** 10, "Mi": 2 ** 20, "Gi": 2 ** 30, "Ti": 2 ** 40}
+
+
+def parse_cpu_quantity(value: str) -> int:
+    """ "2" / "0.5" / "500m" -> millicores """
+    match = CPU_QUANTITY_RE.match(str(value).strip())
+    if not match:
+        raise HTTPException(status_code=400, detail=f"Invalid cpu quantity: {value}")
+    amount = float(match.group(1))
+    return int(amount if match.group(2) else amount * 1000)
+
+
+def parse_memory_quantity(value: str) -> int:
+    """ "512Mi" / "8Gi" / "1G" -> bytes """
+    match = MEMORY_QUANTITY_RE.match(str(value).strip())
+    if not match:
+        raise HTTPException(status_code=400, detail=f"Invalid memory quantity: {value}")
+    return int(float(match.group(1)) * MEMORY_UNITS[match.group(2)])
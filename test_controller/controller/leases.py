@@ -0,0 +1,496 @@
+from fastapi import APIRouter, HTTPException
+import os
+import time
+import redis
+import json
+from datetime import datetime
+from typing import Optional
+import threading
+import random
+from . import store
+from .observability import LOCK_CONTENTION, logger, observe_call
+from .coordination import coordinator
+
+router = APIRouter()
+
+
+##############################################################
+# Instance lease：以 Lua script 在 Redis 端原子地完成「找空閒 + 鎖定」
+# 每個 lease 帶有遞增的 fencing token，持有期間需定期 /renew_service 續約 (heartbeat)，
+# 停止續約 (DAG crash) 的 lease 在 LEASE_TTL_SECONDS 內由 reaper 回收並發出事件
+
+LEASE_TTL_SECONDS = int(os.getenv("LEASE_TTL_SECONDS", "60"))
+# 釋放時必須帶 allocate 拿到的 fencing token；尚未改為帶 token 的舊 DAG 遷移期間可暫時設為 false
+LEASE_REQUIRE_FENCING_TOKEN = os.getenv("LEASE_REQUIRE_FENCING_TOKEN", "true").lower() == "true"
+LEASE_MAX_TTL_SECONDS = int(os.getenv("LEASE_MAX_TTL_SECONDS", "3600"))
+LEASE_REAPER_INTERVAL = float(os.getenv("LEASE_REAPER_INTERVAL", "2"))
+
+LEASE_FENCING_KEY = "lease_fencing_counter"
+LEASE_EXPIRY_KEY = "lease_expiry"        # zset：lock key -> 到期時間 (ms)
+LEASE_INFO_KEY = "lease_info"            # hash：lock key -> "owner|token|service_name|granted_ms"
+LEASE_EVENTS_CHANNEL = "lease_events"
+LEASE_EVENTS_STREAM = "lease_events_stream"  # stream：最近的 lease 事件 (約 LEASE_EVENTS_MAX 筆)，/leases/events 由此讀取
+LEASE_EVENTS_MAX = int(os.getenv("LEASE_EVENTS_MAX", "200"))
+LEASE_EVENT_COUNTS_KEY = "lease_event_counts"  # hash：事件類型 -> 次數
+LEASE_KEYS = [LEASE_FENCING_KEY, LEASE_EXPIRY_KEY, LEASE_INFO_KEY]
+
+# 所有 lease script 共用：KEYS[1..3] 固定為 LEASE_KEYS，lock value 格式為 "owner|token"
+LEASE_LUA_PRELUDE = """
+local t = redis.call("TIME")
+local now_ms = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+
+local function parse(value)
+    local owner, token = string.match(value, "^(.*)|(%d+)$")
+    if not owner then
+        return value, ""
+    end
+    return owner, token
+end
+
+local function grant(key, owner, ttl, service)
+    if redis.call("EXISTS", key) == 1 then
+        return nil
+    end
+    local token = redis.call("INCR", KEYS[1])
+    redis.call("SET", key, owner .. "|" .. token, "EX", ttl)
+    redis.call("ZADD", KEYS[2], now_ms + ttl * 1000, key)
+    redis.call("HSET", KEYS[3], key, owner .. "|" .. token .. "|" .. service .. "|" .. now_ms)
+    return token
+end
+
+local function revoke(key)
+    redis.call("DEL", key)
+    redis.call("ZREM", KEYS[2], key)
+    redis.call("HDEL", KEYS[3], key)
+end
+"""
+
+# KEYS[4]: instance_last_allocated，KEYS[5]: 該 service 的等待佇列，KEYS[6]: 等待者心跳，KEYS[7..]: 候選 lock key (依挑選順序)
+# ARGV: dag_unique_id, TTL, service_name, waiter id ("" 表示新 request), 排隊 score, 心跳到期時間 (ms)
+# 先清掉心跳過期的等待者；新 request 遇到有人排隊時不可插隊，排隊中的 request 只有排頭可以鎖定
+# 回傳 {KEYS[7..] 中的 index (1-based), fencing token}，全部被鎖定時回傳 {0, 0}，前面還有人排隊時回傳 {-1, 0}
+CLAIM_INSTANCE_LUA = LEASE_LUA_PRELUDE + """
+for _, waiter in ipairs(redis.call("ZRANGEBYSCORE", KEYS[6], "-inf", now_ms)) do
+    redis.call("ZREM", KEYS[5], waiter)
+    redis.call("ZREM", KEYS[6], waiter)
+end
+local waiter = ARGV[4]
+if waiter == "" then
+    if redis.call("ZCARD", KEYS[5]) > 0 then
+        return {-1, 0}
+    end
+else
+    -- 第一次呼叫即排入佇列；心跳過期被清掉後再呼叫，會以原本的 score 回到原位
+    redis.call("ZADD", KEYS[5], ARGV[5], waiter)
+    redis.call("ZADD", KEYS[6], now_ms + tonumber(ARGV[6]), waiter)
+    if redis.call("ZRANGE", KEYS[5], 0, 0)[1] ~= waiter then
+        return {-1, 0}
+    end
+end
+for i = 7, #KEYS do
+    local token = grant(KEYS[i], ARGV[1], tonumber(ARGV[2]), ARGV[3])
+    if token then
+        redis.call("HSET", KEYS[4], KEYS[i], now_ms)
+        if waiter ~= "" then
+            redis.call("ZREM", KEYS[5], waiter)
+            redis.call("ZREM", KEYS[6], waiter)
+        end
+        return {i - 6, token}
+    end
+end
+return {0, 0}
+"""
+
+# KEYS[4]: instance_last_allocated，KEYS[5..]: 候選 lock key；ARGV: dag_unique_id, TTL, service_name, 需要的數量
+# 全有或全無：湊不到指定數量時把這次鎖到的全部還回去；回傳 {index1, token1, index2, token2, ...}
+CLAIM_INSTANCES_BATCH_LUA = LEASE_LUA_PRELUDE + """
+local need = tonumber(ARGV[4])
+local claimed = {}
+for i = 5, #KEYS do
+    if #claimed >= need * 2 then
+        break
+    end
+    local token = grant(KEYS[i], ARGV[1], tonumber(ARGV[2]), ARGV[3])
+    if token then
+        table.insert(claimed, i - 4)
+        table.insert(claimed, token)
+    end
+end
+if #claimed < need * 2 then
+    for j = 1, #claimed, 2 do
+        revoke(KEYS[claimed[j] + 4])
+    end
+    return {}
+end
+for j = 1, #claimed, 2 do
+    redis.call("HSET", KEYS[4], KEYS[claimed[j] + 4], now_ms)
+end
+return claimed
+"""
+
+# KEYS[4]: lock key；ARGV: dag_unique_id, fencing token ("" 表示不檢查)
+# 回傳 {狀態, 目前持有者, lease info}：1 已釋放 / 0 沒有 lock / -1 持有者不同 / -2 token 不符 (已被重新分配)
+RELEASE_INSTANCE_LUA = LEASE_LUA_PRELUDE + """
+local value = redis.call("GET", KEYS[4])
+if not value then
+    return {0, "", ""}
+end
+local owner, token = parse(value)
+if owner ~= ARGV[1] then
+    return {-1, owner, ""}
+end
+if ARGV[2] ~= "" and token ~= ARGV[2] then
+    return {-2, owner, ""}
+end
+local info = redis.call("HGET", KEYS[3], KEYS[4]) or ""
+revoke(KEYS[4])
+return {1, owner, info}
+"""
+
+# KEYS[4]: lock key；ARGV: dag_unique_id, fencing token, TTL
+# 回傳 {狀態, 到期時間 ms 或目前持有者}：1 已續約 / 0 lease 已不存在 / -1 持有者或 token 不符
+RENEW_INSTANCE_LUA = LEASE_LUA_PRELUDE + """
+local value = redis.call("GET", KEYS[4])
+if not value then
+    return {0, ""}
+end
+local owner, token = parse(value)
+if owner ~= ARGV[1] or token ~= ARGV[2] then
+    return {-1, owner}
+end
+local ttl = tonumber(ARGV[3])
+local expires_at = now_ms + ttl * 1000
+redis.call("EXPIRE", KEYS[4], ttl)
+redis.call("ZADD", KEYS[2], expires_at, KEYS[4])
+return {1, expires_at}
+"""
+
+# ARGV[1]: 單次最多處理幾筆；回傳已過期 lease 的 {lock key, info, ...}
+# 整段在 Redis 端原子執行，多個 reaper 同時跑也不會重複發出事件
+REAP_LEASES_LUA = LEASE_LUA_PRELUDE + """
+local expired = {}
+local keys = redis.call("ZRANGEBYSCORE", KEYS[2], "-inf", now_ms, "LIMIT", 0, tonumber(ARGV[1]))
+for _, key in ipairs(keys) do
+    local pttl = redis.call("PTTL", key)
+    if pttl > 0 then
+        redis.call("ZADD", KEYS[2], now_ms + pttl, key)
+    else
+        table.insert(expired, key)
+        table.insert(expired, redis.call("HGET", KEYS[3], key) or "")
+        revoke(key)
+    end
+end
+return expired
+"""
+
+# ARGV: lock key, 本次持有秒數, alpha；第一筆樣本直接採用，之後以 EWMA 平滑
+UPDATE_LATENCY_LUA = """
+local previous = redis.call("HGET", KEYS[1], ARGV[1])
+local sample = tonumber(ARGV[2])
+if previous then
+    local alpha = tonumber(ARGV[3])
+    sample = alpha * sample + (1 - alpha) * tonumber(previous)
+end
+redis.call("HSET", KEYS[1], ARGV[1], tostring(sample))
+return tostring(sample)
+"""
+
+claim_instance_script = store.redis_lock.register_script(CLAIM_INSTANCE_LUA)
+claim_instances_batch_script = store.redis_lock.register_script(CLAIM_INSTANCES_BATCH_LUA)
+release_instance_script = store.redis_lock.register_script(RELEASE_INSTANCE_LUA)
+renew_instance_script = store.redis_lock.register_script(RENEW_INSTANCE_LUA)
+reap_leases_script = store.redis_lock.register_script(REAP_LEASES_LUA)
+update_latency_script = store.redis_lock.register_script(UPDATE_LATENCY_LUA)
+
+
+def instance_lock_key(service_instance_id: str) -> str:
+    return f"locked_dag_{service_instance_id}"
+
+
+# Allocation wait queue 的 key：claim script 檢查排隊順序並清除心跳過期的等待者
+ALLOCATION_QUEUE_HEARTBEAT_TTL = float(os.getenv("ALLOCATION_QUEUE_HEARTBEAT_TTL", "5"))  # 超過此秒數沒再嘗試的等待者視為已離開
+
+
+def allocation_queue_key(service_name: str) -> str:
+    return f"allocation_queue:{service_name}"  # zset：waiter id -> score (priority, 排入時間)
+
+
+def allocation_heartbeat_key(service_name: str) -> str:
+    return f"allocation_queue_heartbeat:{service_name}"  # zset：waiter id -> 心跳到期時間 (ms)
+
+
+def resolve_lease_ttl(lease_ttl: Optional[int]) -> int:
+    if lease_ttl is None:
+        return LEASE_TTL_SECONDS
+    if lease_ttl < 1 or lease_ttl > LEASE_MAX_TTL_SECONDS:
+        raise HTTPException(status_code=400, detail=f"lease_ttl must be between 1 and {LEASE_MAX_TTL_SECONDS} seconds.")
+    return lease_ttl
+
+
+def claim_service_instance(service_name: str, service_instances: list, dag_unique_id: str, lease_ttl: int, strategy: str = None, waiter: dict = None):
+    """
+    依策略排序後，一次 round trip 鎖定第一台空閒的 instance，回傳 (instance, fencing token)；鎖不到時回傳 None
+    waiter 為 None (新 request) 時，該 service 已有人排隊就不鎖定；否則只有排在 Redis 佇列最前面的 waiter 能鎖定
+    """
+    candidates = instance_selector.order(service_instances, instance_selector.validate(strategy))
+    if not candidates and waiter is None:
+        return None
+    keys = LEASE_KEYS + [INSTANCE_LAST_ALLOCATED_KEY, allocation_queue_key(service_name), allocation_heartbeat_key(service_name)]
+    keys += [instance_lock_key(instance["ServiceID"]) for instance in candidates]
+    args = [dag_unique_id, lease_ttl, service_name, "", 0, 0]
+    if waiter is not None:
+        args[3:] = [waiter["id"], waiter["score"], int(ALLOCATION_QUEUE_HEARTBEAT_TTL * 1000)]
+    with observe_call("redis", "claim_instance"):
+        index, token = claim_instance_script(keys=keys, args=args, client=store.redis_lock)
+    if index <= 0:
+        if index == 0 and candidates:
+            LOCK_CONTENTION.labels(service_name).inc()
+        return None
+    return candidates[index - 1], token
+
+
+def claim_service_instances_batch(requested: dict, dag_unique_id: str, lease_ttl: int, strategy: str = None):
+    """
+    requested: {service_name: (service_instances, count)}
+    所有 service 的 Lua script 放在同一個 pipeline 送出；任何一個 service 湊不到數量，
+    就把其他 service 已鎖定的 instance 也一併 (pipelined) 釋放，回傳 (leases, 失敗的 service)
+    """
+    strategy = instance_selector.validate(strategy)
+    requested = {
+        service_name: (instance_selector.order(service_instances, strategy), count)
+        for service_name, (service_instances, count) in requested.items()
+    }
+    pipe = store.redis_lock.pipeline(transaction=False)
+    for service_name, (service_instances, count) in requested.items():
+        keys = LEASE_KEYS + [INSTANCE_LAST_ALLOCATED_KEY] + [instance_lock_key(instance["ServiceID"]) for instance in service_instances]
+        claim_instances_batch_script(keys=keys, args=[dag_unique_id, lease_ttl, service_name, count], client=pipe)
+    with observe_call("redis", "claim_instances_batch"):
+        results = pipe.execute()
+
+    leases = []
+    failed = []
+    for (service_name, (service_instances, count)), claimed in zip(requested.items(), results):
+        if len(claimed) < count * 2:
+            LOCK_CONTENTION.labels(service_name).inc()
+            failed.append(service_name)
+            continue
+        for index, token in zip(claimed[0::2], claimed[1::2]):
+            leases.append({"service_name": service_name, "instance": service_instances[index - 1], "fencing_token": token})
+
+    if failed and leases:
+        pipe = store.redis_lock.pipeline(transaction=False)
+        for lease in leases:
+            keys = LEASE_KEYS + [instance_lock_key(lease["instance"]["ServiceID"])]
+            release_instance_script(keys=keys, args=[dag_unique_id, lease["fencing_token"]], client=pipe)
+        with observe_call("redis", "release_instances_batch"):
+            pipe.execute()
+        leases = []
+    return leases, failed
+
+
+def release_service_instance(service_instance_id: str, dag_unique_id: str, fencing_token: Optional[int] = None):
+    """ 只有持有者本人 (且 token 相符) 才能解除鎖定，回傳 (狀態, 目前持有者, lease info) """
+    keys = LEASE_KEYS + [instance_lock_key(service_instance_id)]
+    token = "" if fencing_token is None else str(fencing_token)
+    with observe_call("redis", "release_instance"):
+        status, owner, info = release_instance_script(keys=keys, args=[dag_unique_id, token], client=store.redis_lock)
+    return status, owner, info
+
+
+def renew_service_instance(service_instance_id: str, dag_unique_id: str, fencing_token: int, lease_ttl: int):
+    keys = LEASE_KEYS + [instance_lock_key(service_instance_id)]
+    with observe_call("redis", "renew_instance"):
+        return renew_instance_script(keys=keys, args=[dag_unique_id, fencing_token, lease_ttl], client=store.redis_lock)
+
+
+def lease_response(instance: dict, fencing_token: int, lease_ttl: int):
+    return {
+        "assigned_service_instance_id": instance["ServiceID"],
+        "assigned_service_instance_ip": instance["ServiceAddress"],
+        "assigned_service_instance_port": instance["ServicePort"],
+        "fencing_token": fencing_token,
+        "lease_ttl": lease_ttl,
+    }
+
+
+class LeaseReaper:
+    """
+    背景 thread 定期以 Lua script 找出已過期的 lease：
+    清除 lease_expiry / lease_info 的殘留，並透過 Redis pub/sub (lease_events) 發出 expired 事件；
+    事件同時寫進 Redis stream 與計數 hash，/leases/events 不論打到哪個 replica / worker 都看到同一份
+    """
+
+    def __init__(self):
+        self._stop = threading.Event()
+        self._thread = None
+        self.listeners = []  # callback(event)，lease 被釋放 / 過期時呼叫
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="lease-reaper", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def emit(self, event_type: str, lock_key: str, info: str):
+        owner, token, service_name, granted_ms = (info.rsplit("|", 3) + ["", "", "", ""])[:4] if info else ("", "", "", "")
+        event = {
+            "type": event_type,
+            "service_instance_id": lock_key[len(instance_lock_key("")):],
+            "service_name": service_name,
+            "owner": owner,
+            "fencing_token": int(token) if token.isdigit() else None,
+            "held_seconds": round(time.time() - int(granted_ms) / 1000, 3) if granted_ms.isdigit() else None,
+            "timestamp": datetime.utcnow().isoformat(),
+        }
+        payload = json.dumps(event)
+        try:
+            pipe = store.redis_lock.pipeline(transaction=False)
+            pipe.publish(LEASE_EVENTS_CHANNEL, payload)
+            pipe.xadd(LEASE_EVENTS_STREAM, {"event": payload}, maxlen=LEASE_EVENTS_MAX, approximate=True)
+            store.incr_stats(LEASE_EVENT_COUNTS_KEY, {event_type: 1}, pipe)
+            with observe_call("redis", "publish_lease_event"):
+                pipe.execute()
+        except redis.RedisError as e:
+            logger.error("Failed to publish lease event", extra={"error": str(e)})
+        for listener in self.listeners:
+            listener(event)
+
+    @staticmethod
+    def recent_events(limit: int = LEASE_EVENTS_MAX) -> list:
+        """ 最近的 lease 事件 (由舊到新) """
+        entries = store.redis_lock.xrevrange(LEASE_EVENTS_STREAM, count=limit)
+        return [json.loads(fields["event"]) for _, fields in reversed(entries)]
+
+    @staticmethod
+    def counts() -> dict:
+        return store.load_stats(LEASE_EVENT_COUNTS_KEY, ("expired", "released"))
+
+    def reap(self, limit: int = 100):
+        with observe_call("redis", "reap_leases"):
+            expired = reap_leases_script(keys=LEASE_KEYS, args=[limit], client=store.redis_lock)
+        for lock_key, info in zip(expired[0::2], expired[1::2]):
+            self.emit("expired", lock_key, info)
+        return len(expired) // 2
+
+    def _run(self):
+        while not self._stop.is_set():
+            # reap script 本身是 atomic，只由 leader 輪詢以免 N 個 process 重複掃描；
+            # 其他 replica 的 allocation queue 由定期重試得知 instance 被釋放
+            if coordinator.is_leader():
+                try:
+                    self.reap()
+                except Exception:
+                    logger.exception("Lease reaper error")
+            self._stop.wait(LEASE_REAPER_INTERVAL)
+
+
+lease_reaper = LeaseReaper()
+
+
+def start_lease_reaper():
+    lease_reaper.start()
+
+
+def stop_lease_reaper():
+    lease_reaper.stop()
+
+
+##############################################################
+# Instance 挑選策略：lru / latency 的狀態存在 Redis (所有 replica / worker 共用)，其餘策略只看本地 Consul 快取
+
+ALLOCATION_STRATEGY = os.getenv("ALLOCATION_STRATEGY", "healthy")
+ALLOCATION_LATENCY_EWMA_ALPHA = float(os.getenv("ALLOCATION_LATENCY_EWMA_ALPHA", "0.3"))
+
+INSTANCE_LAST_ALLOCATED_KEY = "instance_last_allocated"  # hash：lock key -> 最後一次被分配的時間 (ms)，由 claim script 寫入
+INSTANCE_LATENCY_KEY = "instance_latency_ewma"           # hash：lock key -> lease 持有時間的 EWMA 秒數
+
+
+class InstanceSelector:
+    """
+    依策略決定候選 instance 的嘗試順序 (Lua script 會鎖定順序中第一台空閒的)：
+    - first：Consul 回傳順序 (舊行為，不過濾健康狀態)
+    - healthy：只保留 health check 全部 passing 的 instance
+    - lru：最久沒被分配的優先，讓工作平均分散
+    - weighted：依 ServiceMeta["weight"] (或 Consul Weights.Passing) 加權隨機
+    - latency：依最近 lease 持有時間的 EWMA，越快完成的越優先
+    除 first 外皆只挑健康的 instance；lru / latency 排序時多一次 HMGET
+    """
+
+    STRATEGIES = ("first", "healthy", "lru", "weighted", "latency")
+
+    def validate(self, strategy: Optional[str]) -> str:
+        strategy = strategy or ALLOCATION_STRATEGY
+        if strategy not in self.STRATEGIES:
+            raise HTTPException(status_code=400, detail=f"Unknown strategy {strategy}, must be one of {', '.join(self.STRATEGIES)}.")
+        return strategy
+
+    def order(self, service_instances: list, strategy: str) -> list:
+        if strategy == "first":
+            return list(service_instances)
+        healthy = [instance for instance in service_instances if instance.get("Healthy", True)]
+        if strategy == "lru":
+            last_allocated = self._load(INSTANCE_LAST_ALLOCATED_KEY, healthy)
+            return sorted(healthy, key=lambda instance: last_allocated.get(instance["ServiceID"], 0))
+        if strategy == "weighted":
+            # Efraimidis-Spirakis：random ** (1 / weight) 由大到小即為加權隨機排列
+            return sorted(healthy, key=lambda instance: random.random() ** (1.0 / self._weight(instance)), reverse=True)
+        if strategy == "latency":
+            latency = self._load(INSTANCE_LATENCY_KEY, healthy)
+            default = sum(latency.values()) / len(latency) if latency else 0.0
+            return sorted(healthy, key=lambda instance: latency.get(instance["ServiceID"], default))
+        return healthy
+
+    @staticmethod
+    def _load(key: str, service_instances: list) -> dict:
+        if not service_instances:
+            return {}
+        ids = [instance["ServiceID"] for instance in service_instances]
+        with observe_call("redis", "instance_selector_state"):
+            values = store.redis_lock.hmget(key, [instance_lock_key(instance_id) for instance_id in ids])
+        return {instance_id: float(value) for instance_id, value in zip(ids, values) if value is not None}
+
+    @staticmethod
+    def _weight(instance: dict) -> float:
+        meta_weight = instance.get("ServiceMeta", {}).get("weight")
+        weight = meta_weight if meta_weight is not None else instance.get("ServiceWeights", {}).get("Passing", 1)
+        try:
+            return max(float(weight), 0.001)
+        except (TypeError, ValueError):
+            return 1.0
+
+    def on_lease_event(self, event: dict):
+        # 只有處理 release 的 process 會收到 released 事件，EWMA 直接寫回 Redis 讓其他 replica 看得到
+        if event["type"] != "released" or event.get("held_seconds") is None:
+            return
+        lock_key = instance_lock_key(event["service_instance_id"])
+        try:
+            update_latency_script(
+                keys=[INSTANCE_LATENCY_KEY], args=[lock_key, event["held_seconds"], ALLOCATION_LATENCY_EWMA_ALPHA], client=store.redis_lock
+            )
+        except redis.RedisError as e:
+            logger.error("Failed to update instance latency", extra={"service_instance_id": event["service_instance_id"], "error": str(e)})
+
+    def snapshot(self):
+        prefix = len(instance_lock_key(""))
+        pipe = store.redis_lock.pipeline(transaction=False)
+        pipe.hgetall(INSTANCE_LAST_ALLOCATED_KEY)
+        pipe.hgetall(INSTANCE_LATENCY_KEY)
+        last_allocated, latency = pipe.execute()
+        return {
+            "default_strategy": ALLOCATION_STRATEGY,
+            "last_allocated": {k[prefix:]: datetime.utcfromtimestamp(int(v) / 1000).isoformat() for k, v in last_allocated.items()},
+            "latency_ewma_seconds": {k[prefix:]: float(v) for k, v in latency.items()},
+        }
+
+
+instance_selector = InstanceSelector()
+lease_reaper.listeners.append(instance_selector.on_lease_event)
+
+
+@router.get("/allocation_strategy/stats")
+def allocation_strategy_stats():
+    return instance_selector.snapshot()
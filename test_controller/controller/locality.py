@@ -0,0 +1,108 @@
+from fastapi import APIRouter, HTTPException
+import os
+from typing import Optional
+import collections
+from .informers import node_informer, pod_informer
+from .images import qualify_image
+
+router = APIRouter()
+
+
+##############################################################
+# Node locality：依 node informer / pod informer 計算每個 node 的 locality (已有 image、剩餘 GPU、已掛載同一個 PVC 的 Pod)
+# 產生 preferredDuringScheduling node affinity，讓 scheduler 優先選擇不需要拉 image、NFS page cache 較熱的 node
+
+LOCALITY_ENABLED = os.getenv("LOCALITY_ENABLED", "true").lower() == "true"
+LOCALITY_MAX_NODES = int(os.getenv("LOCALITY_MAX_NODES", "5"))  # 寫進 manifest 的 node 數上限
+# 各項 locality 的權重 (相加後即 preferredDuringScheduling 的 weight，上限 100)
+LOCALITY_IMAGE_WEIGHT = int(os.getenv("LOCALITY_IMAGE_WEIGHT", "50"))
+LOCALITY_PVC_WEIGHT = int(os.getenv("LOCALITY_PVC_WEIGHT", "30"))
+LOCALITY_GPU_WEIGHT = int(os.getenv("LOCALITY_GPU_WEIGHT", "20"))
+
+
+def pod_gpu_count(pod) -> int:
+    gpus = 0
+    for container in pod.spec.containers or []:
+        limits = (container.resources.limits or {}) if container.resources else {}
+        gpus += int(limits.get("nvidia.com/gpu", 0))
+    return gpus
+
+
+def node_gpu_free(node) -> int:
+    allocatable = (node.status.allocatable or {}) if node.status else {}
+    used = sum(
+        pod_gpu_count(pod) for pod in pod_informer.by_index("node", node.metadata.name)
+        if not (pod.status and pod.status.phase in ("Succeeded", "Failed"))
+    )
+    return int(allocatable.get("nvidia.com/gpu", 0)) - used
+
+
+def node_locality(image: str, pvc_name: str = None, gpu: int = 0) -> list:
+    """ 回傳每個可排程 node 的 locality 與分數 (依分數排序)；pod informer 只涵蓋 ml-serving namespace 的 GPU 使用量 """
+    cached_nodes = set(node_informer.index_keys("image", image))
+    pvc_nodes = collections.Counter(
+        pod.spec.node_name for pod in pod_informer.by_index("pvc", pvc_name) if pod.spec.node_name
+    ) if pvc_name else collections.Counter()
+    result = []
+    for node in node_informer.list():
+        if node.spec and node.spec.unschedulable:
+            continue
+        name = node.metadata.name
+        gpu_free = node_gpu_free(node)
+        score = 0
+        if name in cached_nodes:
+            score += LOCALITY_IMAGE_WEIGHT
+        if pvc_nodes[name]:
+            score += LOCALITY_PVC_WEIGHT
+        if gpu and gpu_free >= gpu:
+            score += LOCALITY_GPU_WEIGHT
+        result.append({
+            "node": name,
+            "image_cached": name in cached_nodes,
+            "gpu_free": gpu_free,
+            "pvc_pods": pvc_nodes[name],
+            "score": min(score, 100),
+        })
+    result.sort(key=lambda item: (-item["score"], -item["gpu_free"], item["node"]))
+    return result
+
+
+def preferred_node_affinity(image: str, pvc_name: str = None, gpu: int = 0) -> Optional[dict]:
+    """
+    以 matchFields metadata.name 產生 preferred node affinity (同分數的 node 合併成一個 term)
+    只是偏好，node 沒有空間時 scheduler 仍可選擇其他 node；node cache 尚未同步時不加 affinity
+    """
+    if not LOCALITY_ENABLED or not node_informer.has_synced():
+        return None
+    candidates = [item for item in node_locality(image, pvc_name, gpu) if item["score"] > 0][:LOCALITY_MAX_NODES]
+    terms = {}
+    for item in candidates:
+        terms.setdefault(item["score"], []).append(item["node"])
+    if not terms:
+        return None
+    return {
+        "nodeAffinity": {
+            "preferredDuringSchedulingIgnoredDuringExecution": [
+                {
+                    "weight": score,
+                    "preference": {"matchFields": [{"key": "metadata.name", "operator": "In", "values": nodes}]}
+                }
+                for score, nodes in sorted(terms.items(), reverse=True)
+            ]
+        }
+    }
+
+
+# 查詢 image / PVC 在各 node 的 locality (與 manifest 中 affinity 使用相同的計算)
+@router.get("/nodes/locality")
+def nodes_locality(image: str, pvc: str = None, gpu: int = 0):
+    if not node_informer.has_synced():
+        raise HTTPException(status_code=503, detail="Node cache is not synced yet.")
+    image = qualify_image(image)
+    return {
+        "image": image,
+        "pvc": pvc,
+        "gpu": gpu,
+        "nodes": node_locality(image, pvc, gpu),
+        "affinity": preferred_node_affinity(image, pvc, gpu),
+    }
@@ -0,0 +1,420 @@
+from fastapi import APIRouter, HTTPException
+import os
+from kubernetes import client
+import uuid
+import time
+import json
+from datetime import datetime
+import requests
+from pydantic import BaseModel
+from typing import Optional
+import hashlib
+from fastapi.concurrency import run_in_threadpool
+from . import kube, store
+from .observability import logger, observe_call
+from .kube import k8s_request, parse_memory_quantity
+from .coordination import coordinator
+from .informers import CONTROLLER_LABELS, job_informer, pod_informer, pvc_informer, ROLE_LABEL
+from .jobs import isoformat_or_none, job_state, JOB_TERMINAL_STATES
+
+router = APIRouter()
+
+
+##############################################################
+# Model cache：以 content-addressed 的共用 PVC 存放 MLflow model artifact
+# 同一個 model version 只下載一次 (由 fetch Job 寫入)，之後以 subPath read-only 掛進每個需要的 serving Pod
+# 依 LRU 淘汰未被任何 Pod 使用的 artifact，總大小維持在 MODEL_CACHE_MAX_BYTES 以下
+
+MODEL_CACHE_PVC = os.getenv("MODEL_CACHE_PVC", "model-cache-pvc")
+MODEL_CACHE_SIZE = os.getenv("MODEL_CACHE_SIZE", "200Gi")
+MODEL_CACHE_MAX_BYTES = int(os.getenv("MODEL_CACHE_MAX_BYTES", str(int(parse_memory_quantity(MODEL_CACHE_SIZE) * 0.9))))
+MODEL_CACHE_MOUNT_PATH = "/mnt/models"
+# fetch Job 的 image，需內含 mlflow (>= 2.0，或 mlflow-skinny) 與 boto3；建議使用 model_fetch/Dockerfile 建立的專用 image
+# 空白表示沿用 serving image 本身，此時 serving image 必須自行安裝上述套件，否則 fetch Job 會失敗
+MODEL_FETCH_IMAGE = os.getenv("MODEL_FETCH_IMAGE", "")
+MODEL_CACHE_UTIL_IMAGE = os.getenv("MODEL_CACHE_UTIL_IMAGE", "busybox:1.36")
+MODEL_FETCH_TIMEOUT = int(os.getenv("MODEL_FETCH_TIMEOUT", "1800"))
+# 最近使用過的 artifact 不淘汰：剛下載完成、Pod 還沒建立前不會被 LRU 刪掉
+MODEL_CACHE_EVICT_GRACE = int(os.getenv("MODEL_CACHE_EVICT_GRACE", "600"))
+MLFLOW_TRACKING_URI = os.getenv("MLFLOW_TRACKING_URI", "")
+# 剛建立的 fetch Job 在這段時間內還沒出現在 informer 不視為已被刪除
+MODEL_FETCH_WATCH_GRACE = 30
+
+MODEL_CACHE_KEY = "model_cache"          # hash：cache key -> entry (json)
+MODEL_CACHE_LRU_KEY = "model_cache_lru"  # zset：cache key -> 最後使用時間
+MODEL_CACHE_EVICT_LOCK = "model_cache_evict_lock"
+MODEL_CACHE_LABEL = "ml-serving/model-cache"
+MODEL_URI_ANNOTATION = "ml-serving/model-uri"
+
+pod_informer.add_index("model_cache", lambda pod: [(pod.metadata.labels or {}).get(MODEL_CACHE_LABEL)] if (pod.metadata.labels or {}).get(MODEL_CACHE_LABEL) else [])
+
+# KEYS[1]: model_cache hash；ARGV: cache key, 新的 fetching entry
+# entry 不存在或上次失敗才寫入並回傳 {1, entry}；否則回傳 {0, 目前的 entry} (已有人在下載 / 已完成 / 淘汰中)
+CLAIM_MODEL_FETCH_LUA = """
+local current = redis.call("HGET", KEYS[1], ARGV[1])
+if current and cjson.decode(current)["state"] ~= "failed" then
+    return {0, current}
+end
+redis.call("HSET", KEYS[1], ARGV[1], ARGV[2])
+return {1, ARGV[2]}
+"""
+claim_model_fetch_script = store.redis_lock.register_script(CLAIM_MODEL_FETCH_LUA)
+
+# 下載到暫存目錄後再 rename，Pod 只會看到完整的 artifact；大小寫進 termination message 供 controller 讀取
+MODEL_FETCH_SCRIPT = """set -e
+tmp="/models/.tmp-$MODEL_CACHE_KEY-$HOSTNAME"
+rm -rf "$tmp"
+python -c 'import os, sys, mlflow; mlflow.artifacts.download_artifacts(artifact_uri=os.environ["MODEL_URI"], dst_path=sys.argv[1])' "$tmp"
+rm -rf "/models/$MODEL_CACHE_KEY"
+mv "$tmp" "/models/$MODEL_CACHE_KEY"
+du -sb "/models/$MODEL_CACHE_KEY" | cut -f1 > /dev/termination-log
+"""
+
+MODEL_ENV = [
+    {"name": "MLFLOW_TRACKING_URI", "valueFrom": {"configMapKeyRef": {"name": "mlflow-config", "key": "MLFLOW_TRACKING_URI"}}},
+    {"name": "MLFLOW_S3_ENDPOINT_URL", "valueFrom": {"configMapKeyRef": {"name": "mlflow-config", "key": "MLFLOW_S3_ENDPOINT_URL"}}},
+    {"name": "AWS_ACCESS_KEY_ID", "valueFrom": {"secretKeyRef": {"name": "mlflow-secret", "key": "AWS_ACCESS_KEY_ID"}}},
+    {"name": "AWS_SECRET_ACCESS_KEY", "valueFrom": {"secretKeyRef": {"name": "mlflow-secret", "key": "AWS_SECRET_ACCESS_KEY"}}},
+]
+
+
+def mlflow_get(path: str, params: dict, operation: str) -> dict:
+    if not MLFLOW_TRACKING_URI:
+        raise HTTPException(status_code=400, detail="MLFLOW_TRACKING_URI is not configured; use models:/<name>/<version> or runs:/ URIs.")
+    try:
+        with observe_call("mlflow", operation):
+            response = requests.get(f"{MLFLOW_TRACKING_URI.rstrip('/')}/api/2.0/mlflow/{path}", params=params, timeout=10)
+    except requests.RequestException as e:
+        raise HTTPException(status_code=502, detail=f"MLflow request failed: {e}")
+    if response.status_code == 404:
+        raise HTTPException(status_code=404, detail=f"MLflow model not found: {params}")
+    if response.status_code != 200:
+        raise HTTPException(status_code=502, detail=f"MLflow returned {response.status_code}: {response.text[:200]}")
+    return response.json()
+
+
+def resolve_model_uri(model_uri: str) -> str:
+    """
+    轉成不會再變動的 URI 作為 cache key：
+    - models:/<name>/<version>、runs:/<run_id>/<path> 及其他 artifact URI 直接使用
+    - models:/<name>/<stage> 與 models:/<name>@<alias> 透過 MLflow REST API 換成目前對應的 version
+    """
+    if not model_uri.startswith("models:/"):
+        return model_uri
+    ref = model_uri[len("models:/"):].strip("/")
+    if "@" in ref:
+        name, alias = ref.split("@", 1)
+        result = mlflow_get("registered-models/alias", {"name": name, "alias": alias}, "get_model_version_by_alias")
+        return f"models:/{name}/{result['model_version']['version']}"
+    if "/" not in ref:
+        raise HTTPException(status_code=400, detail=f"Invalid model URI: {model_uri}")
+    name, version = ref.rsplit("/", 1)
+    if version.isdigit():
+        return f"models:/{name}/{version}"
+    stages = [] if version.lower() == "latest" else [version]
+    result = mlflow_get("registered-models/get-latest-versions", {"name": name, "stages": stages}, "get_latest_versions")
+    versions = [int(item["version"]) for item in result.get("model_versions", [])]
+    if not versions:
+        raise HTTPException(status_code=404, detail=f"No version of {name} in stage {version}.")
+    return f"models:/{name}/{max(versions)}"
+
+
+def model_cache_key(model_uri: str) -> str:
+    return hashlib.sha256(model_uri.encode()).hexdigest()[:16]
+
+
+def apply_model_mount(plan: dict, model: dict):
+    """ 在 serving Pod manifest 中以 read-only subPath 掛上 cache 內的 model，並以 label 標記正在使用 """
+    pod_manifest = plan["pod_manifest"]
+    pod_manifest["metadata"]["labels"][MODEL_CACHE_LABEL] = model["key"]
+    pod_manifest["metadata"]["annotations"][MODEL_URI_ANNOTATION] = model["uri"]
+    container = pod_manifest["spec"]["containers"][0]
+    container["env"].extend([
+        {"name": "MODEL_URI", "value": model["uri"]},
+        {"name": "MODEL_PATH", "value": MODEL_CACHE_MOUNT_PATH},
+    ])
+    container["volumeMounts"].append({"name": "model-cache", "mountPath": MODEL_CACHE_MOUNT_PATH, "subPath": model["key"], "readOnly": True})
+    pod_manifest["spec"]["volumes"].append({"name": "model-cache", "persistentVolumeClaim": {"claimName": MODEL_CACHE_PVC, "readOnly": True}})
+    plan["model"] = model
+
+
+def model_job_manifest(job_name: str, key: str, role: str, container: dict, labels: dict = None) -> dict:
+    job_labels = {**CONTROLLER_LABELS, ROLE_LABEL: role, MODEL_CACHE_LABEL: key, **(labels or {})}
+    return {
+        "apiVersion": "batch/v1",
+        "kind": "Job",
+        "metadata": {"name": job_name, "namespace": "ml-serving", "labels": job_labels},
+        "spec": {
+            "ttlSecondsAfterFinished": 600,
+            "backoffLimit": 2,
+            "activeDeadlineSeconds": MODEL_FETCH_TIMEOUT,
+            "template": {
+                "metadata": {"labels": dict(job_labels)},
+                "spec": {
+                    "restartPolicy": "Never",
+                    "containers": [{**container, "volumeMounts": [{"name": "model-cache", "mountPath": "/models"}]}],
+                    "volumes": [{"name": "model-cache", "persistentVolumeClaim": {"claimName": MODEL_CACHE_PVC}}],
+                    "imagePullSecrets": [{"name": "harbor-secret"}],
+                },
+            },
+        },
+    }
+
+
+def fetch_job_size(job_name: str) -> int:
+    """ fetch Pod 結束時寫在 termination message 的 artifact 大小 (bytes) """
+    for pod in pod_informer.by_index("job", job_name):
+        for status in (pod.status.container_statuses or []) if pod.status else []:
+            terminated = status.state.terminated if status.state else None
+            if terminated and terminated.exit_code == 0 and (terminated.message or "").strip().isdigit():
+                return int(terminated.message.strip())
+    return 0
+
+
+def fetch_job_finished(entry: dict):
+    """
+    等待 fetch Job 的 predicate：Job 結束，或 Job 已被刪除 (TTL / 手動) 時都要醒來，結果由 _fetch_result 從 Redis 判斷
+    剛建立、informer 還沒看到的 Job 不算被刪除
+    """
+    seen = [entry["created_at"] < time.time() - MODEL_FETCH_WATCH_GRACE]
+
+    def predicate(job):
+        if job is None:
+            return seen[0]
+        seen[0] = True
+        return job_state(job) in JOB_TERMINAL_STATES
+    return predicate
+
+
+class ModelCache:
+    """
+    1. build_serving_pod_plan(model_uri=...) 解析出固定的 model version 並掛上 cache 的 subPath
+    2. provisioning 的第一個階段 ensure：cache 中沒有時由 Lua script 搶到下載權的 replica 建立 fetch Job，其餘等待同一個 Job
+    3. fetch Job 完成後記錄大小，超過 MODEL_CACHE_MAX_BYTES 時以 eviction Job 刪除最久未使用、且沒有 Pod 在使用的 artifact
+    """
+
+    def __init__(self):
+        self._pvc_ready = False
+
+    def get(self, key: str) -> Optional[dict]:
+        value = store.redis_lock.hget(MODEL_CACHE_KEY, key)
+        return json.loads(value) if value else None
+
+    def _set(self, key: str, entry: dict):
+        store.redis_lock.hset(MODEL_CACHE_KEY, key, json.dumps(entry))
+
+    def resolve(self, model_uri: str) -> dict:
+        uri = resolve_model_uri(model_uri)
+        return {"key": model_cache_key(uri), "uri": uri, "requested_uri": model_uri}
+
+    def _ensure_pvc(self):
+        if self._pvc_ready or pvc_informer.get(MODEL_CACHE_PVC) is not None:
+            self._pvc_ready = True
+            return
+        manifest = {
+            "apiVersion": "v1",
+            "kind": "PersistentVolumeClaim",
+            "metadata": {"name": MODEL_CACHE_PVC, "namespace": "ml-serving", "labels": {**CONTROLLER_LABELS, ROLE_LABEL: "model-cache"}},
+            "spec": {
+                "accessModes": ["ReadWriteMany"],
+                "storageClassName": "nfs-storage",
+                "resources": {"requests": {"storage": MODEL_CACHE_SIZE}},
+            },
+        }
+        try:
+            k8s_request(kube.v1.create_namespaced_persistent_volume_claim, namespace="ml-serving", body=manifest)
+        except client.exceptions.ApiException as e:
+            if e.status != 409:
+                raise
+        self._pvc_ready = True
+
+    def claim(self, model: dict, image: str) -> dict:
+        """ 回傳目前的 entry；需要下載時建立 fetch Job (同一個 key 同時只會有一個 fetch Job) """
+        key = model["key"]
+        store.redis_lock.zadd(MODEL_CACHE_LRU_KEY, {key: time.time()})
+        entry = self.get(key)
+        if entry is not None and entry["state"] in ("ready", "fetching"):
+            return entry
+        if entry is not None and entry["state"] == "evicting":
+            # 等 eviction Job 刪完舊目錄再重新下載，避免 rm -rf 與新的 mv 交錯
+            job_informer.wait_for(entry["job"], lambda job: job is None or job_state(job) in JOB_TERMINAL_STATES, MODEL_FETCH_TIMEOUT)
+            self._finish_evict(key, entry["job"])
+
+        self._ensure_pvc()
+        job_name = f"model-fetch-{key}-{uuid.uuid4().hex[:5]}"
+        new_entry = {"state": "fetching", "uri": model["uri"], "job": job_name, "size": 0, "created_at": time.time()}
+        with observe_call("redis", "claim_model_fetch"):
+            claimed, value = claim_model_fetch_script(keys=[MODEL_CACHE_KEY], args=[key, json.dumps(new_entry)], client=store.redis_lock)
+        if not int(claimed):
+            return json.loads(value)
+
+        container = {
+            "name": "fetch",
+            "image": MODEL_FETCH_IMAGE or image,
+            "command": ["/bin/sh", "-c", MODEL_FETCH_SCRIPT],
+            "env": [{"name": "MODEL_URI", "value": model["uri"]}, {"name": "MODEL_CACHE_KEY", "value": key}, *MODEL_ENV],
+        }
+        try:
+            k8s_request(kube.batch_v1.create_namespaced_job, namespace="ml-serving", body=model_job_manifest(job_name, key, "model-fetch", container))
+        except Exception as e:
+            self._set(key, {**new_entry, "state": "failed", "error": str(e)})
+            raise
+        logger.info("Fetching model into cache", extra={"key": key, "model_uri": model["uri"], "job_name": job_name})
+        return new_entry
+
+    def on_job_event(self, event_type: str, job):
+        # 由 job informer 的 watch thread 呼叫；每個 replica 都會收到同一個事件，只由 leader 收尾與觸發 LRU 淘汰
+        # (等待中的 ensure() 會自行在 _fetch_result 收尾)
+        labels = job.metadata.labels or {}
+        key = labels.get(MODEL_CACHE_LABEL)
+        if key is None or event_type == "DELETED" or job_state(job) not in JOB_TERMINAL_STATES:
+            return
+        if not coordinator.is_leader():
+            return
+        if labels.get(ROLE_LABEL) == "model-fetch":
+            self._finish_fetch(key, job)
+        elif labels.get(ROLE_LABEL) == "model-evict":
+            self._finish_evict(key, job.metadata.name)
+
+    def _finish_fetch(self, key: str, job) -> dict:
+        entry = self.get(key)
+        if entry is None or entry["state"] != "fetching" or entry["job"] != job.metadata.name:
+            return entry
+        if job_state(job) == "succeeded":
+            entry.update(state="ready", size=fetch_job_size(job.metadata.name), ready_at=time.time())
+        else:
+            entry.update(state="failed", error=f"Fetch job {job.metadata.name} failed.")
+        self._set(key, entry)
+        logger.info("Model fetch finished", extra={"key": key, "state": entry["state"], "size": entry["size"]})
+        if entry["state"] == "ready":
+            self.evict()
+        return entry
+
+    def _finish_evict(self, key: str, job_name: str):
+        entry = self.get(key)
+        if entry is not None and entry["state"] == "evicting" and entry["job"] == job_name:
+            pipe = store.redis_lock.pipeline()
+            pipe.hdel(MODEL_CACHE_KEY, key)
+            pipe.zrem(MODEL_CACHE_LRU_KEY, key)
+            pipe.execute()
+
+    def _fetch_result(self, key: str, entry: dict, job) -> dict:
+        if job is not None:
+            entry = self._finish_fetch(key, job) or entry
+        elif job_informer.has_synced() and job_informer.get(entry["job"]) is None and self.get(key) == entry:
+            # fetch Job 已不存在 (被手動刪除) 卻沒有留下結果
+            entry = {**entry, "state": "failed", "error": f"Fetch job {entry['job']} disappeared."}
+            self._set(key, entry)
+        entry = self.get(key) or entry
+        if entry["state"] == "ready":
+            return entry
+        if entry["state"] == "fetching":
+            raise HTTPException(status_code=504, detail=f"Timed out waiting for model {entry['uri']} to be fetched.")
+        raise HTTPException(status_code=502, detail=entry.get("error") or f"Model {entry['uri']} is not available.")
+
+    def ensure_sync(self, model: dict, image: str) -> dict:
+        entry = self.claim(model, image)
+        if entry["state"] == "ready":
+            return entry
+        job = job_informer.wait_for(entry["job"], fetch_job_finished(entry), MODEL_FETCH_TIMEOUT)
+        return self._fetch_result(model["key"], entry, job)
+
+    async def ensure(self, model: dict, image: str) -> dict:
+        entry = await run_in_threadpool(self.claim, model, image)
+        if entry["state"] == "ready":
+            return entry
+        job = await job_informer.async_wait_for(entry["job"], fetch_job_finished(entry), MODEL_FETCH_TIMEOUT)
+        return await run_in_threadpool(self._fetch_result, model["key"], entry, job)
+
+    def in_use(self, key: str) -> list:
+        return sorted(pod.metadata.name for pod in pod_informer.by_index("model_cache", key))
+
+    def evict(self, force_key: str = None) -> list:
+        """ 依 LRU 淘汰直到總大小不超過上限；force_key 表示手動淘汰指定的 artifact """
+        if not store.redis_lock.set(MODEL_CACHE_EVICT_LOCK, "1", nx=True, ex=60):
+            return []
+        try:
+            entries = {key: json.loads(value) for key, value in store.redis_lock.hgetall(MODEL_CACHE_KEY).items()}
+            total = sum(entry["size"] for entry in entries.values() if entry["state"] in ("ready", "evicting"))
+            if force_key is not None:
+                candidates = [force_key]
+            elif total > MODEL_CACHE_MAX_BYTES:
+                candidates = store.redis_lock.zrangebyscore(MODEL_CACHE_LRU_KEY, "-inf", time.time() - MODEL_CACHE_EVICT_GRACE)
+            else:
+                return []
+            evicted = []
+            for key in candidates:
+                if force_key is None and total <= MODEL_CACHE_MAX_BYTES:
+                    break
+                entry = entries.get(key)
+                if entry is None or entry["state"] != "ready" or self.in_use(key):
+                    continue
+                job_name = f"model-evict-{key}-{uuid.uuid4().hex[:5]}"
+                container = {
+                    "name": "evict",
+                    "image": MODEL_CACHE_UTIL_IMAGE,
+                    "command": ["/bin/sh", "-c", f'rm -rf "/models/{key}" /models/.tmp-{key}-*'],
+                }
+                self._set(key, {**entry, "state": "evicting", "job": job_name})
+                k8s_request(kube.batch_v1.create_namespaced_job, namespace="ml-serving", body=model_job_manifest(job_name, key, "model-evict", container))
+                total -= entry["size"]
+                evicted.append(key)
+                logger.info("Evicting model from cache", extra={"key": key, "model_uri": entry["uri"], "size": entry["size"]})
+            return evicted
+        finally:
+            store.redis_lock.delete(MODEL_CACHE_EVICT_LOCK)
+
+    def snapshot(self) -> dict:
+        entries = {key: json.loads(value) for key, value in store.redis_lock.hgetall(MODEL_CACHE_KEY).items()}
+        last_used = dict(store.redis_lock.zrange(MODEL_CACHE_LRU_KEY, 0, -1, withscores=True))
+        items = [
+            {"key": key, **entry, "last_used": isoformat_or_none(datetime.utcfromtimestamp(last_used[key]) if key in last_used else None), "pods": self.in_use(key)}
+            for key, entry in entries.items()
+        ]
+        items.sort(key=lambda item: last_used.get(item["key"], 0), reverse=True)
+        return {
+            "pvc": MODEL_CACHE_PVC,
+            "max_bytes": MODEL_CACHE_MAX_BYTES,
+            "used_bytes": sum(item["size"] for item in items if item["state"] in ("ready", "evicting")),
+            "entries": items,
+        }
+
+
+model_cache = ModelCache()
+job_informer.add_handler(model_cache.on_job_event)
+
+
+class ModelPrefetchRequest(BaseModel):
+    model_uri: str
+    image_name: str  # 未設定 MODEL_FETCH_IMAGE 時用來執行 fetch Job 的 image (需內含 mlflow 與 boto3)
+    image_tag: str = "latest"
+
+
+@router.get("/model_cache")
+def get_model_cache():
+    return model_cache.snapshot()
+
+
+# 預先把 model 放進 cache (不等待下載完成)
+@router.post("/model_cache", status_code=202)
+async def prefetch_model(request: ModelPrefetchRequest):
+    model = await run_in_threadpool(model_cache.resolve, request.model_uri)
+    entry = await run_in_threadpool(model_cache.claim, model, f"harbor.pdc.tw/{request.image_name}:{request.image_tag}")
+    return {**model, **entry}
+
+
+# 手動淘汰沒有 Pod 在使用的 artifact
+@router.delete("/model_cache/{key}")
+async def evict_model(key: str):
+    entry = await run_in_threadpool(model_cache.get, key)
+    if entry is None:
+        raise HTTPException(status_code=404, detail=f"Model cache entry {key} not found.")
+    pods = model_cache.in_use(key)
+    if pods:
+        raise HTTPException(status_code=409, detail=f"Model cache entry {key} is used by {pods}.")
+    if entry["state"] != "ready":
+        raise HTTPException(status_code=409, detail=f"Model cache entry {key} is {entry['state']}.")
+    evicted = await run_in_threadpool(model_cache.evict, key)
+    if not evicted:
+        raise HTTPException(status_code=409, detail="Another eviction is in progress, retry later.")
+    return {"key": key, "status": "evicting"}
@@ -0,0 +1,137 @@
+from fastapi import APIRouter
+import os
+import time
+import json
+from datetime import datetime
+import logging
+import contextlib
+from fastapi import Response
+from prometheus_client import Counter, Gauge, Histogram, CONTENT_TYPE_LATEST, CollectorRegistry, generate_latest, multiprocess
+
+router = APIRouter()
+
+
+##############################################################
+# Observability：Prometheus metrics (/metrics) + 結構化 log (LOG_LEVEL 控制，hot path 不再無條件 print)
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")  # json | text
+
+_LOG_RECORD_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+
+class JsonLogFormatter(logging.Formatter):
+    """ 一行一筆 JSON，logger.info(..., extra={...}) 的欄位會原樣輸出 """
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.utcfromtimestamp(record.created).isoformat(timespec="milliseconds") + "Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        entry.update({k: v for k, v in vars(record).items() if k not in _LOG_RECORD_FIELDS})
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+def init_logging():
+    handler = logging.StreamHandler()
+    if LOG_FORMAT == "json":
+        handler.setFormatter(JsonLogFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s %(message)s"))
+    logger.handlers = [handler]
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+
+
+logger = logging.getLogger("ml-serving-controller")
+init_logging()
+
+# 每個 provisioning 階段的耗時 (60 秒的 worst case 花在哪裡)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 45, 60, 90, 120)
+
+PROVISION_PHASE_SECONDS = Histogram(
+    "ml_serving_provision_phase_seconds", "Duration of each serving pod provisioning phase",
+    ["phase"], buckets=LATENCY_BUCKETS)
+PROVISION_SECONDS = Histogram(
+    "ml_serving_provision_seconds", "End-to-end serving pod provisioning duration",
+    ["source", "result"], buckets=LATENCY_BUCKETS)
+DEPENDENCY_REQUEST_SECONDS = Histogram(
+    "ml_serving_dependency_request_seconds", "Latency of Kubernetes / Redis / Consul calls",
+    ["system", "operation"], buckets=LATENCY_BUCKETS)
+DEPENDENCY_ERRORS = Counter(
+    "ml_serving_dependency_errors_total", "Failed Kubernetes / Redis / Consul calls",
+    ["system", "operation", "error"])
+INFORMER_EVENTS = Counter(
+    "ml_serving_informer_events_total", "Watch events applied to the informer caches", ["kind", "type"])
+INFORMER_SYNCED = Gauge(
+    "ml_serving_informer_synced", "1 when the informer cache has completed its initial LIST", ["kind"])
+ALLOCATION_REQUESTS = Counter(
+    "ml_serving_allocation_requests_total", "Allocation requests by outcome", ["service", "result"])
+ALLOCATION_WAIT_SECONDS = Histogram(
+    "ml_serving_allocation_wait_seconds", "Time allocation requests spent queued for a free instance",
+    ["service", "result"], buckets=LATENCY_BUCKETS)
+# 佇列存在 Redis，每個 worker 設定的都是同一個 zcard，取最近一次的值
+ALLOCATION_QUEUE_DEPTH = Gauge(
+    "ml_serving_allocation_queue_depth", "Allocation requests waiting for a free instance", ["service"],
+    multiprocess_mode="livemostrecent")
+LOCK_CONTENTION = Counter(
+    "ml_serving_lock_contention_total", "Claim attempts that found every candidate instance locked", ["service"])
+PROVISION_ROLLBACKS = Counter(
+    "ml_serving_provision_rollbacks_total", "Failed provisionings rolled back, by rollback outcome", ["result"])
+WARM_POOL_REQUESTS = Counter(
+    "ml_serving_warm_pool_requests_total", "Warm pool lookups by result (hit / miss / unconfigured)", ["result"])
+ORPHANS_COLLECTED = Counter(
+    "ml_serving_orphans_collected_total", "Orphaned objects deleted by the GC sweep", ["kind"])
+RECONCILE_ACTIONS = Counter(
+    "ml_serving_reconcile_actions_total", "API calls issued by the serving instance reconciler", ["action"])
+RECONCILE_ERRORS = Counter(
+    "ml_serving_reconcile_errors_total", "Serving instance reconcile attempts that failed", ["error"])
+CONTROLLER_LEADER = Gauge(
+    "ml_serving_controller_leader", "1 when this controller process holds the leader lease", multiprocess_mode="liveall")
+
+
+def error_label(e: Exception) -> str:
+    status = getattr(e, "status", None)
+    return str(status) if status else type(e).__name__
+
+
+@contextlib.contextmanager
+def observe_call(system: str, operation: str):
+    """ 記錄一次外部呼叫的耗時，失敗時依 HTTP status / 例外類型計數 """
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        DEPENDENCY_ERRORS.labels(system, operation, error_label(e)).inc()
+        raise
+    finally:
+        DEPENDENCY_REQUEST_SECONDS.labels(system, operation).observe(time.perf_counter() - start)
+
+
+@contextlib.contextmanager
+def observe_phase(phase: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        PROVISION_PHASE_SECONDS.labels(phase).observe(time.perf_counter() - start)
+
+
+@router.get("/metrics")
+def metrics():
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        # 多個 uvicorn worker：合併每個 worker process 寫在共用目錄的 metrics
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+def mark_metrics_process_dead():
+    # worker 結束 (重啟 / 縮減) 後不再把它的 live gauge 算進 /metrics；目錄本身在 container 啟動時清空
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        multiprocess.mark_process_dead(os.getpid())
@@ -0,0 +1,208 @@
+from fastapi import APIRouter, Header, HTTPException
+import os
+import uuid
+import json
+from datetime import datetime
+from typing import Optional
+import asyncio
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from . import store
+from .observability import observe_call
+from .idempotency import idempotency, resolve_idempotency_key
+from .provisioning import build_serving_pod_plan, PodCreateRequest, provision_serving_pod
+from .warm_pool import warm_pool
+
+router = APIRouter()
+
+
+##############################################################
+# 非阻塞 Provisioning：立即回傳 operation ID，由背景 pipeline 執行，並可查詢 / 訂閱進度
+
+OPERATION_TTL_SECONDS = int(os.getenv("OPERATION_TTL_SECONDS", "3600"))
+OPERATION_TERMINAL_STATES = ("succeeded", "failed")
+OPERATION_EVENTS_POLL_INTERVAL = float(os.getenv("OPERATION_EVENTS_POLL_INTERVAL", "0.5"))
+
+
+class OperationStore:
+    """
+    記錄背景 provisioning 的狀態與事件，存在 Redis (TTL 為 OPERATION_TTL_SECONDS)，任何 replica 都能查詢 / 訂閱：
+    - GET /operations/{id} 查詢目前狀態
+    - GET /operations/{id}/events 以 SSE 重播既有事件並持續推送新事件
+      (operation 在同一個 process 執行時立即推送，否則每 OPERATION_EVENTS_POLL_INTERVAL 秒從 Redis 讀取新事件)
+    (所有方法皆在 event loop 內呼叫，Redis I/O 在 threadpool 執行)
+    """
+
+    def __init__(self):
+        self._running = {}  # 在這個 process 執行中的 operation_id -> operation
+        self._subscribers = {}  # operation_id -> [asyncio.Queue]
+        self._tasks = set()
+
+    @staticmethod
+    def key(operation_id: str) -> str:
+        return f"operation:{operation_id}"
+
+    @staticmethod
+    def events_key(operation_id: str) -> str:
+        return f"operation:{operation_id}:events"
+
+    async def create(self, op_type: str, request: dict, **fields) -> dict:
+        now = datetime.utcnow().isoformat()
+        operation = {
+            "operation_id": uuid.uuid4().hex,
+            "type": op_type,
+            "status": "pending",
+            "phase": "accepted",
+            "request": request,
+            "result": None,
+            "error": None,
+            "created_at": now,
+            "updated_at": now,
+            **fields,
+        }
+        await run_in_threadpool(self._save, operation)
+        return operation
+
+    def _save(self, operation: dict, event: dict = None):
+        operation_id = operation["operation_id"]
+        pipe = store.redis_lock.pipeline(transaction=False)
+        pipe.set(self.key(operation_id), json.dumps(operation), ex=OPERATION_TTL_SECONDS)
+        if event is not None:
+            pipe.rpush(self.events_key(operation_id), json.dumps(event))
+            pipe.expire(self.events_key(operation_id), OPERATION_TTL_SECONDS)
+        with observe_call("redis", "save_operation"):
+            pipe.execute()
+
+    async def get(self, operation_id: str):
+        value = await run_in_threadpool(store.redis_lock.get, self.key(operation_id))
+        return json.loads(value) if value else None
+
+    def run(self, operation: dict, coro_factory):
+        """ 以 asyncio task 在背景執行 pipeline，coro_factory(report) 回傳 coroutine """
+        self._running[operation["operation_id"]] = operation
+        task = asyncio.create_task(self._execute(operation, coro_factory))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _execute(self, operation: dict, coro_factory):
+        operation_id = operation["operation_id"]
+
+        async def report(phase: str, detail: dict):
+            await self.publish(operation_id, phase, detail)
+
+        operation["status"] = "running"
+        try:
+            result = await coro_factory(report)
+        except HTTPException as e:
+            operation["error"] = e.detail
+            operation["status"] = "failed"
+            await self.publish(operation_id, "failed", {"error": e.detail})
+        except Exception as e:
+            operation["error"] = str(e)
+            operation["status"] = "failed"
+            await self.publish(operation_id, "failed", {"error": str(e)})
+        else:
+            operation["result"] = result
+            operation["status"] = "succeeded"
+            await self.publish(operation_id, "succeeded", result)
+        finally:
+            self._running.pop(operation_id, None)
+
+    async def publish(self, operation_id: str, phase: str, detail: dict):
+        operation = self._running.get(operation_id)
+        if operation is None:
+            return
+        event = {"phase": phase, "detail": detail, "timestamp": datetime.utcnow().isoformat()}
+        operation["phase"] = phase
+        operation["updated_at"] = event["timestamp"]
+        await run_in_threadpool(self._save, operation, event)
+        for queue in self._subscribers.get(operation_id, []):
+            queue.put_nowait(event)
+
+    async def subscribe(self, operation_id: str):
+        """ 先重播已發生的事件，再持續推送直到 operation 結束 (或過期) """
+        queue = asyncio.Queue()  # 只用來喚醒，事件內容一律以 Redis 為準
+        self._subscribers.setdefault(operation_id, []).append(queue)
+        sent = 0
+        try:
+            while True:
+                events = await run_in_threadpool(store.redis_lock.lrange, self.events_key(operation_id), sent, -1)
+                for value in events:
+                    event = json.loads(value)
+                    sent += 1
+                    yield event
+                    if event["phase"] in OPERATION_TERMINAL_STATES:
+                        return
+                if not events and await self.get(operation_id) is None:
+                    return
+                try:
+                    await asyncio.wait_for(queue.get(), timeout=OPERATION_EVENTS_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            subscribers = self._subscribers.get(operation_id, [])
+            if queue in subscribers:
+                subscribers.remove(queue)
+            if not subscribers:
+                self._subscribers.pop(operation_id, None)
+
+
+operations = OperationStore()
+
+
+# 非阻塞創建 Pod：立即回傳 operation ID
+@router.post("/operations/create_pod", status_code=202)
+async def create_pod_operation(request: PodCreateRequest, idempotency_key: Optional[str] = Header(None)):
+    # 重送時回傳同一個 operation (而不是再啟動一次 provisioning)
+    return await idempotency.run("create_pod_operation", resolve_idempotency_key(idempotency_key, request), request,
+                                 lambda: start_create_pod_operation(request), status_code=202)
+
+
+async def start_create_pod_operation(request: PodCreateRequest):
+    plan = await run_in_threadpool(
+        build_serving_pod_plan, request.image_name, request.image_tag, request.export_port, request.dag_id, model_uri=request.model_uri
+    )
+    # 實際的 Pod 要等背景 pipeline 決定 (warm pool 命中時是 warm pool 的 Pod)，由 /operations/{id} 的 pod_name 回報
+    operation = await operations.create("create_pod", request.model_dump(), pod_name=None)
+
+    async def pipeline(report):
+        warm = None
+        if not request.model_uri:
+            warm = await run_in_threadpool(warm_pool.acquire, request.image_name, request.image_tag, request.export_port, request.dag_id)
+        if warm is not None:
+            operation["pod_name"] = warm["pod_name"]
+            await report("warm_pool_hit", {"pod_name": warm["pod_name"]})
+            return warm
+        operation["pod_name"] = plan["pod_name"]
+        return await provision_serving_pod(plan, report)
+
+    operations.run(operation, pipeline)
+
+    operation_id = operation["operation_id"]
+    return {
+        "operation_id": operation_id,
+        "status": operation["status"],
+        "status_url": f"/operations/{operation_id}",
+        "events_url": f"/operations/{operation_id}/events"
+    }
+
+
+@router.get("/operations/{operation_id}")
+async def get_operation(operation_id: str):
+    operation = await operations.get(operation_id)
+    if operation is None:
+        raise HTTPException(status_code=404, detail=f"Operation {operation_id} not found.")
+    return operation
+
+
+# SSE 進度串流
+@router.get("/operations/{operation_id}/events")
+async def stream_operation_events(operation_id: str):
+    if await operations.get(operation_id) is None:
+        raise HTTPException(status_code=404, detail=f"Operation {operation_id} not found.")
+
+    async def event_stream():
+        async for event in operations.subscribe(operation_id):
+            yield f"event: {event['phase']}\ndata: {json.dumps(event)}\n\n"
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
@@ -0,0 +1,144 @@
+from fastapi import APIRouter
+import os
+from kubernetes import client
+from datetime import datetime
+from typing import Optional
+import threading
+from fastapi.concurrency import run_in_threadpool
+from . import kube
+from .observability import logger, ORPHANS_COLLECTED
+from .kube import k8s_request
+from .coordination import coordinator
+from .informers import pod_informer, POD_READY_TIMEOUT, PROVISIONING_LABEL, pvc_informer, ROLE_LABEL, service_informer
+from .serving_instances import SERVING_INSTANCE_LABEL
+
+router = APIRouter()
+
+
+##############################################################
+# Orphan GC：定期找出沒有對應 Pod 的 mlpod-* PVC / Service，以及 provisioning 中途中斷 (rollback 也失敗) 的 Pod
+# 新建立的 PVC / Service 都有 Pod ownerReference，由 Kubernetes GC 處理；這裡主要清掉舊版本留下、沒有 owner 的物件
+
+ORPHAN_GC_INTERVAL = int(os.getenv("ORPHAN_GC_INTERVAL", "600"))
+# 建立後超過這段時間才視為 orphan，避免刪到 provisioning 進行中的物件
+ORPHAN_GC_GRACE = int(os.getenv("ORPHAN_GC_GRACE", str(POD_READY_TIMEOUT + 600)))
+
+
+def object_age_seconds(obj) -> float:
+    created = obj.metadata.creation_timestamp
+    if created is None:
+        return 0
+    if created.tzinfo is not None:
+        created = created.replace(tzinfo=None) - created.utcoffset()
+    return (datetime.utcnow() - created).total_seconds()
+
+
+def serving_pod_name_of(name: str, suffix: str) -> Optional[str]:
+    if name.startswith("mlpod-") and name.endswith(suffix):
+        return name[:-len(suffix)]
+    return None
+
+
+class OrphanCollector:
+
+    def __init__(self):
+        self._stop = threading.Event()
+        self._thread = None
+        self.last_sweep = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="orphan-gc", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._stop.wait(ORPHAN_GC_INTERVAL)
+            if self._stop.is_set():
+                break
+            try:
+                # 多個 replica 時只有 leader 掃描
+                if coordinator.is_leader():
+                    self.sweep()
+            except Exception:
+                logger.exception("Orphan GC error")
+
+    def find_orphans(self) -> list:
+        """ 回傳 [(kind, name, reason)] """
+        orphans = []
+        for kind, informer, suffix in (("pvc", pvc_informer, "-pvc"), ("service", service_informer, "-svc")):
+            for obj in informer.list():
+                pod_name = serving_pod_name_of(obj.metadata.name, suffix)
+                if pod_name is None or obj.metadata.deletion_timestamp or obj.metadata.owner_references:
+                    continue
+                if (obj.metadata.labels or {}).get(SERVING_INSTANCE_LABEL):
+                    continue  # ServingInstance 的 PVC / Service 由 reconciler 管理
+                if pod_informer.get(pod_name) is None and object_age_seconds(obj) > ORPHAN_GC_GRACE:
+                    orphans.append((kind, obj.metadata.name, "pod_missing"))
+        # provisioning 中斷：有 provisioning-id 的 serving Pod 過了 grace 還沒有 Service
+        for pod in pod_informer.list():
+            labels = pod.metadata.labels or {}
+            if labels.get(PROVISIONING_LABEL) is None or labels.get(ROLE_LABEL) != "serving" or pod.metadata.deletion_timestamp:
+                continue
+            if labels.get(SERVING_INSTANCE_LABEL):
+                continue
+            if service_informer.get(f"{pod.metadata.name}-svc") is None and object_age_seconds(pod) > ORPHAN_GC_GRACE:
+                orphans.append(("pod", pod.metadata.name, "provisioning_incomplete"))
+        return orphans
+
+    def sweep(self, dry_run: bool = False) -> dict:
+        if not all(informer.has_synced() for informer in (pod_informer, pvc_informer, service_informer)):
+            return {"skipped": "informers not synced"}
+        delete_funcs = {
+            "pvc": kube.v1.delete_namespaced_persistent_volume_claim,
+            "service": kube.v1.delete_namespaced_service,
+            "pod": kube.v1.delete_namespaced_pod,
+        }
+        results = []
+        for kind, name, reason in self.find_orphans():
+            result = {"kind": kind, "name": name, "reason": reason, "status": "found" if dry_run else "deleted"}
+            if not dry_run:
+                try:
+                    k8s_request(delete_funcs[kind], name=name, namespace="ml-serving", propagation_policy="Background")
+                    ORPHANS_COLLECTED.labels(kind).inc()
+                except client.exceptions.ApiException as e:
+                    result["status"] = "not_found" if e.status == 404 else f"failed: {e.reason}"
+            results.append(result)
+        if results and not dry_run:
+            logger.info("Orphan GC sweep", extra={"deleted": sum(1 for r in results if r["status"] == "deleted"), "orphans": results})
+        sweep = {"swept_at": datetime.utcnow().isoformat(), "dry_run": dry_run, "orphans": results}
+        if not dry_run:
+            self.last_sweep = sweep
+        return sweep
+
+
+orphan_collector = OrphanCollector()
+
+
+def start_orphan_collector():
+    orphan_collector.start()
+
+
+def stop_orphan_collector():
+    orphan_collector.stop()
+
+
+@router.get("/gc/orphans")
+def get_orphans():
+    return {
+        "interval": ORPHAN_GC_INTERVAL,
+        "grace": ORPHAN_GC_GRACE,
+        "pending": [{"kind": kind, "name": name, "reason": reason} for kind, name, reason in orphan_collector.find_orphans()],
+        "last_sweep": orphan_collector.last_sweep,
+    }
+
+
+# 立即執行一次 sweep (dry_run=true 只列出不刪除)
+@router.post("/gc/orphans")
+async def sweep_orphans(dry_run: bool = False):
+    return await run_in_threadpool(orphan_collector.sweep, dry_run)
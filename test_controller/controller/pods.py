@@ -0,0 +1,301 @@
+from fastapi import APIRouter, Header, HTTPException, Query
+import os
+from kubernetes import client
+import json
+from pydantic import BaseModel
+from typing import List, Optional
+import asyncio
+import base64
+from fastapi.concurrency import run_in_threadpool
+from . import kube
+from .kube import k8s_call
+from .informers import DAG_LABEL, pod_image_ref, pod_informer, pvc_informer, sanitize_label_value, service_informer
+from .idempotency import idempotency, resolve_idempotency_key
+from .provisioning import build_serving_pod_plan, PodCreateRequest, provision_serving_pod, provision_serving_pod_sync, serving_pod_response
+from .warm_pool import warm_pool
+
+router = APIRouter()
+
+
+##############################################################
+# Serving Pod API：建立 (同步 / async)、刪除、bulk 與列表
+
+# 創建 Pod
+@router.post("/create_pod")
+async def create_pod(request: PodCreateRequest, idempotency_key: Optional[str] = Header(None)):
+    def _create():
+        # 先從 warm pool 取用已預先建立好的 Pod (warm pool 的 Pod 沒有掛 model cache)
+        if not request.model_uri:
+            warm = warm_pool.acquire(request.image_name, request.image_tag, request.export_port, request.dag_id)
+            if warm is not None:
+                return warm
+
+        plan = build_serving_pod_plan(request.image_name, request.image_tag, request.export_port, request.dag_id, model_uri=request.model_uri)
+        pod_info = provision_serving_pod_sync(plan)
+        return serving_pod_response(plan, pod_info.status.pod_ip)
+
+    # 同步 provisioning 仍在 threadpool 中執行，idempotency 的等待不佔用 thread
+    return await idempotency.run("create_pod", resolve_idempotency_key(idempotency_key, request), request,
+                                 lambda: run_in_threadpool(_create))
+
+
+# 創建 Pod (async 版本：等待期間不佔用 worker thread)
+@router.post("/create_pod_async")
+async def create_pod_async(request: PodCreateRequest, idempotency_key: Optional[str] = Header(None)):
+    async def _create():
+        if not request.model_uri:
+            warm = await run_in_threadpool(warm_pool.acquire, request.image_name, request.image_tag, request.export_port, request.dag_id)
+            if warm is not None:
+                return warm
+
+        plan = await run_in_threadpool(
+            build_serving_pod_plan, request.image_name, request.image_tag, request.export_port, request.dag_id, model_uri=request.model_uri
+        )
+        return await provision_serving_pod(plan)
+
+    # /create_pod 與 /create_pod_async 共用 scope：同一個 key 不論打哪一個都只會建立一次
+    return await idempotency.run("create_pod", resolve_idempotency_key(idempotency_key, request), request, _create)
+
+
+PROPAGATION_POLICIES = ("Background", "Foreground", "Orphan")
+BULK_DEFAULT_CONCURRENCY = int(os.getenv("BULK_DEFAULT_CONCURRENCY", "10"))
+BULK_MAX_CONCURRENCY = int(os.getenv("BULK_MAX_CONCURRENCY", "50"))
+
+
+def validate_propagation_policy(propagation_policy: str) -> str:
+    if propagation_policy not in PROPAGATION_POLICIES:
+        raise HTTPException(status_code=400, detail=f"propagation_policy must be one of {', '.join(PROPAGATION_POLICIES)}.")
+    return propagation_policy
+
+
+async def delete_serving_pod_async(pod_name: str, propagation_policy: str = "Background"):
+    """
+    同時刪除 Pod / PVC / Service (三個 API 呼叫並行)，
+    回傳 {"pod": ..., "pvc": ..., "service": ...}，值為 deleted / not_found 或 ApiException
+    propagation_policy=Background 時 API Server 立即回應，不等待 finalizer
+    """
+    async def _delete(delete_func, name):
+        try:
+            await k8s_call(delete_func, name=name, namespace="ml-serving", propagation_policy=propagation_policy)
+            return "deleted"
+        except client.exceptions.ApiException as e:
+            if e.status == 404:
+                return "not_found"
+            return e
+
+    pod_result, pvc_result, service_result = await asyncio.gather(
+        _delete(kube.v1.delete_namespaced_pod, pod_name),
+        _delete(kube.v1.delete_namespaced_persistent_volume_claim, f"{pod_name}-pvc"),
+        _delete(kube.v1.delete_namespaced_service, f"{pod_name}-svc"),
+    )
+    return {"pod": pod_result, "pvc": pvc_result, "service": service_result}
+
+
+# 刪除 Pod
+@router.delete("/delete_pod/{pod_name}")
+async def delete_pod(pod_name: str, propagation_policy: str = "Background"):
+    validate_propagation_policy(propagation_policy)
+    results = await delete_serving_pod_async(pod_name, propagation_policy)
+
+    errors = [result for result in results.values() if isinstance(result, Exception)]
+    if errors:
+        raise HTTPException(status_code=400, detail=f"Failed to delete pod or pvc: {errors[0]}")
+    if all(result == "not_found" for result in results.values()):
+        raise HTTPException(status_code=400, detail=f"Failed to delete pod or pvc: {pod_name} not found")
+
+    return {"message": "Pod ,SVC and PVC deleted", "pod_name": pod_name, "pvc_name": f"{pod_name}-pvc",
+            "service_name": f"{pod_name}-svc", "results": results}
+
+
+##############################################################
+# Bulk 建立 / 刪除：以 semaphore 限制同時進行的數量
+
+class BulkCreatePodsRequest(BaseModel):
+    pods: List[PodCreateRequest]
+    concurrency: Optional[int] = None
+
+
+class BulkDeletePodsRequest(BaseModel):
+    pod_names: List[str] = []
+    label_selector: Optional[str] = None  # 僅支援 equality-based，例如 "ml-serving/dag-id=my_dag"
+    image: Optional[str] = None  # 完整 image 或不含 registry / tag 的 image name
+    concurrency: Optional[int] = None
+    propagation_policy: str = "Background"
+
+
+def resolve_concurrency(concurrency: Optional[int]) -> int:
+    if concurrency is None:
+        return BULK_DEFAULT_CONCURRENCY
+    if concurrency < 1 or concurrency > BULK_MAX_CONCURRENCY:
+        raise HTTPException(status_code=400, detail=f"concurrency must be between 1 and {BULK_MAX_CONCURRENCY}.")
+    return concurrency
+
+
+def match_label_selector(labels: dict, selector: str) -> bool:
+    """ 本地比對 equality-based label selector (k=v, k==v, k!=v, k, !k) """
+    labels = labels or {}
+    for requirement in filter(None, (part.strip() for part in selector.split(","))):
+        if "!=" in requirement:
+            key, value = (x.strip() for x in requirement.split("!=", 1))
+            if labels.get(key) == value:
+                return False
+        elif "=" in requirement:
+            key, value = (x.strip() for x in requirement.replace("==", "=").split("=", 1))
+            if labels.get(key) != value:
+                return False
+        elif requirement.startswith("!"):
+            if requirement[1:].strip() in labels:
+                return False
+        elif " in " in requirement or " notin " in requirement:
+            raise HTTPException(status_code=400, detail="Set-based label selectors are not supported.")
+        elif requirement not in labels:
+            return False
+    return True
+
+
+@router.post("/create_pods")
+async def create_pods(request: BulkCreatePodsRequest):
+    concurrency = resolve_concurrency(request.concurrency)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def _create(index: int, item: PodCreateRequest):
+        async with semaphore:
+            try:
+                warm = None
+                if not item.model_uri:
+                    warm = await run_in_threadpool(warm_pool.acquire, item.image_name, item.image_tag, item.export_port, item.dag_id)
+                if warm is None:
+                    plan = await run_in_threadpool(
+                        build_serving_pod_plan, item.image_name, item.image_tag, item.export_port, item.dag_id, model_uri=item.model_uri
+                    )
+                    warm = await provision_serving_pod(plan)
+                return {"index": index, "status": "created", **warm}
+            except HTTPException as e:
+                return {"index": index, "status": "failed", "image_name": item.image_name, "detail": e.detail}
+            except Exception as e:
+                return {"index": index, "status": "failed", "image_name": item.image_name, "detail": str(e)}
+
+    results = await asyncio.gather(*(_create(index, item) for index, item in enumerate(request.pods)))
+    return {
+        "created": sum(1 for result in results if result["status"] == "created"),
+        "failed": sum(1 for result in results if result["status"] == "failed"),
+        "results": list(results)
+    }
+
+
+@router.post("/delete_pods")
+async def delete_pods(request: BulkDeletePodsRequest):
+    propagation_policy = validate_propagation_policy(request.propagation_policy)
+    concurrency = resolve_concurrency(request.concurrency)
+
+    if not (request.pod_names or request.label_selector or request.image):
+        raise HTTPException(status_code=400, detail="pod_names, label_selector or image is required.")
+    if (request.label_selector or request.image) and not pod_informer.has_synced():
+        raise HTTPException(status_code=503, detail="Pod cache is not synced yet.")
+
+    targets = set(request.pod_names)
+    if request.label_selector or request.image:
+        # 由 informer cache 解析目標，不另外對 API Server 發 LIST；warm pool 中閒置的 Pod 不在刪除範圍
+        names = pod_informer.index_keys("role", "serving")
+        if request.image:
+            names &= pod_informer.index_keys("image", request.image)
+        for name in names:
+            pod = pod_informer.get(name)
+            if pod is None or (pod.metadata.labels or {}).get("warm-pool") == "idle":
+                continue
+            if request.label_selector and not match_label_selector(pod.metadata.labels, request.label_selector):
+                continue
+            targets.add(name)
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def _delete(pod_name: str):
+        async with semaphore:
+            results = await delete_serving_pod_async(pod_name, propagation_policy)
+        errors = {kind: str(result) for kind, result in results.items() if isinstance(result, Exception)}
+        if errors:
+            return {"pod_name": pod_name, "status": "failed", "errors": errors}
+        return {"pod_name": pod_name, "status": "deleted", "results": results}
+
+    results = await asyncio.gather(*(_delete(pod_name) for pod_name in sorted(targets)))
+    return {
+        "deleted": sum(1 for result in results if result["status"] == "deleted"),
+        "failed": sum(1 for result in results if result["status"] == "failed"),
+        "propagation_policy": propagation_policy,
+        "results": list(results)
+    }
+
+
+##############################################################
+# Serving Pod 列表：由 informer cache 提供，以 (建立時間, 名稱) 為 cursor 分頁
+
+def encode_continue_token(pod) -> str:
+    key = [pod.metadata.creation_timestamp.isoformat() if pod.metadata.creation_timestamp else "", pod.metadata.name]
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+
+def decode_continue_token(token: str):
+    try:
+        created_at, name = json.loads(base64.urlsafe_b64decode(token.encode()).decode())
+        return created_at, name
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid continue token.")
+
+
+def pod_sort_key(pod):
+    created_at = pod.metadata.creation_timestamp.isoformat() if pod.metadata.creation_timestamp else ""
+    return created_at, pod.metadata.name
+
+
+def serving_pod_view(pod):
+    pod_name = pod.metadata.name
+    labels = pod.metadata.labels or {}
+    service = service_informer.get(f"{pod_name}-svc")
+    pvc = pvc_informer.get(f"{pod_name}-pvc")
+    statuses = (pod.status.container_statuses or []) if pod.status else []
+    return {
+        "pod_name": pod_name,
+        "phase": pod.status.phase if pod.status else None,
+        "ready": bool(statuses) and all(status.ready for status in statuses),
+        "pod_ip": pod.status.pod_ip if pod.status else None,
+        "node_name": pod.spec.node_name,
+        "image": pod_image_ref(pod),
+        "dag_id": labels.get(DAG_LABEL),
+        "created_at": pod.metadata.creation_timestamp.isoformat() if pod.metadata.creation_timestamp else None,
+        "pod_service": f"{service.metadata.name}.ml-serving.svc.cluster.local" if service else None,
+        "pvc_name": pvc.metadata.name if pvc else None,
+        "pvc_phase": pvc.status.phase if pvc and pvc.status else None,
+    }
+
+
+# 查詢目前所有 ML Serving Pod (由 informer cache 提供，不對 API Server 發 LIST)
+@router.get("/list_pods")
+def list_pods(image: Optional[str] = None, dag_id: Optional[str] = None, phase: Optional[str] = None,
+              limit: int = 50, continue_token: Optional[str] = Query(None, alias="continue")):
+    if not pod_informer.has_synced():
+        raise HTTPException(status_code=503, detail="Pod cache is not synced yet.")
+    if limit < 1 or limit > 500:
+        raise HTTPException(status_code=400, detail="limit must be between 1 and 500.")
+
+    # 以 index 取交集，避免掃描全部 Pod
+    names = pod_informer.index_keys("role", "serving")
+    if image:
+        names &= pod_informer.index_keys("image", image)
+    if dag_id:
+        names &= pod_informer.index_keys("dag", sanitize_label_value(dag_id))
+    if phase:
+        names &= pod_informer.index_keys("phase", phase)
+
+    pods = [pod for pod in (pod_informer.get(name) for name in names) if pod is not None]
+    pods.sort(key=pod_sort_key)
+    total = len(pods)
+    if continue_token:
+        after = decode_continue_token(continue_token)
+        pods = [pod for pod in pods if pod_sort_key(pod) > after]
+
+    page = pods[:limit]
+    return {
+        "pods": [serving_pod_view(pod) for pod in page],
+        "total": total,
+        "continue": encode_continue_token(page[-1]) if len(pods) > limit else None
+    }
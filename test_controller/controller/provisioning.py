@@ -0,0 +1,409 @@
+from fastapi import HTTPException
+from kubernetes import client
+import uuid
+import time
+from pydantic import BaseModel
+from typing import Optional
+import asyncio
+import logging
+from . import kube, store
+from .observability import logger, observe_phase, PROVISION_ROLLBACKS, PROVISION_SECONDS
+from .kube import generate_safe_name, k8s_call, k8s_request
+from .informers import CONTROLLER_LABELS, DAG_LABEL, IMAGE_REF_ANNOTATION, pod_informer, POD_READY_TIMEOUT, PROVISIONING_LABEL, ROLE_LABEL, sanitize_label_value
+from .images import image_tag, resolve_image
+from .locality import preferred_node_affinity
+from .model_cache import apply_model_mount, model_cache
+
+
+##############################################################
+# Serving Pod provisioning：PVC / Pod / Service manifest、等待 Ready，中途失敗時以 saga 依相反順序 rollback
+
+class PodCreateRequest(BaseModel):
+    image_name: str
+    image_tag: str
+    export_port: int
+    dag_id: Optional[str] = None  # 可選：建立此 Pod 的 DAG，用於 /list_pods 篩選
+    execution_id: Optional[str] = None  # 可選：與 dag_id 一起推導 idempotency key (Airflow retry 不會重複建立)
+    idempotency_key: Optional[str] = None  # 也可以用 Idempotency-Key header 指定
+    model_uri: Optional[str] = None  # 可選：MLflow model (e.g. models:/name/3)，由共用 model cache 以 read-only 掛載
+
+
+def build_serving_pod_plan(image_name: str, image_tag: str, export_port: int, dag_id: str = None, pod_name: str = None,
+                           model_uri: str = None):
+    """
+    產生一組 ML Serving 所需的 PVC / Pod / Service 名稱與 manifest
+    (同步與 async 版本的 /create_pod 共用；pod_name 只在 scale-to-zero 喚醒時沿用原名稱)
+    model_uri 有值時掛上共用 model cache，provisioning 會先確保 model 已在 cache 中
+    """
+    # 確認 Image Name 格式
+    if not image_name:
+        raise HTTPException(status_code=400, detail="Image Name is required.")
+    if ":" in image_name:
+        raise HTTPException(status_code=400, detail="Invalid Image Name.")
+
+    # 拼接 Image 完整名稱；所有 node 上都是同一個 digest 時改用 digest + IfNotPresent
+    full_image_name = f"harbor.pdc.tw/{image_name}:{image_tag}"
+    pinned_image, pull_policy = resolve_image(full_image_name)
+
+    # 安全生成 pod 名稱
+    pod_name = pod_name or generate_safe_name(image_name, prefix="mlpod")
+    pvc_name = f"{pod_name}-pvc"
+    service_name = f"{pod_name}-svc"
+    # 偏好已有 image / 已掛載同一個 PVC 的 node (scale-to-zero 喚醒時 PVC 沿用)
+    affinity = preferred_node_affinity(full_image_name, pvc_name=pvc_name)
+
+    provisioning_id = uuid.uuid4().hex[:12]
+    labels = {**CONTROLLER_LABELS, ROLE_LABEL: "serving", PROVISIONING_LABEL: provisioning_id}
+    if dag_id:
+        labels[DAG_LABEL] = sanitize_label_value(dag_id)
+
+    pvc_manifest = {
+        "apiVersion": "v1",
+        "kind": "PersistentVolumeClaim",
+        "metadata": {
+            "name": pvc_name,
+            "namespace": "ml-serving",
+            "labels": dict(labels)
+        },
+        "spec": {
+            "accessModes": ["ReadWriteMany"],
+            "storageClassName": "nfs-storage",
+            "resources": {
+                "requests": {
+                    "storage": "5Gi"
+                }
+            }
+        }
+    }
+
+    pod_manifest = {
+        "apiVersion": "v1",
+        "kind": "Pod",
+        "metadata": {
+            "name": pod_name, 
+            "namespace": "ml-serving",
+            "labels": {
+                "app": pod_name,
+                **labels
+            },
+            "annotations": {IMAGE_REF_ANNOTATION: full_image_name}
+        },
+        "spec": {
+            "serviceAccountName": "ml-serving-sa",
+            "containers": [
+                {
+                    "name": "ml-serving-container",
+                    "image": pinned_image,
+                    "imagePullPolicy": pull_policy,
+                    "ports": [{"name": "http", "containerPort": export_port}],  # 這裡假設 ML Server 跑在 export_port
+                     "env": [  # 傳遞 PVC 名稱，讓 ml-serving Pod 知道要共用的 PVC
+                        {
+                            "name": "PVC_NAME",
+                            "value": pvc_name
+                        },
+                        {
+                            "name": "GITHUB_TOKEN",
+                            "valueFrom": {
+                                "secretKeyRef": {
+                                    "name": "github-token",
+                                    "key": "GITHUB_TOKEN"
+                                }
+                            }
+                        },
+                        {"name": "MLFLOW_TRACKING_URI", "valueFrom": {"configMapKeyRef": {"name": "mlflow-config", "key": "MLFLOW_TRACKING_URI"}}},
+                        {"name": "MLFLOW_S3_ENDPOINT_URL", "valueFrom": {"configMapKeyRef": {"name": "mlflow-config", "key": "MLFLOW_S3_ENDPOINT_URL"}}},
+                        {"name": "AWS_ACCESS_KEY_ID", "valueFrom": {"secretKeyRef": {"name": "mlflow-secret", "key": "AWS_ACCESS_KEY_ID"}}},
+                        {"name": "AWS_SECRET_ACCESS_KEY", "valueFrom": {"secretKeyRef": {"name": "mlflow-secret", "key": "AWS_SECRET_ACCESS_KEY"}}}
+                    ],
+                    "volumeMounts": [
+                        {
+                            "name": "ml-storage",
+                            "mountPath": "/mnt/storage"
+                        }
+                    ]
+                }
+            ],
+            "volumes": [
+                {
+                    "name": "ml-storage",
+                    "persistentVolumeClaim": {
+                        "claimName": pvc_name
+                    }
+                }
+            ],
+            # 加入這行，指定 Image Pull Secret
+            "imagePullSecrets": [
+                {
+                    "name": "harbor-secret"  # 與 harbor-secret.yaml 中的 name 相同
+                }
+            ]
+        }
+    }
+    if affinity:
+        pod_manifest["spec"]["affinity"] = affinity
+
+    service_manifest = {
+        "apiVersion": "v1",
+        "kind": "Service",
+        "metadata": {
+            "name": service_name,
+            "namespace": "ml-serving",
+            "labels": dict(labels)
+        },
+        "spec": {
+            "selector": {
+                "app": pod_name  
+            },
+            "ports": [
+                {
+                    "protocol": "TCP",
+                    "port": export_port,
+                    "targetPort": export_port  
+                }
+            ]
+        }
+    }
+
+    plan = {
+        "provisioning_id": provisioning_id,
+        "pod_name": pod_name,
+        "pvc_name": pvc_name,
+        "service_name": service_name,
+        "full_image_name": full_image_name,
+        "export_port": export_port,
+        "pvc_manifest": pvc_manifest,
+        "pod_manifest": pod_manifest,
+        "service_manifest": service_manifest,
+    }
+    if model_uri:
+        apply_model_mount(plan, model_cache.resolve(model_uri))
+    return plan
+
+
+def pod_ready_predicate(export_port: int):
+    """ Pod 進入 Running 且 containerPort 已就緒，才可以建立 Service """
+    def _ready(pod) -> bool:
+        if pod is None or pod.status is None or pod.status.phase != "Running":
+            return False
+        if not pod.status.pod_ip:
+            return False
+        ports = pod.spec.containers[0].ports
+        return bool(ports) and ports[0].container_port == export_port
+    return _ready
+
+
+def pod_readiness_stages(export_port: int):
+    """ 把「等待 Pod 就緒」拆成 scheduling → Running → containerPort 就緒，分別記錄耗時 """
+    return [
+        ("pod_scheduling", lambda pod: pod is not None and pod.spec is not None and bool(pod.spec.node_name)),
+        ("pod_running", lambda pod: pod is not None and pod.status is not None and pod.status.phase == "Running"),
+        ("port_ready", pod_ready_predicate(export_port)),
+    ]
+
+
+def pod_ready_timeout(plan: dict, stage: str):
+    logger.warning("Pod did not become ready in time", extra={"pod_name": plan["pod_name"], "stage": stage, "timeout": POD_READY_TIMEOUT})
+    return HTTPException(status_code=500, detail="Pod did not reach Running state in time.")
+
+
+def wait_for_serving_pod_sync(plan: dict):
+    deadline = time.monotonic() + POD_READY_TIMEOUT
+    pod_info = None
+    for stage, predicate in pod_readiness_stages(plan["export_port"]):
+        with observe_phase(stage):
+            pod_info = pod_informer.wait_for(plan["pod_name"], predicate, timeout=max(deadline - time.monotonic(), 0))
+        if pod_info is None:
+            raise pod_ready_timeout(plan, stage)
+    return pod_info
+
+
+async def wait_for_serving_pod(plan: dict):
+    deadline = time.monotonic() + POD_READY_TIMEOUT
+    pod_info = None
+    for stage, predicate in pod_readiness_stages(plan["export_port"]):
+        with observe_phase(stage):
+            pod_info = await pod_informer.async_wait_for(plan["pod_name"], predicate, timeout=max(deadline - time.monotonic(), 0))
+        if pod_info is None:
+            raise pod_ready_timeout(plan, stage)
+    return pod_info
+
+
+def serving_pod_response(plan: dict, pod_ip: str):
+    return {
+        "message": "Pod created",
+        "pod_name": plan["pod_name"],
+        "image": plan["full_image_name"],
+        "pod_ip": pod_ip,
+        "pod_service": f"{plan['service_name']}.ml-serving.svc.cluster.local"
+    }
+
+
+def pod_owner_reference(pod) -> dict:
+    return {"apiVersion": "v1", "kind": "Pod", "name": pod.metadata.name, "uid": pod.metadata.uid}
+
+
+def set_pod_owner(plan: dict, pod):
+    """ PVC / Service 以 Pod 為 owner：Pod 被刪除 (包含 rollback) 時由 Kubernetes GC 一併清除 """
+    for manifest in (plan["pvc_manifest"], plan["service_manifest"]):
+        manifest["metadata"]["ownerReferences"] = [pod_owner_reference(pod)]
+
+
+class ProvisioningSaga:
+    """
+    Provisioning 以 saga 執行：每完成一步就記下對應的補償 (刪除剛建立的物件)，
+    任何一步失敗時依相反順序 rollback；rollback 本身失敗的物件留給 orphan GC
+    """
+
+    def __init__(self, plan: dict):
+        self.plan = plan
+        self.created = []  # [(kind, delete function, name)]
+
+    def completed(self, kind: str, delete_func, name: str):
+        self.created.append((kind, delete_func, name))
+
+    def _log(self, error: Exception, failures: list):
+        PROVISION_ROLLBACKS.labels("failed" if failures else "succeeded").inc()
+        logger.warning("Provisioning rolled back", extra={
+            "pod_name": self.plan["pod_name"], "provisioning_id": self.plan["provisioning_id"], "error": str(error),
+            "rolled_back": [kind for kind, _, _ in self.created], "rollback_failures": failures,
+        })
+
+    def rollback_sync(self, error: Exception):
+        if not self.created:
+            return
+        failures = []
+        for kind, delete_func, name in reversed(self.created):
+            try:
+                k8s_request(delete_func, name=name, namespace="ml-serving", propagation_policy="Background")
+            except client.exceptions.ApiException as e:
+                if e.status != 404:
+                    failures.append(kind)
+            except Exception:
+                failures.append(kind)
+        self._log(error, failures)
+
+    async def rollback(self, error: Exception):
+        if not self.created:
+            return
+        failures = []
+        for kind, delete_func, name in reversed(self.created):
+            try:
+                await k8s_call(delete_func, name=name, namespace="ml-serving", propagation_policy="Background")
+            except client.exceptions.ApiException as e:
+                if e.status != 404:
+                    failures.append(kind)
+            except Exception:
+                failures.append(kind)
+        self._log(error, failures)
+
+
+def provision_serving_pod_sync(plan: dict):
+    """ 同步 provisioning：Pod → PVC (owner 為 Pod) → 等待 Running → Service，回傳 Running 的 Pod；失敗時 rollback """
+    start = time.perf_counter()
+    logger.info("Provisioning serving pod", extra={"pod_name": plan["pod_name"], "image": plan["full_image_name"],
+                                                   "provisioning_id": plan["provisioning_id"]})
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Serving pod manifests", extra={"pod_manifest": plan["pod_manifest"], "service_manifest": plan["service_manifest"]})
+
+    saga = ProvisioningSaga(plan)
+    try:
+        # 0. model 尚未在共用 cache 時等待 fetch Job 下載
+        if plan.get("model"):
+            with observe_phase("model_fetch"):
+                model_cache.ensure_sync(plan["model"], plan["full_image_name"])
+
+        # 1. 先建立 Pod 取得 uid (PVC 建立前 Pod 維持 Pending，scheduler 會在 PVC 出現後重試)
+        with observe_phase("pod_create"):
+            pod = k8s_request(kube.v1.create_namespaced_pod, namespace="ml-serving", body=plan["pod_manifest"])
+        saga.completed("pod", kube.v1.delete_namespaced_pod, plan["pod_name"])
+        set_pod_owner(plan, pod)
+
+        # 2. 動態生成 PVC
+        with observe_phase("pvc_create"):
+            k8s_request(kube.v1.create_namespaced_persistent_volume_claim, namespace="ml-serving", body=plan["pvc_manifest"])
+        saga.completed("pvc", kube.v1.delete_namespaced_persistent_volume_claim, plan["pvc_name"])
+
+        # 等待 watch stream 通知 Pod Running + containerPort 就緒 (不再輪詢 API Server)
+        pod_info = wait_for_serving_pod_sync(plan)
+
+        # 3.  create svc
+        with observe_phase("service_create"):
+            k8s_request(kube.v1.create_namespaced_service, namespace="ml-serving", body=plan["service_manifest"])
+    except Exception as e:
+        PROVISION_SECONDS.labels("cold", "failed").observe(time.perf_counter() - start)
+        saga.rollback_sync(e)
+        raise
+
+    PROVISION_SECONDS.labels("cold", "succeeded").observe(time.perf_counter() - start)
+    return pod_info
+
+
+async def provision_serving_pod(plan: dict, report=None):
+    """
+    async provisioning pipeline：Pod → PVC → readiness → Service，失敗時 rollback 已建立的物件
+    report(phase, detail) 用來回報每個階段的進度 (operation 事件串流使用)
+    """
+    async def _report(phase: str, detail: dict = None):
+        if report is not None:
+            await report(phase, detail or {})
+
+    pod_name = plan["pod_name"]
+    start = time.perf_counter()
+    logger.info("Provisioning serving pod", extra={"pod_name": pod_name, "image": plan["full_image_name"],
+                                                   "provisioning_id": plan["provisioning_id"]})
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Serving pod manifests", extra={"pod_manifest": plan["pod_manifest"], "service_manifest": plan["service_manifest"]})
+
+    saga = ProvisioningSaga(plan)
+    try:
+        if plan.get("model"):
+            await _report("model_fetching", {"model_uri": plan["model"]["uri"], "key": plan["model"]["key"]})
+            with observe_phase("model_fetch"):
+                await model_cache.ensure(plan["model"], plan["full_image_name"])
+
+        await _report("pod_creating", {"pod_name": pod_name, "image": plan["full_image_name"], "provisioning_id": plan["provisioning_id"]})
+        with observe_phase("pod_create"):
+            pod = await k8s_call(kube.v1.create_namespaced_pod, namespace="ml-serving", body=plan["pod_manifest"])
+        saga.completed("pod", kube.v1.delete_namespaced_pod, pod_name)
+        set_pod_owner(plan, pod)
+
+        await _report("pvc_creating", {"pvc_name": plan["pvc_name"]})
+        with observe_phase("pvc_create"):
+            await k8s_call(kube.v1.create_namespaced_persistent_volume_claim, namespace="ml-serving", body=plan["pvc_manifest"])
+        saga.completed("pvc", kube.v1.delete_namespaced_persistent_volume_claim, plan["pvc_name"])
+
+        await _report("pod_waiting", {"timeout": POD_READY_TIMEOUT})
+        pod_info = await wait_for_serving_pod(plan)
+
+        await _report("service_creating", {"service_name": plan["service_name"], "pod_ip": pod_info.status.pod_ip})
+        with observe_phase("service_create"):
+            await k8s_call(kube.v1.create_namespaced_service, namespace="ml-serving", body=plan["service_manifest"])
+    except BaseException as e:
+        # 包含 CancelledError (client 中斷 / operation 被取消)，一樣要清掉已建立的物件
+        PROVISION_SECONDS.labels("cold", "failed").observe(time.perf_counter() - start)
+        if saga.created:
+            await _report("rolling_back", {"created": [kind for kind, _, _ in saga.created]})
+        await asyncio.shield(saga.rollback(e))
+        raise
+
+    PROVISION_SECONDS.labels("cold", "succeeded").observe(time.perf_counter() - start)
+    return serving_pod_response(plan, pod_info.status.pod_ip)
+
+
+POD_ACTIVITY_KEY = "pod_last_active"  # zset：pod name -> 最後活動時間 (idle reaper 依此回收)
+
+
+def delete_serving_resources(pod_name: str):
+    """ 刪除 Pod / PVC / Service，找不到的物件直接略過 """
+    deletes = [
+        (kube.v1.delete_namespaced_pod, pod_name),
+        (kube.v1.delete_namespaced_persistent_volume_claim, f"{pod_name}-pvc"),
+        (kube.v1.delete_namespaced_service, f"{pod_name}-svc"),
+    ]
+    for delete_func, name in deletes:
+        try:
+            k8s_request(delete_func, name=name, namespace="ml-serving")
+        except client.exceptions.ApiException as e:
+            if e.status != 404:
+                raise
+    store.redis_lock.zrem(POD_ACTIVITY_KEY, pod_name)
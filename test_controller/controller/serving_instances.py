@@ -0,0 +1,400 @@
+from fastapi import APIRouter, HTTPException
+import os
+from kubernetes import client
+import time
+import redis
+import json
+from datetime import datetime
+from pydantic import BaseModel
+from typing import Optional
+import re
+import hashlib
+import asyncio
+import threading
+from fastapi.concurrency import run_in_threadpool
+from . import kube, store
+from .observability import error_label, logger, RECONCILE_ACTIONS, RECONCILE_ERRORS
+from .kube import k8s_call
+from .coordination import coordinator, REPLICA_ID
+from .informers import pod_informer, pvc_informer, service_informer
+from .model_cache import model_cache
+from .provisioning import build_serving_pod_plan, pod_ready_predicate
+from .idle_reaper import IDLE_REAPER_OPT_OUT_LABEL
+
+router = APIRouter()
+
+
+##############################################################
+# ServingInstance：宣告式的 serving spec 存在 Redis，由 reconcile loop 比對 desired (Redis) 與 observed (informer cache)
+# 只在有差異時才呼叫 API Server：Pod 被 evict / crash / 刪除時自動重建，spec 改變時替換 Pod
+# 觸發來源：PUT / DELETE、informer 事件 (帶 serving-instance label 的 Pod / PVC / Service) 與定期 resync
+# 多 replica 時每個 instance 只由 coordinator.owner_of(name) 的 process reconcile；
+# PUT / DELETE 透過 Redis pub/sub 通知負責的 process，replica 增減時立即 resync
+
+SERVING_INSTANCES_KEY = "serving_instances"  # hash：instance name -> desired spec (json)
+SERVING_INSTANCE_ERRORS_KEY = "serving_instance_errors"  # hash：instance name -> 最後一次 reconcile 錯誤
+SERVING_INSTANCE_EVENTS_CHANNEL = "serving_instance_events"
+SERVING_INSTANCE_LABEL = "ml-serving/serving-instance"
+SPEC_HASH_ANNOTATION = "ml-serving/spec-hash"
+RECONCILE_RESYNC_INTERVAL = int(os.getenv("RECONCILE_RESYNC_INTERVAL", "300"))
+RECONCILE_MAX_BACKOFF = int(os.getenv("RECONCILE_MAX_BACKOFF", "300"))
+SERVING_INSTANCE_NAME_PATTERN = re.compile(r"^[a-z0-9]([a-z0-9\-]{0,38}[a-z0-9])?$")
+
+
+class ServingInstanceSpec(BaseModel):
+    image_name: str
+    image_tag: str
+    export_port: int
+    dag_id: Optional[str] = None
+    model_uri: Optional[str] = None
+
+
+def serving_instance_pod_name(name: str) -> str:
+    # 與 /create_pod 產生的 mlpod-* 分開，instance 名稱不會撞到命令式建立的 Pod
+    return f"mlinst-{name}"
+
+
+def serving_spec_hash(spec: dict) -> str:
+    fields = {key: spec.get(key) for key in ServingInstanceSpec.model_fields}
+    return hashlib.sha256(json.dumps(fields, sort_keys=True).encode()).hexdigest()[:16]
+
+
+class ServingReconciler:
+    """
+    每個 instance 同一時間只會有一個 reconcile 在執行；執行中收到的事件會在結束後再處理一次
+    reconcile 失敗時以指數 backoff 重試
+    ownership 換手的瞬間兩個 process 可能同時 reconcile 同一個 instance，建立 / 刪除遇到 409 / 404 都視為已完成
+    """
+
+    def __init__(self):
+        self._loop = None
+        self._wakeup = None
+        self._task = None
+        self._stop = threading.Event()
+        self._listener = None
+        self._dirty = set()
+        self._running = set()
+        self._resync_requested = False
+        self._failures = {}  # instance name -> 連續失敗次數
+        self._healthy = set()  # 最近一次 reconcile 成功的 instance
+
+    def start(self, loop):
+        self._loop = loop
+        self._wakeup = asyncio.Event()
+        self._task = loop.create_task(self._run())
+        self._stop.clear()
+        self._listener = threading.Thread(target=self._listen, name="serving-instance-events", daemon=True)
+        self._listener.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+
+    def get(self, name: str) -> Optional[dict]:
+        value = store.redis_lock.hget(SERVING_INSTANCES_KEY, name)
+        return json.loads(value) if value else None
+
+    def list(self) -> dict:
+        return {name: json.loads(value) for name, value in store.redis_lock.hgetall(SERVING_INSTANCES_KEY).items()}
+
+    def enqueue(self, name: str):
+        # 可由任何 thread 呼叫 (informer handler 在 watch thread)；不是自己負責的 instance 在 _run 內略過
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._mark, name)
+
+    def notify(self, name: str):
+        """ desired state 改變後通知負責的 process (可能是其他 replica) """
+        self.enqueue(name)
+        store.redis_lock.publish(SERVING_INSTANCE_EVENTS_CHANNEL, name)
+
+    def request_resync(self):
+        # replica 增減時 ownership 會改變 (由 coordinator thread 呼叫)
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._mark_resync)
+
+    def _mark(self, name: str):
+        self._dirty.add(name)
+        self._wakeup.set()
+
+    def _mark_resync(self):
+        self._resync_requested = True
+        self._wakeup.set()
+
+    def _listen(self):
+        while not self._stop.is_set():
+            pubsub = store.redis_lock.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.subscribe(SERVING_INSTANCE_EVENTS_CHANNEL)
+                # 斷線期間可能漏掉通知，重新訂閱後做一次完整 resync
+                self.request_resync()
+                while not self._stop.is_set():
+                    message = pubsub.get_message(timeout=1.0)
+                    if message is not None:
+                        self.enqueue(message["data"])
+            except redis.RedisError as e:
+                logger.warning("Serving instance event subscription failed", extra={"error": str(e)})
+                self._stop.wait(1)
+            finally:
+                pubsub.close()
+
+    def on_object_event(self, event_type: str, obj):
+        name = (obj.metadata.labels or {}).get(SERVING_INSTANCE_LABEL)
+        if name:
+            self.enqueue(name)
+
+    async def _run(self):
+        while not all(informer.has_synced() for informer in (pod_informer, pvc_informer, service_informer)):
+            await asyncio.sleep(0.5)
+        last_resync = 0
+        while True:
+            if self._resync_requested or time.monotonic() - last_resync >= RECONCILE_RESYNC_INTERVAL:
+                self._resync_requested = False
+                last_resync = time.monotonic()
+                try:
+                    self._dirty.update(await run_in_threadpool(lambda: list(self.list())))
+                except Exception:
+                    logger.exception("Serving instance resync failed")
+            for name in self._dirty - self._running:
+                self._dirty.discard(name)
+                if not coordinator.owns(name):
+                    self._failures.pop(name, None)
+                    self._healthy.discard(name)
+                    continue
+                self._running.add(name)
+                self._loop.create_task(self._reconcile_guarded(name))
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=RECONCILE_RESYNC_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def _reconcile_guarded(self, name: str):
+        try:
+            await self.reconcile(name)
+            self._failures.pop(name, None)
+            if name not in self._healthy:
+                # 第一次成功 (包含從其他 replica 接手時) 清除之前留下的錯誤
+                await run_in_threadpool(store.redis_lock.hdel, SERVING_INSTANCE_ERRORS_KEY, name)
+                self._healthy.add(name)
+        except Exception as e:
+            self._healthy.discard(name)
+            failures = self._failures[name] = self._failures.get(name, 0) + 1
+            delay = min(2 ** failures, RECONCILE_MAX_BACKOFF)
+            detail = e.detail if isinstance(e, HTTPException) else str(e)
+            error = {"error": detail, "failures": failures, "retry_in": delay, "replica_id": REPLICA_ID,
+                     "at": datetime.utcnow().isoformat()}
+            RECONCILE_ERRORS.labels(error_label(e)).inc()
+            try:
+                await run_in_threadpool(store.redis_lock.hset, SERVING_INSTANCE_ERRORS_KEY, name, json.dumps(error))
+            except redis.RedisError:
+                pass
+            logger.warning("Serving instance reconcile failed", extra={"instance": name, "error": detail, "retry_in": delay})
+            self._loop.call_later(delay, self._mark, name)
+        finally:
+            self._running.discard(name)
+            if name in self._dirty:
+                self._wakeup.set()
+
+    async def _call(self, action: str, func, **kwargs):
+        RECONCILE_ACTIONS.labels(action).inc()
+        try:
+            return await k8s_call(func, namespace="ml-serving", **kwargs)
+        except client.exceptions.ApiException as e:
+            # 409 / 404 代表 cache 稍微落後，下一個事件會再 reconcile
+            if e.status not in (404, 409):
+                raise
+
+    def _plan(self, name: str, spec: dict) -> dict:
+        plan = build_serving_pod_plan(spec["image_name"], spec["image_tag"], spec["export_port"], spec.get("dag_id"),
+                                      pod_name=serving_instance_pod_name(name), model_uri=spec.get("model_uri"))
+        for manifest in (plan["pvc_manifest"], plan["pod_manifest"], plan["service_manifest"]):
+            manifest["metadata"]["labels"][SERVING_INSTANCE_LABEL] = name
+        # Pod 會被 reconciler 重建，不交給 idle reaper 回收
+        plan["pod_manifest"]["metadata"]["labels"][IDLE_REAPER_OPT_OUT_LABEL] = "disabled"
+        plan["pod_manifest"]["metadata"]["annotations"][SPEC_HASH_ANNOTATION] = spec["hash"]
+        return plan
+
+    @staticmethod
+    def _managed(obj, name: str) -> bool:
+        return (obj.metadata.labels or {}).get(SERVING_INSTANCE_LABEL) == name
+
+    async def reconcile(self, name: str):
+        spec = await run_in_threadpool(self.get, name)
+        pod_name = serving_instance_pod_name(name)
+        pod = pod_informer.get(pod_name)
+        pvc = pvc_informer.get(f"{pod_name}-pvc")
+        service = service_informer.get(f"{pod_name}-svc")
+        # 同名但不是這個 instance 建立的物件一律不碰 (不刪除、不接管)
+        foreign = [obj.metadata.name for obj in (pod, pvc, service) if obj is not None and not self._managed(obj, name)]
+
+        if spec is None or spec.get("deleting"):
+            observed = [
+                ("delete_pod", kube.v1.delete_namespaced_pod, pod),
+                ("delete_service", kube.v1.delete_namespaced_service, service),
+                ("delete_pvc", kube.v1.delete_namespaced_persistent_volume_claim, pvc),
+            ]
+            observed = [(action, func, obj if obj is not None and self._managed(obj, name) else None) for action, func, obj in observed]
+            for action, delete_func, obj in observed:
+                if obj is not None and not obj.metadata.deletion_timestamp:
+                    await self._call(action, delete_func, name=obj.metadata.name, propagation_policy="Background")
+            if spec is not None and all(obj is None for _, _, obj in observed):
+                pipe = store.redis_lock.pipeline(transaction=False)
+                pipe.hdel(SERVING_INSTANCES_KEY, name)
+                pipe.hdel(SERVING_INSTANCE_ERRORS_KEY, name)
+                await run_in_threadpool(pipe.execute)
+                logger.info("Serving instance deleted", extra={"instance": name})
+            return
+
+        if foreign:
+            raise HTTPException(status_code=409, detail=f"Existing object(s) {', '.join(foreign)} are not managed by serving instance {name}.")
+
+        plan = None
+
+        async def planned() -> dict:
+            # build_serving_pod_plan 可能向 MLflow 查詢 model version (blocking)，不在 event loop 上執行
+            nonlocal plan
+            if plan is None:
+                plan = await run_in_threadpool(self._plan, name, spec)
+            return plan
+
+        if pvc is None:
+            await self._call("create_pvc", kube.v1.create_namespaced_persistent_volume_claim, body=(await planned())["pvc_manifest"])
+        if service is not None and not service.metadata.deletion_timestamp and service.spec and service.spec.ports \
+                and service.spec.ports[0].port != spec["export_port"]:
+            await self._call("delete_service", kube.v1.delete_namespaced_service, name=service.metadata.name)
+        elif service is None:
+            await self._call("create_service", kube.v1.create_namespaced_service, body=(await planned())["service_manifest"])
+
+        if pod is not None:
+            if pod.metadata.deletion_timestamp:
+                return  # 等 DELETED 事件再重建
+            reason = None
+            if (pod.metadata.annotations or {}).get(SPEC_HASH_ANNOTATION) != spec["hash"]:
+                reason = "spec_changed"
+            elif pod.status and pod.status.phase in ("Failed", "Succeeded"):
+                reason = (pod.status.reason or "pod_failed") if pod.status.phase == "Failed" else "pod_exited"
+            if reason:
+                logger.info("Replacing serving instance pod", extra={"instance": name, "pod_name": pod_name, "reason": reason})
+                await self._call("delete_pod", kube.v1.delete_namespaced_pod, name=pod_name, propagation_policy="Background")
+                if reason != "spec_changed":
+                    await run_in_threadpool(self._record_recreation, name, reason)
+            return
+
+        plan = await planned()
+        if plan.get("model"):
+            await model_cache.ensure(plan["model"], plan["full_image_name"])
+        await self._call("create_pod", kube.v1.create_namespaced_pod, body=plan["pod_manifest"])
+
+    def _record_recreation(self, name: str, reason: str):
+        spec = self.get(name)
+        if spec is None:
+            return
+        spec["recreations"] = spec.get("recreations", 0) + 1
+        spec["last_recreation"] = {"reason": reason, "at": datetime.utcnow().isoformat()}
+        store.redis_lock.hset(SERVING_INSTANCES_KEY, name, json.dumps(spec))
+
+    def errors(self, names: list) -> dict:
+        values = store.redis_lock.hmget(SERVING_INSTANCE_ERRORS_KEY, names) if names else []
+        return {name: json.loads(value) for name, value in zip(names, values) if value}
+
+    def view(self, name: str, spec: dict, error: dict = None) -> dict:
+        pod_name = serving_instance_pod_name(name)
+        pod = pod_informer.get(pod_name)
+        ready = pod_ready_predicate(spec["export_port"])(pod)
+        if spec.get("deleting"):
+            state = "deleting"
+        elif ready and (pod.metadata.annotations or {}).get(SPEC_HASH_ANNOTATION) == spec["hash"]:
+            state = "ready"
+        elif error is not None:
+            state = "degraded"
+        else:
+            state = "progressing"
+        return {
+            "name": name,
+            "state": state,
+            "spec": {key: spec.get(key) for key in ServingInstanceSpec.model_fields},
+            "generation": spec.get("generation"),
+            "pod_name": pod_name,
+            "pod_phase": pod.status.phase if pod is not None and pod.status else None,
+            "pod_ip": pod.status.pod_ip if ready else None,
+            "pod_service": f"{pod_name}-svc.ml-serving.svc.cluster.local",
+            "pvc_present": pvc_informer.get(f"{pod_name}-pvc") is not None,
+            "service_present": service_informer.get(f"{pod_name}-svc") is not None,
+            "recreations": spec.get("recreations", 0),
+            "last_recreation": spec.get("last_recreation"),
+            "error": error,
+            "owner": coordinator.owner_of(name),
+        }
+
+
+serving_reconciler = ServingReconciler()
+for _informer in (pod_informer, pvc_informer, service_informer):
+    _informer.add_handler(serving_reconciler.on_object_event)
+coordinator.listeners.append(serving_reconciler.request_resync)
+
+
+async def start_serving_reconciler():
+    serving_reconciler.start(asyncio.get_running_loop())
+
+
+def stop_serving_reconciler():
+    serving_reconciler.stop()
+
+
+def validate_serving_instance_name(name: str):
+    if not SERVING_INSTANCE_NAME_PATTERN.match(name):
+        raise HTTPException(status_code=400, detail="Instance name must be lowercase alphanumeric or '-', at most 40 characters.")
+
+
+# 建立 / 更新 desired state (spec 沒有變化時不會產生任何 API 呼叫)
+@router.put("/serving_instances/{name}", status_code=202)
+async def put_serving_instance(name: str, spec: ServingInstanceSpec):
+    validate_serving_instance_name(name)
+    if not spec.image_name or ":" in spec.image_name:
+        raise HTTPException(status_code=400, detail="Invalid Image Name.")
+    desired = spec.model_dump()
+    desired["hash"] = serving_spec_hash(desired)
+    current = await run_in_threadpool(serving_reconciler.get, name)
+    if current is not None and current["hash"] == desired["hash"] and not current.get("deleting"):
+        return serving_reconciler.view(name, current)
+    now = datetime.utcnow().isoformat()
+    desired.update(
+        generation=(current or {}).get("generation", 0) + 1,
+        created_at=(current or {}).get("created_at", now),
+        updated_at=now,
+        recreations=(current or {}).get("recreations", 0),
+    )
+    await run_in_threadpool(store.redis_lock.hset, SERVING_INSTANCES_KEY, name, json.dumps(desired))
+    await run_in_threadpool(serving_reconciler.notify, name)
+    return serving_reconciler.view(name, desired)
+
+
+@router.get("/serving_instances")
+async def list_serving_instances():
+    instances = await run_in_threadpool(serving_reconciler.list)
+    errors = await run_in_threadpool(serving_reconciler.errors, list(instances))
+    return {"items": [serving_reconciler.view(name, spec, errors.get(name)) for name, spec in sorted(instances.items())]}
+
+
+@router.get("/serving_instances/{name}")
+async def get_serving_instance(name: str):
+    spec = await run_in_threadpool(serving_reconciler.get, name)
+    if spec is None:
+        raise HTTPException(status_code=404, detail=f"Serving instance {name} not found.")
+    errors = await run_in_threadpool(serving_reconciler.errors, [name])
+    return serving_reconciler.view(name, spec, errors.get(name))
+
+
+# 標記為 deleting，由 reconciler 刪除 Pod / Service / PVC 後移除記錄
+@router.delete("/serving_instances/{name}", status_code=202)
+async def delete_serving_instance(name: str):
+    spec = await run_in_threadpool(serving_reconciler.get, name)
+    if spec is None:
+        raise HTTPException(status_code=404, detail=f"Serving instance {name} not found.")
+    if not spec.get("deleting"):
+        spec["deleting"] = True
+        spec["updated_at"] = datetime.utcnow().isoformat()
+        await run_in_threadpool(store.redis_lock.hset, SERVING_INSTANCES_KEY, name, json.dumps(spec))
+    await run_in_threadpool(serving_reconciler.notify, name)
+    return serving_reconciler.view(name, spec)
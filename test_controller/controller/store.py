@@ -0,0 +1,31 @@
+import redis
+
+
+# Redis 用來實現機器 Lock
+REDIS_HOST = "redis.redis.svc.cluster.local"
+REDIS_PORT = 6379
+redis_lock = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=0, decode_responses=True)
+
+
+##############################################################
+# 共用統計計數 (Redis hash)：所有 replica / worker 累加到同一份，/stats 類 endpoint 不論打到哪個 process 結果都相同
+
+def incr_stats(key: str, counts: dict, pipe=None):
+    """ counts: {field: 增量}；給定 pipe 時只排入 pipeline，由呼叫端 execute """
+    target = pipe if pipe is not None else redis_lock.pipeline(transaction=False)
+    for field, amount in counts.items():
+        if isinstance(amount, float):
+            target.hincrbyfloat(key, field, amount)
+        else:
+            target.hincrby(key, field, amount)
+    if pipe is None:
+        target.execute()
+
+
+def load_stats(key: str, fields) -> dict:
+    values = redis_lock.hmget(key, list(fields))
+    stats = {}
+    for field, value in zip(fields, values):
+        number = float(value) if value else 0
+        stats[field] = int(number) if float(number).is_integer() else number
+    return stats
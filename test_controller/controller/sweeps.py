@@ -0,0 +1,167 @@
+from fastapi import APIRouter, Header, HTTPException
+import os
+from kubernetes import client
+import json
+from typing import Any, Dict, List, Optional
+import re
+import itertools
+from fastapi.concurrency import run_in_threadpool
+from . import kube
+from .kube import k8s_call
+from .informers import job_informer
+from .idempotency import idempotency, resolve_idempotency_key
+from .jobs import build_custom_job, CustomImageJobRequest, delete_config_map, JOB_COMPLETION_INDEX_ANNOTATION, JOB_RESOURCE_ANNOTATION, resolve_job_status, sanitize_job_name
+from .job_queue import job_queue
+
+router = APIRouter()
+
+
+##############################################################
+# Parameter sweep：一組參數清單 / grid 只建立一個 Indexed Job (completionMode: Indexed)
+# 每個 index 的參數放在同一個 ConfigMap，掛載到 /etc/sweep，Pod 依 JOB_COMPLETION_INDEX 讀取自己那份
+# Job 名稱為 sweep-{execution_id} (與單一 Job 的 job-{execution_id} 分開)，每個 trial 的 EXECUTION_ID 為 {sweep_id}-{index}
+
+SWEEP_MAX_INDEXES = int(os.getenv("SWEEP_MAX_INDEXES", "1000"))
+SWEEP_PARAMS_MOUNT_PATH = "/etc/sweep"
+SWEEP_CONFIGMAP_MAX_BYTES = 900 * 1024  # ConfigMap 上限 1MiB，保留一些給 metadata
+SWEEP_ID_MAX_LEN = 52  # Indexed Job 的 Pod hostname 為 {sweep_id}-{index}，需在 63 字元內
+
+
+class SweepJobRequest(CustomImageJobRequest):
+    parameters: List[Dict[str, Any]] = []  # 每個 index 一組 env override
+    grid: Dict[str, List[Any]] = {}  # {"LR": [0.1, 0.01], "BATCH": [32, 64]} 展開成所有組合
+    parallelism: Optional[int] = None  # 同時執行的 index 數，預設全部
+    backoff_limit: Optional[int] = None  # 整個 Job 允許的失敗次數，預設等於 index 數
+    command: Optional[List[str]] = None  # 指定時會先把參數 export 成環境變數再 exec 此 command
+
+
+def sweep_id_of(execution_id: str) -> str:
+    return sanitize_job_name(f"sweep-{execution_id}", SWEEP_ID_MAX_LEN)
+
+
+def expand_sweep_parameters(parameters: list, grid: dict) -> list:
+    """ parameters 與 grid 都有時取兩者的組合 """
+    grid_points = [dict(zip(grid, values)) for values in itertools.product(*grid.values())] if grid else [{}]
+    base = parameters or [{}]
+    return [{**point, **overrides} for overrides in base for point in grid_points]
+
+
+def sweep_env_file(overrides: dict) -> str:
+    lines = []
+    for key, value in overrides.items():
+        if not re.match(r"^[A-Za-z_][A-Za-z0-9_]*$", key):
+            raise HTTPException(status_code=400, detail=f"Invalid env name in sweep parameters: {key}")
+        value = value if isinstance(value, str) else json.dumps(value)
+        lines.append(f"{key}='" + value.replace("'", "'\\''") + "'")
+    return "\n".join(lines) + "\n"
+
+
+# 參數 sweep：單一 Indexed Job + 參數 ConfigMap，同樣經過 admission queue
+@router.post("/job/sweep", status_code=202)
+async def run_sweep_job(req: SweepJobRequest, idempotency_key: Optional[str] = Header(None)):
+    """ 同一個 idempotency key (預設為 dag_id / execution_id) 重送時回傳第一次的結果，不會重複建立 ConfigMap / Job """
+    return await idempotency.run("job_sweep", resolve_idempotency_key(idempotency_key, req), req,
+                                 lambda: submit_sweep_job(req), status_code=202)
+
+
+async def submit_sweep_job(req: SweepJobRequest):
+    namespace = "ml-serving"
+    configs = expand_sweep_parameters(req.parameters, req.grid)
+    if not 1 <= len(configs) <= SWEEP_MAX_INDEXES:
+        raise HTTPException(status_code=400, detail=f"A sweep needs between 1 and {SWEEP_MAX_INDEXES} parameter sets, got {len(configs)}.")
+    completions = len(configs)
+    parallelism = min(req.parallelism or completions, completions)
+    if parallelism < 1:
+        raise HTTPException(status_code=400, detail="parallelism must be at least 1.")
+
+    sweep_id = sweep_id_of(req.execution_id)
+    job_name, job_manifest, demand = build_custom_job(req, namespace, job_name=sweep_id)
+    configmap_name = f"{sweep_id}-params"
+
+    # 參數檔：{index}.env (shell 格式) 與 {index}.json
+    data = {}
+    for index, overrides in enumerate(configs):
+        data[f"{index}.env"] = sweep_env_file(overrides)
+        data[f"{index}.json"] = json.dumps(overrides)
+    if sum(len(key) + len(value) for key, value in data.items()) > SWEEP_CONFIGMAP_MAX_BYTES:
+        raise HTTPException(status_code=400, detail="Sweep parameters are too large for a single ConfigMap.")
+
+    # 同時執行 parallelism 個 Pod，quota 以此計算
+    demand = {**{k: v * parallelism for k, v in demand.items()}, "jobs": 1}
+    job_manifest["metadata"]["annotations"][JOB_RESOURCE_ANNOTATION] = json.dumps(demand)
+    job_queue.check_admissible(namespace, req.dag_id, demand)
+
+    spec = job_manifest["spec"]
+    spec.update({
+        "completionMode": "Indexed",
+        "completions": completions,
+        "parallelism": parallelism,
+        "backoffLimit": req.backoff_limit if req.backoff_limit is not None else completions,
+    })
+    pod_spec = spec["template"]["spec"]
+    pod_spec["volumes"] = [{"name": "sweep-params", "configMap": {"name": configmap_name}}]
+    container = pod_spec["containers"][0]
+    container["volumeMounts"] = [{"name": "sweep-params", "mountPath": SWEEP_PARAMS_MOUNT_PATH, "readOnly": True}]
+    # 每個 trial 各自的 EXECUTION_ID，避免所有 index 寫到同一個 MLflow run / 輸出路徑
+    container["env"] = [env for env in container["env"] if env["name"] != "EXECUTION_ID"] + [
+        {"name": "JOB_COMPLETION_INDEX", "valueFrom": {"fieldRef": {"fieldPath": f"metadata.annotations['{JOB_COMPLETION_INDEX_ANNOTATION}']"}}},
+        {"name": "SWEEP_ID", "value": sweep_id},
+        {"name": "SWEEP_EXECUTION_ID", "value": req.execution_id},
+        {"name": "EXECUTION_ID", "value": f"{sweep_id}-$(JOB_COMPLETION_INDEX)"},
+        {"name": "SWEEP_PARAMS_FILE", "value": f"{SWEEP_PARAMS_MOUNT_PATH}/$(JOB_COMPLETION_INDEX).json"},
+        {"name": "SWEEP_PARAMS_ENV_FILE", "value": f"{SWEEP_PARAMS_MOUNT_PATH}/$(JOB_COMPLETION_INDEX).env"},
+    ]
+    if req.command:
+        # 先把該 index 的參數 export 成環境變數，再執行原本的 command
+        container["command"] = ["/bin/sh", "-c", 'set -a; . "$SWEEP_PARAMS_ENV_FILE"; set +a; exec "$@"', "sweep"] + req.command
+
+    if job_informer.get(job_name) is not None:
+        raise HTTPException(status_code=409, detail=f"Job {job_name} already exists.")
+    configmap = {
+        "apiVersion": "v1",
+        "kind": "ConfigMap",
+        "metadata": {"name": configmap_name, "namespace": namespace, "labels": dict(job_manifest["metadata"]["labels"])},
+        "data": data,
+    }
+    try:
+        await k8s_call(kube.v1.create_namespaced_config_map, namespace=namespace, body=configmap)
+    except client.exceptions.ApiException as e:
+        if e.status == 409:
+            raise HTTPException(status_code=409, detail=f"Sweep {job_name} already exists.")
+        raise HTTPException(status_code=500, detail=f"Create sweep parameters failed: {e.reason}")
+
+    try:
+        position = await run_in_threadpool(job_queue.enqueue, job_name, namespace, req.dag_id, job_manifest, demand, configmap_name)
+    except Exception:
+        await delete_config_map(configmap_name)
+        raise
+    if position is None:
+        await delete_config_map(configmap_name)
+        raise HTTPException(status_code=409, detail=f"Job {job_name} is already queued.")
+
+    job_queue.kick()
+    return {
+        "status": "queued",
+        "position": position,
+        "sweep_id": sweep_id,
+        "job_name": job_name,
+        "indexes": completions,
+        "parallelism": parallelism,
+        "parameters_configmap": configmap_name,
+        "resources": demand,
+        "status_url": f"/job/{job_name}/sweep",
+        "wait_url": f"/job/{job_name}/wait",
+    }
+
+
+# 每個 index 的狀態 (Job 已被 TTL 刪除時回傳保存的最終狀態)
+@router.get("/job/{job_name}/sweep")
+async def get_sweep_status(job_name: str):
+    status = await resolve_job_status(job_name)
+    if status is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_name} not found.")
+    if status["state"] == "queued":
+        return status
+    if "indexes" not in status:
+        raise HTTPException(status_code=400, detail=f"Job {job_name} is not a sweep.")
+    return status
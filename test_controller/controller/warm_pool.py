@@ -0,0 +1,325 @@
+from fastapi import APIRouter, HTTPException
+import os
+from kubernetes import client
+import time
+import json
+from pydantic import BaseModel
+import hashlib
+import threading
+import random
+from . import kube, store
+from .observability import logger, PROVISION_SECONDS, WARM_POOL_REQUESTS
+from .kube import k8s_request
+from .coordination import coordinator
+from .informers import DAG_LABEL, pod_image_ref, pod_informer, sanitize_label_value, service_informer
+from .images import image_tag
+from .provisioning import build_serving_pod_plan, delete_serving_resources, pod_ready_predicate, provision_serving_pod_sync, serving_pod_response
+
+router = APIRouter()
+
+
+##############################################################
+# Warm pool：依 (image_name, image_tag, export_port) 預先建立 PVC + Pod + Service
+
+WARM_POOL_CONFIG = os.getenv("WARM_POOL_CONFIG", "[]")  # e.g. [{"image_name": "moa_ncu/xxx", "image_tag": "v1", "export_port": 8000, "size": 2}]
+WARM_POOL_MAX_TOTAL = int(os.getenv("WARM_POOL_MAX_TOTAL", "20"))
+WARM_POOL_MAX_SIZE_PER_KEY = int(os.getenv("WARM_POOL_MAX_SIZE_PER_KEY", "5"))
+WARM_POOL_IDLE_TTL = int(os.getenv("WARM_POOL_IDLE_TTL", "1800"))
+WARM_POOL_REFILL_INTERVAL = int(os.getenv("WARM_POOL_REFILL_INTERVAL", "5"))
+WARM_POOL_SIZES_KEY = "warm_pool_sizes"  # hash：warm-pool-key label -> {"image_name", "image_tag", "export_port", "size"}
+WARM_POOL_LAST_USED_KEY = "warm_pool_last_used"  # hash：warm-pool-key label -> 最後一次被請求的時間
+WARM_POOL_STATS_KEY = "warm_pool_stats"  # hash：hits / misses / provisioned / provision_failures / evicted (所有 replica 累計)
+WARM_POOL_STATS_FIELDS = ("hits", "misses", "provisioned", "provision_failures", "evicted")
+
+
+class WarmPoolRequest(BaseModel):
+    image_name: str
+    image_tag: str
+    export_port: int
+    size: int
+
+
+def warm_pool_key_label(image_name: str, image_tag: str, export_port: int) -> str:
+    return hashlib.sha1(f"{image_name}:{image_tag}:{export_port}".encode()).hexdigest()[:10]
+
+
+def warm_pool_pod_keys(pod) -> list:
+    labels = pod.metadata.labels or {}
+    return [labels["warm-pool-key"]] if labels.get("warm-pool") == "idle" and labels.get("warm-pool-key") else []
+
+
+def warm_pod_plan(pod, export_port: int) -> dict:
+    return {
+        "pod_name": pod.metadata.name,
+        "pvc_name": f"{pod.metadata.name}-pvc",
+        "service_name": f"{pod.metadata.name}-svc",
+        "full_image_name": pod_image_ref(pod),
+        "export_port": export_port,
+    }
+
+
+pod_informer.add_index("warm_pool", warm_pool_pod_keys)
+
+
+class WarmPool:
+    """
+    預熱池 (所有 replica 共用同一份狀態)：
+    1. 每個 key 的 size 與最後使用時間存在 Redis；idle 的 warm Pod 直接從 pod informer (warm-pool=idle label) 取得
+    2. /create_pod 命中時以帶 resourceVersion 的 patch 把 Pod 標成 assigned，多個 replica 搶同一個 Pod 時只有一個會成功
+    3. 只有 leader 補充與回收：依設定維持每個 key 有 N 組 PVC + Pod + Service，
+       超過 WARM_POOL_IDLE_TTL 沒被取用的 key 整組回收，直到再次有人請求
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._static = {}  # WARM_POOL_CONFIG 設定的 key -> size (Redis 中的設定優先)
+        self._pools = {}  # key -> {"size": N, "last_used": ts}
+        self._in_flight = {}  # key -> {pod_name}：這個 process 正在建立的 warm Pod
+        for item in json.loads(WARM_POOL_CONFIG):
+            key = (item["image_name"], item["image_tag"], int(item["export_port"]))
+            self._static[key] = max(0, min(int(item["size"]), WARM_POOL_MAX_SIZE_PER_KEY))
+            self._pools[key] = {"size": self._static[key], "last_used": time.time()}
+
+    def configure(self, image_name: str, image_tag: str, export_port: int, size: int):
+        size = max(0, min(size, WARM_POOL_MAX_SIZE_PER_KEY))
+        key = (image_name, image_tag, export_port)
+        label = warm_pool_key_label(*key)
+        now = time.time()
+        pipe = store.redis_lock.pipeline(transaction=False)
+        pipe.hset(WARM_POOL_SIZES_KEY, label, json.dumps({"image_name": image_name, "image_tag": image_tag,
+                                                         "export_port": export_port, "size": size}))
+        pipe.hset(WARM_POOL_LAST_USED_KEY, label, now)
+        pipe.execute()
+        with self._lock:
+            self._pools[key] = {"size": size, "last_used": now}
+        self._wakeup.set()
+        return size
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="warm-pool", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+
+    def on_pod_event(self, event_type: str, pod):
+        # warm Pod 被取走 / Ready / 刪除時，leader 立即檢查是否需要補充
+        if (pod.metadata.labels or {}).get("warm-pool-key") and coordinator.is_leader():
+            self._wakeup.set()
+
+    @staticmethod
+    def _available(pod, export_port: int) -> bool:
+        # Service 是 provisioning 最後一步，有 Service 才代表整組建立完成
+        return pod.metadata.deletion_timestamp is None and pod_ready_predicate(export_port)(pod) \
+            and service_informer.get(f"{pod.metadata.name}-svc") is not None
+
+    def acquire(self, image_name: str, image_tag: str, export_port: int, dag_id: str = None):
+        """ 命中時回傳 create_pod 格式的 response，否則回傳 None """
+        start = time.perf_counter()
+        key = (image_name, image_tag, export_port)
+        with self._lock:
+            configured = key in self._pools
+        if not configured:
+            self._record_lookup("unconfigured")
+            return None
+        label = warm_pool_key_label(*key)
+        # 記下使用時間：dormant 的 key 會在 leader 下一輪重新補充
+        store.redis_lock.hset(WARM_POOL_LAST_USED_KEY, label, time.time())
+        candidates = [pod for pod in pod_informer.by_index("warm_pool", label) if self._available(pod, export_port)]
+        random.shuffle(candidates)  # 降低多個 replica 同時搶同一個 Pod 的機率
+        labels = {"warm-pool": "assigned"}
+        if dag_id:
+            labels[DAG_LABEL] = sanitize_label_value(dag_id)
+        for pod in candidates:
+            try:
+                k8s_request(
+                    kube.v1.patch_namespaced_pod,
+                    name=pod.metadata.name, namespace="ml-serving",
+                    body={"metadata": {"labels": labels, "resourceVersion": pod.metadata.resource_version}}
+                )
+            except client.exceptions.ApiException as e:
+                if e.status in (404, 409):
+                    continue  # 已被其他 replica 取走或刪除
+                logger.error("Failed to hand out warm pod", extra={"pod_name": pod.metadata.name, "status": e.status})
+                self._discard(pod.metadata.name)
+                break
+            self._record_lookup("hit")
+            PROVISION_SECONDS.labels("warm", "succeeded").observe(time.perf_counter() - start)
+            response = serving_pod_response(warm_pod_plan(pod, export_port), pod.status.pod_ip)
+            response["warm_pool"] = True
+            return response
+        self._record_lookup("miss")
+        return None
+
+    @staticmethod
+    def _record_lookup(result: str):
+        # Redis 的 hits / misses 給 /warm_pool 的快照 (所有 worker 共用)，Prometheus counter 給 hit rate 的告警與圖表
+        WARM_POOL_REQUESTS.labels(result).inc()
+        store.incr_stats(WARM_POOL_STATS_KEY, {"hits" if result == "hit" else "misses": 1})
+
+    def snapshot(self):
+        self._load()
+        now = time.time()
+        with self._lock:
+            pools = {key: dict(pool) for key, pool in self._pools.items()}
+            in_flight = {key: set(names) for key, names in self._in_flight.items()}
+        stats = store.load_stats(WARM_POOL_STATS_KEY, WARM_POOL_STATS_FIELDS)
+        items = []
+        for key, pool in pools.items():
+            pods = pod_informer.by_index("warm_pool", warm_pool_key_label(*key))
+            ready = sum(1 for pod in pods if self._available(pod, key[2]))
+            items.append({
+                "image_name": key[0], "image_tag": key[1], "export_port": key[2],
+                "size": pool["size"], "ready": ready,
+                "in_flight": len({pod.metadata.name for pod in pods} | in_flight.get(key, set())) - ready,
+                "dormant": now - pool["last_used"] >= WARM_POOL_IDLE_TTL,
+                "idle_seconds": int(now - pool["last_used"]),
+            })
+        total = stats["hits"] + stats["misses"]
+        return {
+            **stats,
+            "hit_rate": (stats["hits"] / total) if total else 0.0,
+            "max_total": WARM_POOL_MAX_TOTAL,
+            "leader": coordinator.is_leader(),
+            "pools": items,
+        }
+
+    def _load(self):
+        """ 從 Redis 讀取所有 replica 共用的 size 與最後使用時間 """
+        pipe = store.redis_lock.pipeline(transaction=False)
+        pipe.hgetall(WARM_POOL_SIZES_KEY)
+        pipe.hgetall(WARM_POOL_LAST_USED_KEY)
+        sizes, last_used = pipe.execute()
+        configured = dict(self._static)
+        for value in sizes.values():
+            item = json.loads(value)
+            configured[(item["image_name"], item["image_tag"], int(item["export_port"]))] = int(item["size"])
+        with self._lock:
+            for key, size in configured.items():
+                pool = self._pools.setdefault(key, {"size": size, "last_used": time.time()})
+                pool["size"] = size
+                shared = last_used.get(warm_pool_key_label(*key))
+                if shared is not None:
+                    pool["last_used"] = max(pool["last_used"], float(shared))
+
+    def _run(self):
+        while not (pod_informer.has_synced() and service_informer.has_synced()) and not self._stop.is_set():
+            time.sleep(1)
+        while not self._stop.is_set():
+            try:
+                self._load()
+                if coordinator.is_leader():
+                    idle = self._idle_pods()
+                    self._evict_idle(idle)
+                    self._refill(idle)
+            except Exception:
+                logger.exception("Warm pool refill error")
+            self._wakeup.wait(timeout=WARM_POOL_REFILL_INTERVAL)
+            self._wakeup.clear()
+
+    def _idle_pods(self) -> dict:
+        """ warm-pool-key label -> 尚未被取走的 warm Pod (含建立中) """
+        idle = {}
+        for pod in pod_informer.list():
+            for label in warm_pool_pod_keys(pod):
+                if pod.metadata.deletion_timestamp is None:
+                    idle.setdefault(label, []).append(pod)
+        return idle
+
+    def _evict_idle(self, idle: dict):
+        now = time.time()
+        with self._lock:
+            pools = {warm_pool_key_label(*key): (key, dict(pool)) for key, pool in self._pools.items()}
+        evicted = []
+        for label, pods in idle.items():
+            key, pool = pools.get(label, (None, None))
+            # 未設定的 key (例如設定被移除) 與閒置超過 TTL 的 key 全部回收；縮小 size 時回收多出來的部分
+            keep = pool["size"] if pool is not None and now - pool["last_used"] < WARM_POOL_IDLE_TTL else 0
+            # 只回收已建立完成的 Pod，建立中的等下一輪再判斷
+            ready = [pod for pod in pods if self._available(pod, key[2])] if key else pods
+            evicted.extend(ready[:max(len(pods) - keep, 0)])
+        if evicted:
+            store.incr_stats(WARM_POOL_STATS_KEY, {"evicted": len(evicted)})
+        for pod in evicted:
+            self._discard(pod.metadata.name)
+
+    def _refill(self, idle: dict):
+        now = time.time()
+        targets = []
+        with self._lock:
+            present = {
+                key: {pod.metadata.name for pod in idle.get(warm_pool_key_label(*key), [])} | self._in_flight.get(key, set())
+                for key in self._pools
+            }
+            total = sum(len(names) for names in present.values())
+            for key, pool in self._pools.items():
+                if now - pool["last_used"] >= WARM_POOL_IDLE_TTL:
+                    continue  # dormant
+                missing = min(pool["size"] - len(present[key]), WARM_POOL_MAX_TOTAL - total)
+                if missing > 0:
+                    targets.extend([key] * missing)
+                    total += missing
+        for key in targets:
+            plan = build_serving_pod_plan(*key)
+            plan["pod_manifest"]["metadata"]["labels"].update({
+                "warm-pool": "idle",
+                "warm-pool-key": warm_pool_key_label(*key),
+            })
+            with self._lock:
+                self._in_flight.setdefault(key, set()).add(plan["pod_name"])
+            threading.Thread(target=self._provision, args=(key, plan), daemon=True).start()
+
+    def _provision(self, key, plan: dict):
+        image_name, image_tag, _ = key
+        try:
+            provision_serving_pod_sync(plan)
+        except Exception as e:
+            logger.error("Warm pool provisioning failed", extra={"image_name": image_name, "image_tag": image_tag, "error": str(e)})
+            store.incr_stats(WARM_POOL_STATS_KEY, {"provision_failures": 1})
+            self._discard(plan["pod_name"])
+        else:
+            store.incr_stats(WARM_POOL_STATS_KEY, {"provisioned": 1})
+        finally:
+            with self._lock:
+                self._in_flight[key].discard(plan["pod_name"])
+        self._wakeup.set()
+
+    def _discard(self, pod_name: str):
+        try:
+            delete_serving_resources(pod_name)
+        except Exception as e:
+            logger.error("Failed to discard warm pod", extra={"pod_name": pod_name, "error": str(e)})
+
+
+warm_pool = WarmPool()
+pod_informer.add_handler(warm_pool.on_pod_event)
+
+
+def start_warm_pool():
+    warm_pool.start()
+
+
+def stop_warm_pool():
+    warm_pool.stop()
+
+
+# 設定某組 image 的 warm pool 大小 (size=0 表示停用)
+@router.put("/warm_pool")
+def configure_warm_pool(request: WarmPoolRequest):
+    if not request.image_name or ":" in request.image_name:
+        raise HTTPException(status_code=400, detail="Invalid Image Name.")
+    size = warm_pool.configure(request.image_name, request.image_tag, request.export_port, request.size)
+    return {"message": "Warm pool configured", "image_name": request.image_name, "image_tag": request.image_tag,
+            "export_port": request.export_port, "size": size}
+
+
+@router.get("/warm_pool/stats")
+def warm_pool_stats():
+    return warm_pool.snapshot()
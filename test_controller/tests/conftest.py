@@ -0,0 +1,35 @@
+import os
+import sys
+import threading
+
+import fakeredis
+import pytest
+
+# 在 import controller 之前設定，避免測試輸出被 log 蓋過
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from controller import store  # noqa: E402
+
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    """ 以 fakeredis (含 Lua) 取代 store.redis_lock，Lua script 照常在 Redis 端執行 """
+    client = fakeredis.FakeRedis(decode_responses=True)
+    monkeypatch.setattr(store, "redis_lock", client)
+    return client
+
+
+@pytest.fixture
+def informer_cache(monkeypatch):
+    """ 回傳 load(informer, *objs)：直接填入 informer 快取與 index (不啟動 watch)，測試結束後還原 """
+    def load(informer, *objs):
+        monkeypatch.setattr(informer, "_store", {obj.metadata.name: obj for obj in objs})
+        monkeypatch.setattr(informer, "_indices", {index_name: {} for index_name in informer._indexers})
+        monkeypatch.setattr(informer, "_synced", threading.Event())
+        informer._synced.set()
+        for index_name in informer._indexers:
+            for obj in objs:
+                informer._index_object(index_name, obj.metadata.name, obj)
+
+    return load
@@ -0,0 +1,77 @@
+import asyncio
+import threading
+import time
+
+from controller import consul
+from controller.consul import ConsulCatalogCache, normalize_consul_health_entry
+
+
+def health_entry(service_id, status="passing"):
+    return {
+        "Service": {"ID": service_id, "Address": "", "Port": 8080, "Meta": {"load": "0.5"}},
+        "Node": {"Node": "node-1", "Address": "10.0.0.1"},
+        "Checks": [{"Status": "passing"}, {"Status": status}],
+    }
+
+
+class StubResponse:
+    status_code = 200
+
+    def __init__(self, entries, index):
+        self._entries = entries
+        self.headers = {"X-Consul-Index": str(index)}
+
+    def json(self):
+        return self._entries
+
+
+class StubConsul:
+    """ index=0 立即回應；blocking query 等到 publish() 才回應新版本 """
+
+    def __init__(self, entries):
+        self.entries = entries
+        self.index = 1
+        self.requests = []
+        self._changed = threading.Condition()
+
+    def publish(self, entries):
+        with self._changed:
+            self.entries = entries
+            self.index += 1
+            self._changed.notify_all()
+
+    def get(self, url, params=None, timeout=None):
+        self.requests.append(params["index"])
+        with self._changed:
+            self._changed.wait_for(lambda: self.index > params["index"], timeout=0.2)
+            return StubResponse(self.entries, self.index)
+
+
+def test_normalize_marks_instance_unhealthy_when_any_check_fails():
+    assert normalize_consul_health_entry(health_entry("a")) == {
+        "ServiceID": "a", "ServiceAddress": "10.0.0.1", "ServicePort": 8080, "ServiceMeta": {"load": "0.5"},
+        "ServiceWeights": {}, "Node": "node-1", "Healthy": True,
+    }
+    assert normalize_consul_health_entry(health_entry("a", status="critical"))["Healthy"] is False
+
+
+def test_catalog_is_served_from_cache_and_follows_blocking_queries(monkeypatch):
+    stub = StubConsul([health_entry("a")])
+    monkeypatch.setattr(consul.requests, "Session", lambda: stub)
+    cache = ConsulCatalogCache("http://stub-consul")
+    try:
+        assert [item["ServiceID"] for item in cache.get("svc")] == ["a"]
+        assert [item["ServiceID"] for item in asyncio.run(cache.aget("svc"))] == ["a"]
+        assert (cache.stats["misses"], cache.stats["hits"]) == (1, 1)
+
+        stub.publish([health_entry("a"), health_entry("b")])
+        deadline = time.time() + 2
+        while len(cache.cached("svc")) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+
+        assert [item["ServiceID"] for item in cache.cached("svc")] == ["a", "b"]
+        # 第一次之後都是帶著上一次 X-Consul-Index 的 blocking query
+        assert stub.requests[0] == 0 and set(stub.requests[1:]) <= {1, 2}
+        assert cache.snapshot()["services"]["svc"]["instances"] == 2
+    finally:
+        cache.stop()
@@ -0,0 +1,67 @@
+from controller import coordination
+from controller.coordination import LEADER_KEY, REPLICAS_KEY, ReplicaCoordinator
+
+
+def acquire(fake_redis, replica_id, lease_ms=15000):
+    return coordination.acquire_leader_script(keys=[LEADER_KEY], args=[replica_id, lease_ms], client=fake_redis)
+
+
+def release(fake_redis, replica_id):
+    return coordination.release_leader_script(keys=[LEADER_KEY], args=[replica_id], client=fake_redis)
+
+
+def test_acquire_script_grants_lease_to_a_single_holder(fake_redis):
+    assert acquire(fake_redis, "replica-a") == 1
+    assert acquire(fake_redis, "replica-b") == 0
+    assert fake_redis.get(LEADER_KEY) == "replica-a"
+    assert 0 < fake_redis.pttl(LEADER_KEY) <= 15000
+
+
+def test_holder_renews_its_lease(fake_redis):
+    acquire(fake_redis, "replica-a", lease_ms=1000)
+    assert acquire(fake_redis, "replica-a", lease_ms=60000) == 1
+    assert fake_redis.pttl(LEADER_KEY) > 1000
+
+
+def test_only_holder_can_release(fake_redis):
+    acquire(fake_redis, "replica-a")
+    assert release(fake_redis, "replica-b") == 0
+    assert fake_redis.get(LEADER_KEY) == "replica-a"
+    assert release(fake_redis, "replica-a") == 1
+    assert acquire(fake_redis, "replica-b") == 1
+
+
+def heartbeat(monkeypatch, coordinator, replica_id):
+    monkeypatch.setattr(coordination, "REPLICA_ID", replica_id)
+    coordinator._heartbeat()
+
+
+def test_leadership_moves_to_next_replica_after_stop(fake_redis, monkeypatch):
+    a, b = ReplicaCoordinator(), ReplicaCoordinator()
+    changes = []
+    b.listeners.append(lambda: changes.append(b.is_leader()))
+
+    heartbeat(monkeypatch, a, "replica-a")
+    heartbeat(monkeypatch, b, "replica-b")
+    assert a.is_leader() and not b.is_leader()
+    assert b.members == ["replica-a", "replica-b"]
+    assert fake_redis.zcard(REPLICAS_KEY) == 2
+
+    monkeypatch.setattr(coordination, "REPLICA_ID", "replica-a")
+    a.stop()
+    assert not a.is_leader()
+    assert fake_redis.get(LEADER_KEY) is None
+
+    heartbeat(monkeypatch, b, "replica-b")
+    assert b.is_leader()
+    assert b.members == ["replica-b"]
+    assert changes == [False, True]
+
+
+def test_owner_of_splits_names_across_members():
+    coordinator = ReplicaCoordinator()
+    assert coordinator.owner_of("instance") is None
+    coordinator.members = ["replica-a", "replica-b"]
+    owners = {coordinator.owner_of(f"instance-{i}") for i in range(50)}
+    assert owners == {"replica-a", "replica-b"}
+    assert coordinator.owner_of("instance-1") == coordinator.owner_of("instance-1")
@@ -0,0 +1,118 @@
+import asyncio
+import json
+
+import pytest
+from fastapi import HTTPException
+from pydantic import BaseModel
+
+from controller import idempotency as idempotency_module
+from controller.idempotency import IdempotencyStore
+
+
+class CreateRequest(BaseModel):
+    image_name: str
+    idempotency_key: str = None
+
+
+def run_twice(store, first_request, second_request, handler):
+    async def _run():
+        first = await store.run("scope", "key-1", first_request, handler)
+        second = await store.run("scope", "key-1", second_request, handler)
+        return first, second
+    return asyncio.run(_run())
+
+
+def test_claim_script_returns_current_record_unless_failed(fake_redis):
+    store = IdempotencyStore()
+    owner, record = store.claim("idempotency:k", "fp", {})
+    assert owner is not None and record["state"] == "in_flight"
+    assert 0 < fake_redis.ttl("idempotency:k") <= idempotency_module.IDEMPOTENCY_IN_FLIGHT_TTL
+
+    assert store.claim("idempotency:k", "fp", {}) == (None, record)
+
+    store.complete("idempotency:k", owner, "fp", 500, "boom")
+    retry_owner, retry_record = store.claim("idempotency:k", "fp", {})
+    assert retry_owner not in (None, owner)
+    assert retry_record["state"] == "in_flight"
+
+
+def test_complete_script_ignores_stale_owner(fake_redis):
+    store = IdempotencyStore()
+    owner, _ = store.claim("idempotency:k", "fp", {})
+    store.complete("idempotency:k", owner, "fp", 500, "boom")
+    new_owner, _ = store.claim("idempotency:k", "fp", {})
+
+    # 舊的 owner 晚到的結果不能覆蓋新一輪的執行
+    store.complete("idempotency:k", owner, "fp", 200, {"stale": True})
+    assert store.get("idempotency:k")["owner"] == new_owner
+    assert store.get("idempotency:k")["state"] == "in_flight"
+
+    store.complete("idempotency:k", new_owner, "fp", 200, {"ok": True})
+    record = store.get("idempotency:k")
+    assert (record["state"], record["body"]) == ("succeeded", {"ok": True})
+    assert fake_redis.ttl("idempotency:k") > idempotency_module.IDEMPOTENCY_IN_FLIGHT_TTL
+
+
+def test_completed_request_is_replayed(fake_redis):
+    calls = []
+
+    async def handler():
+        calls.append(1)
+        return {"pod_name": "mlpod-1"}
+
+    request = CreateRequest(image_name="moa_ncu/x")
+    first, second = run_twice(IdempotencyStore(), request, request, handler)
+
+    assert first == {"pod_name": "mlpod-1"}
+    assert len(calls) == 1
+    assert second.headers["Idempotent-Replayed"] == "true"
+    assert json.loads(second.body) == {"pod_name": "mlpod-1"}
+
+
+def test_key_reused_with_different_body_is_rejected(fake_redis):
+    async def handler():
+        return {"pod_name": "mlpod-1"}
+
+    with pytest.raises(HTTPException) as excinfo:
+        run_twice(IdempotencyStore(), CreateRequest(image_name="moa_ncu/x"), CreateRequest(image_name="moa_ncu/y"), handler)
+    assert excinfo.value.status_code == 422
+
+
+def test_failed_request_is_executed_again(fake_redis):
+    outcomes = [HTTPException(status_code=503, detail="unavailable"), {"pod_name": "mlpod-2"}]
+
+    async def handler():
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    store = IdempotencyStore()
+    request = CreateRequest(image_name="moa_ncu/x")
+    with pytest.raises(HTTPException) as excinfo:
+        asyncio.run(store.run("scope", "key-1", request, handler))
+    assert excinfo.value.status_code == 503
+    assert store.get(store.redis_key("scope", "key-1"))["state"] == "failed"
+
+    assert asyncio.run(store.run("scope", "key-1", request, handler)) == {"pod_name": "mlpod-2"}
+    assert outcomes == []
+
+
+def test_concurrent_requests_share_one_execution(fake_redis):
+    calls = []
+
+    async def handler():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return {"pod_name": "mlpod-1"}
+
+    async def _run():
+        store = IdempotencyStore()
+        request = CreateRequest(image_name="moa_ncu/x")
+        return await asyncio.gather(*(store.run("scope", "key-1", request, handler) for _ in range(3)))
+
+    results = asyncio.run(_run())
+
+    assert len(calls) == 1
+    assert results[0] == {"pod_name": "mlpod-1"}
+    assert all(json.loads(result.body) == {"pod_name": "mlpod-1"} for result in results[1:])
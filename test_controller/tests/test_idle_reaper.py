@@ -0,0 +1,89 @@
+import json
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from kubernetes import client
+
+from controller import consul, idle_reaper as idle_reaper_module, kube
+from controller.idle_reaper import IDLE_REAPER_OPT_OUT_LABEL, IdleReaper, SCALED_TO_ZERO_KEY
+from controller.informers import DAG_LABEL, pod_informer, ROLE_LABEL
+from controller.leases import instance_lock_key, LEASE_INFO_KEY
+from controller.provisioning import POD_ACTIVITY_KEY
+
+CREATED = datetime.now(timezone.utc) - timedelta(days=1)
+
+
+def make_pod(name, role="serving", labels=None, phase="Running", pod_ip="10.0.0.1", gpus=1):
+    return client.V1Pod(
+        metadata=client.V1ObjectMeta(name=name, creation_timestamp=CREATED, labels={ROLE_LABEL: role, DAG_LABEL: "dag-1", **(labels or {})}),
+        spec=client.V1PodSpec(containers=[client.V1Container(
+            name="serving", image="harbor.pdc.tw/moa_ncu/x:v1", ports=[client.V1ContainerPort(container_port=8000)],
+            resources=client.V1ResourceRequirements(limits={"nvidia.com/gpu": str(gpus)}),
+        )]),
+        status=client.V1PodStatus(phase=phase, pod_ip=pod_ip),
+    )
+
+
+class FakeCatalog:
+    def cached(self, service_name):
+        return [{"ServiceID": "leased-instance", "ServiceAddress": "10.0.0.9"}] if service_name == "svc" else []
+
+
+class FakeCoreV1:
+    def __init__(self):
+        self.deleted = []
+
+    def delete_namespaced_pod(self, name, namespace, propagation_policy):
+        self.deleted.append(name)
+
+
+@pytest.fixture
+def reaper(monkeypatch, fake_redis, informer_cache):
+    deleted = []
+    fake = FakeCoreV1()
+    monkeypatch.setattr(idle_reaper_module, "delete_serving_resources", deleted.append)
+    monkeypatch.setattr(consul, "consul_catalog", FakeCatalog())
+    monkeypatch.setattr(kube, "v1", fake)
+    idle = time.time() - idle_reaper_module.IDLE_POD_TTL - 60
+    informer_cache(
+        pod_informer,
+        make_pod("mlpod-idle"),
+        make_pod("mlpod-active"),
+        make_pod("mlpod-never-reported"),
+        make_pod("mlpod-opted-out", labels={IDLE_REAPER_OPT_OUT_LABEL: "disabled"}),
+        make_pod("mlpod-leased", pod_ip="10.0.0.9"),
+        make_pod("task-running", role="task", labels={"app": "task-pod"}),
+        make_pod("task-done", role="task", labels={"app": "task-pod"}, phase="Succeeded"),
+    )
+    fake_redis.zadd(POD_ACTIVITY_KEY, {
+        "mlpod-idle": idle, "mlpod-active": time.time(), "mlpod-opted-out": idle, "mlpod-leased": idle,
+        "task-running": idle, "task-done": idle,
+    })
+    fake_redis.hset(LEASE_INFO_KEY, instance_lock_key("leased-instance"), "dag-1|1|svc|0")
+    return IdleReaper(), deleted, fake
+
+
+def test_reap_only_idle_unleased_pods(reaper, fake_redis):
+    idle_reaper, deleted, fake = reaper
+
+    assert idle_reaper.reap() == 2
+    assert deleted == ["mlpod-idle"]
+    assert fake.deleted == ["task-done"]
+    assert fake_redis.zscore(POD_ACTIVITY_KEY, "mlpod-idle") is None
+    assert fake_redis.zscore(POD_ACTIVITY_KEY, "mlpod-leased") is not None
+
+
+def test_scaled_to_zero_spec_can_be_woken(reaper, fake_redis):
+    idle_reaper, _, _ = reaper
+    idle_reaper.reap()
+
+    spec = idle_reaper.scaled_to_zero("mlpod-idle")
+    assert (spec["image_name"], spec["image_tag"], spec["export_port"], spec["dag_id"], spec["gpus"]) == \
+        ("moa_ncu/x", "v1", 8000, "dag-1", 1)
+
+    idle_reaper.mark_woken("mlpod-idle", spec)
+    assert not fake_redis.hexists(SCALED_TO_ZERO_KEY, "mlpod-idle")
+    snapshot = idle_reaper.snapshot()
+    assert snapshot["reaped"] == 2 and snapshot["scaled_to_zero"] == []
+    assert json.loads(fake_redis.lindex(idle_reaper_module.IDLE_REAPER_HISTORY_KEY, 0))["pod_name"] == "mlpod-idle"
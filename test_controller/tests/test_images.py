@@ -0,0 +1,86 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+from kubernetes import client
+
+from controller import images, kube
+from controller.images import ImagePrePuller, PREPULLED_AT_KEY, resolve_image
+from controller.informers import node_informer
+
+IMAGE = "harbor.pdc.tw/moa_ncu/x:v1"
+LATEST = "harbor.pdc.tw/moa_ncu/x:latest"
+
+
+def make_node(name, *entries, labels=None):
+    return client.V1Node(
+        metadata=client.V1ObjectMeta(name=name, labels=labels or {"gpu-node": "true"}),
+        status=client.V1NodeStatus(images=[client.V1ContainerImage(names=list(names)) for names in entries]),
+    )
+
+
+def digest(image, value):
+    return f"{image.rsplit(':', 1)[0]}@sha256:{value * 64}"
+
+
+class FakeAppsV1:
+    def __init__(self):
+        self.deleted = []
+
+    def create_namespaced_daemon_set(self, namespace, body):
+        pass
+
+    def read_namespaced_daemon_set_status(self, name, namespace):
+        return SimpleNamespace(status=SimpleNamespace(desired_number_scheduled=2, number_ready=1))
+
+    def delete_namespaced_daemon_set(self, name, namespace):
+        self.deleted.append(name)
+
+
+@pytest.fixture
+def nodes(informer_cache, fake_redis, monkeypatch):
+    monkeypatch.setattr(images.image_prepuller, "pulled_at", {})
+
+    def load(*items):
+        informer_cache(node_informer, *items)
+    return load
+
+
+def test_image_is_pinned_to_digest_when_every_node_agrees(nodes):
+    nodes(make_node("n1", [IMAGE, digest(IMAGE, "a")]), make_node("n2", [IMAGE, digest(IMAGE, "a")]))
+
+    assert resolve_image(IMAGE) == (digest(IMAGE, "a"), "IfNotPresent")
+
+
+def test_image_keeps_tag_when_digests_differ_or_image_is_unknown(nodes):
+    nodes(make_node("n1", [IMAGE, digest(IMAGE, "a")]), make_node("n2", [IMAGE, digest(IMAGE, "b")]))
+
+    assert resolve_image(IMAGE) == (IMAGE, "Always")
+    assert resolve_image("harbor.pdc.tw/moa_ncu/other:v1") == ("harbor.pdc.tw/moa_ncu/other:v1", "Always")
+
+
+def test_mutable_tag_is_pinned_only_after_a_recent_prepull(nodes):
+    nodes(make_node("n1", [LATEST, digest(LATEST, "c")]))
+    assert resolve_image(LATEST) == (LATEST, "Always")
+
+    images.image_prepuller.pulled_at[LATEST] = time.time()
+    assert resolve_image(LATEST) == (digest(LATEST, "c"), "IfNotPresent")
+
+
+def test_run_finishes_when_every_target_node_reports_the_image(nodes, fake_redis, monkeypatch):
+    apps = FakeAppsV1()
+    monkeypatch.setattr(kube, "apps_v1", apps)
+    nodes(make_node("n1", [IMAGE]), make_node("n2"), make_node("cpu", labels={"gpu-node": "false"}))
+    prepuller = ImagePrePuller()
+    run = prepuller.request([IMAGE], {"gpu-node": "true"})
+    assert prepuller.missing_nodes(IMAGE, {"gpu-node": "true"}) == ["n2"]
+
+    prepuller._check_runs()
+    assert prepuller.get_run(run["name"])["state"] == "running"
+
+    nodes(make_node("n1", [IMAGE]), make_node("n2", [IMAGE]))
+    prepuller._check_runs()
+
+    assert prepuller.get_run(run["name"])["state"] == "succeeded"
+    assert apps.deleted == [run["name"]]
+    assert fake_redis.hexists(PREPULLED_AT_KEY, IMAGE)
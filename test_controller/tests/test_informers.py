@@ -0,0 +1,68 @@
+import asyncio
+import threading
+from types import SimpleNamespace
+
+from controller.informers import ResourceInformer
+from controller.provisioning import pod_ready_predicate
+
+
+def make_pod(name, phase="Pending", pod_ip=None, port=8000, image="harbor.pdc.tw/moa_ncu/x:v1"):
+    return SimpleNamespace(
+        metadata=SimpleNamespace(name=name),
+        spec=SimpleNamespace(node_name=None, containers=[SimpleNamespace(image=image, ports=[SimpleNamespace(container_port=port)])]),
+        status=SimpleNamespace(phase=phase, pod_ip=pod_ip),
+    )
+
+
+def make_informer(*pods):
+    informer = ResourceInformer("pod-test", lambda: None)
+    informer.list_func = lambda **kwargs: SimpleNamespace(items=list(pods), metadata=SimpleNamespace(resource_version="1"))
+    informer.add_index("image", lambda pod: [pod.spec.containers[0].image])
+    informer._relist()
+    return informer
+
+
+def test_relist_and_events_update_cache_and_indices():
+    informer = make_informer(make_pod("a"), make_pod("b", image="other:v1"))
+    assert informer.has_synced()
+    assert informer.index_keys("image", "harbor.pdc.tw/moa_ncu/x:v1") == {"a"}
+
+    informer._apply("MODIFIED", make_pod("b"))
+    informer._apply("DELETED", make_pod("a"))
+
+    assert informer.get("a") is None
+    assert informer.index_keys("image", "harbor.pdc.tw/moa_ncu/x:v1") == {"b"}
+    assert informer.index_keys("image", "other:v1") == set()
+
+
+def test_async_wait_is_woken_by_watch_event_not_polling():
+    informer = make_informer(make_pod("a"))
+    ready = pod_ready_predicate(8000)
+
+    async def scenario():
+        waiter = asyncio.create_task(informer.async_wait_for("a", ready, timeout=5))
+        await asyncio.sleep(0.01)
+        informer._apply("MODIFIED", make_pod("a", phase="Running"))  # 還沒有 pod IP
+        await asyncio.sleep(0.01)
+        assert not waiter.done()
+        # watch thread 送來 Running + pod IP
+        threading.Thread(target=informer._apply, args=("MODIFIED", make_pod("a", phase="Running", pod_ip="10.0.0.1"))).start()
+        return await asyncio.wait_for(waiter, timeout=1)
+
+    pod = asyncio.run(scenario())
+    assert pod.status.pod_ip == "10.0.0.1"
+    assert informer._async_waiters == {}
+
+
+def test_wait_times_out_and_cleans_up_waiters():
+    informer = make_informer(make_pod("a"))
+
+    assert asyncio.run(informer.async_wait_for("a", pod_ready_predicate(8000), timeout=0.05)) is None
+    assert informer.wait_for("a", pod_ready_predicate(8000), timeout=0.05) is None
+    assert informer._async_waiters == {}
+
+
+def test_ready_predicate_requires_matching_port():
+    assert pod_ready_predicate(8000)(make_pod("a", phase="Running", pod_ip="10.0.0.1"))
+    assert not pod_ready_predicate(9000)(make_pod("a", phase="Running", pod_ip="10.0.0.1"))
+    assert not pod_ready_predicate(8000)(None)
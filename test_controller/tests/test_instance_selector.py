@@ -0,0 +1,59 @@
+import random
+
+import pytest
+from fastapi import HTTPException
+
+from controller import leases
+from controller.leases import INSTANCE_LATENCY_KEY, InstanceSelector, instance_lock_key
+
+
+def instance(instance_id, healthy=True, **meta):
+    return {"ServiceID": instance_id, "Healthy": healthy, "ServiceMeta": meta, "ServiceWeights": {}}
+
+
+def ids(instances):
+    return [item["ServiceID"] for item in instances]
+
+
+def test_unknown_strategy_is_rejected():
+    with pytest.raises(HTTPException) as excinfo:
+        InstanceSelector().validate("random")
+    assert excinfo.value.status_code == 400
+    assert InstanceSelector().validate(None) == leases.ALLOCATION_STRATEGY
+
+
+def test_first_keeps_consul_order_and_healthy_filters(fake_redis):
+    candidates = [instance("a", healthy=False), instance("b"), instance("c")]
+
+    assert ids(InstanceSelector().order(candidates, "first")) == ["a", "b", "c"]
+    assert ids(InstanceSelector().order(candidates, "healthy")) == ["b", "c"]
+
+
+def test_lru_prefers_least_recently_allocated(fake_redis):
+    candidates = [instance("a"), instance("b"), instance("c")]
+    leases.claim_service_instance("svc", candidates, "dag-1", 60, strategy="first")  # a
+    leases.release_service_instance("a", "dag-1")
+
+    order = ids(InstanceSelector().order(candidates, "lru"))
+
+    assert order[-1] == "a"
+    assert set(order[:2]) == {"b", "c"}
+
+
+def test_latency_uses_ewma_written_on_release(fake_redis):
+    selector = InstanceSelector()
+    selector.on_lease_event({"type": "released", "service_instance_id": "a", "held_seconds": 10.0})
+    selector.on_lease_event({"type": "released", "service_instance_id": "b", "held_seconds": 2.0})
+    selector.on_lease_event({"type": "expired", "service_instance_id": "b", "held_seconds": 100.0})  # 只計算正常 release
+
+    assert float(fake_redis.hget(INSTANCE_LATENCY_KEY, instance_lock_key("b"))) == 2.0
+    # 沒有紀錄的 c 以平均值 (6s) 排序
+    assert ids(selector.order([instance("a"), instance("b"), instance("c")], "latency")) == ["b", "c", "a"]
+
+
+def test_weighted_favours_heavier_instances(fake_redis):
+    random.seed(7)
+    candidates = [instance("light", weight="1"), instance("heavy", weight="50")]
+    firsts = [ids(InstanceSelector().order(candidates, "weighted"))[0] for _ in range(200)]
+
+    assert firsts.count("heavy") > 150
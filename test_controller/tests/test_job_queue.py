@@ -0,0 +1,130 @@
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+from kubernetes import client
+
+from controller import job_queue as job_queue_module, kube
+from controller.informers import job_informer
+from controller.job_queue import JOB_QUEUE_OWNER_PATCH_KEY, JobAdmissionQueue
+from controller.jobs import job_status_store
+
+
+def make_job(name, uid="job-uid"):
+    return SimpleNamespace(metadata=SimpleNamespace(name=name, uid=uid, namespace="ml-serving", labels={}, annotations={}))
+
+
+class FakeKube:
+    """ batch_v1 / v1 的替身：記錄呼叫，fail 指定的 method 丟出 ApiException(status) """
+
+    def __init__(self):
+        self.calls = []
+        self.fail = {}
+
+    def _call(self, method, name):
+        self.calls.append((method, name))
+        if method in self.fail:
+            raise client.exceptions.ApiException(status=self.fail[method])
+
+    def create_namespaced_job(self, namespace, body):
+        self._call("create_namespaced_job", body["metadata"]["name"])
+        return make_job(body["metadata"]["name"])
+
+    def patch_namespaced_config_map(self, name, namespace, body):
+        self._call("patch_namespaced_config_map", name)
+
+    def delete_namespaced_config_map(self, name, namespace):
+        self._call("delete_namespaced_config_map", name)
+
+
+@pytest.fixture
+def fake_kube(monkeypatch, fake_redis):
+    fake = FakeKube()
+    executor = ThreadPoolExecutor(max_workers=2)
+    monkeypatch.setattr(kube, "v1", fake)
+    monkeypatch.setattr(kube, "batch_v1", fake)
+    monkeypatch.setattr(kube, "k8s_executor", executor)
+    monkeypatch.setattr(job_informer, "_store", {})
+    yield fake
+    executor.shutdown(wait=True)
+
+
+def enqueue(queue, job_name, demand=None, configmap=None):
+    manifest = {"metadata": {"name": job_name}}
+    return queue.enqueue(job_name, "ml-serving", "dag-1", manifest, demand or {"jobs": 1}, configmap)
+
+
+def test_dispatch_admits_in_order_within_quota(fake_kube, monkeypatch):
+    monkeypatch.setattr(job_queue_module, "JOB_NAMESPACE_QUOTAS", '{"ml-serving": {"jobs": 2}}')
+    queue = JobAdmissionQueue()
+    assert [enqueue(queue, name) for name in ("job-a", "job-b", "job-c")] == [1, 2, 3]
+
+    assert asyncio.run(queue._dispatch_locked()) == 2
+    assert [name for method, name in fake_kube.calls] == ["job-a", "job-b"]
+    assert queue.position("job-c") == 1
+    assert set(queue.load_submitted()) == {"job-a", "job-b"}
+
+
+def test_submit_failure_is_archived_and_removed(fake_kube, fake_redis):
+    queue = JobAdmissionQueue()
+    enqueue(queue, "sweep-a", configmap="sweep-a-params")
+    fake_kube.fail["create_namespaced_job"] = 422
+
+    assert asyncio.run(queue._dispatch_locked()) == 0
+    assert queue.get("sweep-a") is None
+    assert job_status_store.get("sweep-a")["failure_reason"] == "SubmitFailed"
+    assert ("delete_namespaced_config_map", "sweep-a-params") in fake_kube.calls
+    assert not fake_redis.hexists(JOB_QUEUE_OWNER_PATCH_KEY, "sweep-a-params")
+
+
+def test_owner_patch_failure_keeps_the_created_job_admitted(fake_kube, fake_redis):
+    queue = JobAdmissionQueue()
+    enqueue(queue, "sweep-a", configmap="sweep-a-params")
+    fake_kube.fail["patch_namespaced_config_map"] = 500
+
+    assert asyncio.run(queue._dispatch_locked()) == 1
+    assert queue.get("sweep-a") is None
+    assert "sweep-a" in queue.load_submitted()
+    assert job_status_store.get("sweep-a") is None
+    assert ("delete_namespaced_config_map", "sweep-a-params") not in fake_kube.calls
+    assert fake_redis.hexists(JOB_QUEUE_OWNER_PATCH_KEY, "sweep-a-params")
+
+    # 下一次 dispatch 在 informer 看到 Job 後補上 ownerReference
+    del fake_kube.fail["patch_namespaced_config_map"]
+    job_informer._store["sweep-a"] = make_job("sweep-a")
+    asyncio.run(queue._dispatch_locked())
+    assert fake_kube.calls[-1] == ("patch_namespaced_config_map", "sweep-a-params")
+    assert not fake_redis.hexists(JOB_QUEUE_OWNER_PATCH_KEY, "sweep-a-params")
+
+
+def test_pending_owner_patch_of_a_deleted_job_cleans_up_the_config_map(fake_kube, fake_redis):
+    queue = JobAdmissionQueue()
+    fake_redis.hset(JOB_QUEUE_OWNER_PATCH_KEY, "sweep-gone-params", json.dumps(["ml-serving", "sweep-gone"]))
+    enqueue(queue, "sweep-b", configmap="sweep-b-params")
+    fake_redis.hset(JOB_QUEUE_OWNER_PATCH_KEY, "sweep-b-params", json.dumps(["ml-serving", "sweep-b"]))
+    # sweep-b 在建立前就重啟 (仍在佇列中、quota 已滿)：不能刪它的 ConfigMap
+    queue.namespace_quotas = {"ml-serving": {"jobs": 0}}
+    asyncio.run(queue._dispatch_locked())
+
+    assert fake_kube.calls == [("delete_namespaced_config_map", "sweep-gone-params")]
+    assert fake_redis.hkeys(JOB_QUEUE_OWNER_PATCH_KEY) == ["sweep-b-params"]
+
+
+def test_wait_returns_when_queued_job_is_cancelled(fake_kube, monkeypatch):
+    from controller import jobs
+
+    monkeypatch.setattr(jobs, "JOB_WAIT_RECHECK_SECONDS", 0.05)
+    enqueue(job_queue_module.job_queue, "job-cancelled")
+
+    async def scenario():
+        waiter = asyncio.create_task(jobs.wait_job("job-cancelled", timeout=5))
+        await asyncio.sleep(0.1)
+        assert not waiter.done()
+        # 取消不會產生 job watch 事件 (也可能發生在其他 worker)，/wait 要靠重新查詢結束
+        await job_queue_module.cancel_queued_job("job-cancelled")
+        return await asyncio.wait_for(waiter, timeout=1)
+
+    status = asyncio.run(scenario())
+    assert (status["state"], status["failure_reason"], status["done"]) == ("failed", "Cancelled", True)
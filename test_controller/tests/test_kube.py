@@ -0,0 +1,67 @@
+import asyncio
+import threading
+import time
+
+import pytest
+from fastapi import HTTPException
+from prometheus_client import REGISTRY
+
+from controller import kube
+
+
+@pytest.fixture
+def k8s_clients(monkeypatch):
+    """ 不讀 kubeconfig，只建立共用的 ApiClient / executor；結束時還原成原本的 global """
+    for name in ("k8s_api_client", "v1", "batch_v1", "apps_v1", "k8s_executor"):
+        monkeypatch.setattr(kube, name, getattr(kube, name))
+    monkeypatch.setattr(kube, "load_k8s_config", lambda: None)
+    monkeypatch.setattr(kube, "K8S_CONNECTION_POOL_SIZE", 4)
+    kube.init_k8s_clients()
+    yield
+    kube.close_k8s_clients()
+
+
+def test_apis_share_one_pooled_api_client(k8s_clients):
+    assert kube.v1.api_client is kube.k8s_api_client
+    assert kube.batch_v1.api_client is kube.k8s_api_client
+    assert kube.apps_v1.api_client is kube.k8s_api_client
+    assert kube.k8s_api_client.configuration.connection_pool_maxsize == 4
+
+
+def test_k8s_call_runs_off_the_event_loop(k8s_clients):
+    def read_namespaced_pod(name):
+        time.sleep(0.1)
+        return threading.current_thread().name
+
+    async def scenario():
+        start = time.perf_counter()
+        threads = await asyncio.gather(*(kube.k8s_call(read_namespaced_pod, name=str(i)) for i in range(4)))
+        return threads, time.perf_counter() - start
+
+    before = REGISTRY.get_sample_value(
+        "ml_serving_dependency_request_seconds_count", {"system": "kubernetes", "operation": "read_namespaced_pod"}) or 0
+    threads, elapsed = asyncio.run(scenario())
+
+    assert all(name.startswith("k8s-api") for name in threads)
+    assert elapsed < 0.35  # 4 個呼叫平行執行，不是依序 0.4s
+    assert REGISTRY.get_sample_value(
+        "ml_serving_dependency_request_seconds_count", {"system": "kubernetes", "operation": "read_namespaced_pod"}) == before + 4
+
+
+@pytest.mark.parametrize("value, expected", [("2", 2000), ("0.5", 500), ("500m", 500)])
+def test_parse_cpu_quantity(value, expected):
+    assert kube.parse_cpu_quantity(value) == expected
+
+
+def test_parse_memory_quantity():
+    assert kube.parse_memory_quantity("8Gi") == 8 * 2 ** 30
+    assert kube.parse_memory_quantity("1G") == 10 ** 9
+    with pytest.raises(HTTPException):
+        kube.parse_memory_quantity("lots")
+
+
+def test_generated_names_fit_kubernetes_limits():
+    name = kube.generate_safe_name("harbor.pdc.tw/moa_ncu/" + "very_long_image_name" * 5, "mlpod")
+
+    assert len(name) <= 45 and len(f"{name}-pvc") <= 63
+    assert name.startswith("mlpod-very-long-image-name")
@@ -0,0 +1,214 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from controller import leases
+
+
+def instances(*ids):
+    return [{"ServiceID": instance_id, "ServiceAddress": "10.0.0.1", "ServicePort": 8000} for instance_id in ids]
+
+
+def lock_key(instance_id):
+    return leases.instance_lock_key(instance_id)
+
+
+def test_claim_locks_first_free_instance_with_increasing_tokens(fake_redis):
+    first = leases.claim_service_instance("svc", instances("a", "b"), "dag-1", 60, strategy="first")
+    second = leases.claim_service_instance("svc", instances("a", "b"), "dag-2", 60, strategy="first")
+
+    assert first == (instances("a")[0], 1)
+    assert second == (instances("b")[0], 2)
+    assert fake_redis.get(lock_key("a")) == "dag-1|1"
+    assert 0 < fake_redis.ttl(lock_key("a")) <= 60
+    assert fake_redis.zscore(leases.LEASE_EXPIRY_KEY, lock_key("b")) is not None
+    assert fake_redis.hget(leases.LEASE_INFO_KEY, lock_key("b")).startswith("dag-2|2|svc|")
+    assert fake_redis.hexists(leases.INSTANCE_LAST_ALLOCATED_KEY, lock_key("a"))
+
+
+def test_claim_returns_none_when_all_instances_are_locked(fake_redis):
+    leases.claim_service_instance("svc", instances("a"), "dag-1", 60, strategy="first")
+
+    assert leases.claim_service_instance("svc", instances("a"), "dag-2", 60, strategy="first") is None
+    assert fake_redis.get(lock_key("a")) == "dag-1|1"
+
+
+def test_batch_claim_is_all_or_nothing(fake_redis):
+    leases.claim_service_instance("svc-b", instances("b1"), "other", 60, strategy="first")
+    requested = {"svc-a": (instances("a1", "a2"), 2), "svc-b": (instances("b1", "b2"), 2)}
+
+    claimed, failed = leases.claim_service_instances_batch(requested, "dag-1", 60, strategy="first")
+
+    assert (claimed, failed) == ([], ["svc-b"])
+    for instance_id in ("a1", "a2", "b2"):
+        assert fake_redis.get(lock_key(instance_id)) is None
+        assert fake_redis.zscore(leases.LEASE_EXPIRY_KEY, lock_key(instance_id)) is None
+    assert fake_redis.get(lock_key("b1")) == "other|1"
+
+
+def test_batch_claim_locks_every_requested_instance(fake_redis):
+    requested = {"svc-a": (instances("a1", "a2", "a3"), 2), "svc-b": (instances("b1"), 1)}
+
+    claimed, failed = leases.claim_service_instances_batch(requested, "dag-1", 60, strategy="first")
+
+    assert failed == []
+    assert [(lease["service_name"], lease["instance"]["ServiceID"]) for lease in claimed] == [
+        ("svc-a", "a1"), ("svc-a", "a2"), ("svc-b", "b1"),
+    ]
+    assert len({lease["fencing_token"] for lease in claimed}) == 3
+    assert fake_redis.get(lock_key("a3")) is None
+
+
+def test_release_checks_owner_and_fencing_token(fake_redis):
+    _, token = leases.claim_service_instance("svc", instances("a"), "dag-1", 60, strategy="first")
+
+    assert leases.release_service_instance("a", "dag-2")[:2] == (-1, "dag-1")
+    assert leases.release_service_instance("a", "dag-1", token + 1)[:2] == (-2, "dag-1")
+    status, owner, info = leases.release_service_instance("a", "dag-1", token)
+    assert (status, owner) == (1, "dag-1")
+    assert info.startswith(f"dag-1|{token}|svc|")
+    assert fake_redis.get(lock_key("a")) is None
+    assert fake_redis.zscore(leases.LEASE_EXPIRY_KEY, lock_key("a")) is None
+    assert leases.release_service_instance("a", "dag-1", token)[0] == 0
+
+
+def test_stale_token_cannot_release_a_reassigned_lease(fake_redis):
+    _, old_token = leases.claim_service_instance("svc", instances("a"), "dag-1", 60, strategy="first")
+    leases.release_service_instance("a", "dag-1", old_token)
+    _, new_token = leases.claim_service_instance("svc", instances("a"), "dag-1", 60, strategy="first")
+
+    assert new_token > old_token
+    assert leases.release_service_instance("a", "dag-1", old_token)[0] == -2
+    assert fake_redis.get(lock_key("a")) == f"dag-1|{new_token}"
+
+
+def test_renew_extends_lease_only_for_holder(fake_redis):
+    _, token = leases.claim_service_instance("svc", instances("a"), "dag-1", 10, strategy="first")
+
+    status, expires_at = leases.renew_service_instance("a", "dag-1", token, 600)
+    assert status == 1
+    assert fake_redis.ttl(lock_key("a")) > 10
+    assert fake_redis.zscore(leases.LEASE_EXPIRY_KEY, lock_key("a")) == expires_at
+
+    assert leases.renew_service_instance("a", "dag-2", token, 600) == [-1, "dag-1"]
+    assert leases.renew_service_instance("a", "dag-1", token + 1, 600) == [-1, "dag-1"]
+    leases.release_service_instance("a", "dag-1", token)
+    assert leases.renew_service_instance("a", "dag-1", token, 600) == [0, ""]
+
+
+def test_reap_emits_expired_leases_once(fake_redis):
+    _, token = leases.claim_service_instance("svc", instances("a", "b"), "dag-1", 60, strategy="first")
+    leases.claim_service_instance("svc", instances("a", "b"), "dag-2", 60, strategy="first")
+    # a 的 lock key 已過期 (Redis 端 TTL 到期)；b 在 expiry zset 中過期但 key 仍有 TTL (已續約)
+    fake_redis.delete(lock_key("a"))
+    fake_redis.zadd(leases.LEASE_EXPIRY_KEY, {lock_key("a"): 0, lock_key("b"): 0})
+    reaper = leases.LeaseReaper()
+    events = []
+    reaper.listeners.append(events.append)
+
+    assert reaper.reap() == 1
+    assert reaper.reap() == 0
+    assert [(event["type"], event["service_instance_id"], event["owner"], event["fencing_token"]) for event in events] == [
+        ("expired", "a", "dag-1", token),
+    ]
+    assert not fake_redis.hexists(leases.LEASE_INFO_KEY, lock_key("a"))
+    assert fake_redis.zscore(leases.LEASE_EXPIRY_KEY, lock_key("b")) > 0
+
+
+@pytest.mark.parametrize("lease_ttl", [0, leases.LEASE_MAX_TTL_SECONDS + 1])
+def test_resolve_lease_ttl_rejects_out_of_range(lease_ttl):
+    with pytest.raises(HTTPException) as excinfo:
+        leases.resolve_lease_ttl(lease_ttl)
+    assert excinfo.value.status_code == 400
+
+def test_release_requires_fencing_token(fake_redis, monkeypatch):
+    from controller import allocation
+
+    _, token = leases.claim_service_instance("svc", instances("a", "b"), "dag_1", 60, strategy="first")
+    leases.claim_service_instance("svc", instances("b"), "dag_1", 60, strategy="first")
+    request = allocation.LeaseRequest(dag_id="dag", execution_id="1")
+
+    with pytest.raises(HTTPException) as excinfo:
+        asyncio.run(allocation.release_service("a", request))
+    assert excinfo.value.status_code == 400
+    assert fake_redis.exists(lock_key("a"))
+
+    with_token = allocation.LeaseRequest(dag_id="dag", execution_id="1", fencing_token=token)
+    assert asyncio.run(allocation.release_service("a", with_token))["status"] == "Unlocked"
+
+    # 遷移期間 (LEASE_REQUIRE_FENCING_TOKEN=false) 舊的 DAG 仍可不帶 token 釋放
+    monkeypatch.setattr(allocation, "LEASE_REQUIRE_FENCING_TOKEN", False)
+    assert asyncio.run(allocation.release_service("b", request))["status"] == "Unlocked"
+
+
+def test_default_lease_ttl_is_short():
+    # 沒有 heartbeat 的 DAG 當掉後，instance 應在數分鐘內被回收
+    assert leases.LEASE_TTL_SECONDS <= 300
+
+
+def test_new_request_cannot_jump_the_wait_queue(fake_redis):
+    leases.claim_service_instance("svc", instances("a"), "dag-1", 60, strategy="first")
+    waiter = {"id": "w1", "score": 1}
+    assert leases.claim_service_instance("svc", instances("a"), "dag-2", 60, strategy="first", waiter=waiter) is None
+    assert fake_redis.zrange(leases.allocation_queue_key("svc"), 0, -1) == ["w1"]
+
+    leases.release_service_instance("a", "dag-1")
+    # instance 已空出，但 w1 還在排隊：新 request 不能插隊
+    assert leases.claim_service_instance("svc", instances("a"), "dag-3", 60, strategy="first") is None
+
+    instance, _ = leases.claim_service_instance("svc", instances("a"), "dag-2", 60, strategy="first", waiter=waiter)
+    assert instance["ServiceID"] == "a"
+    assert fake_redis.zcard(leases.allocation_queue_key("svc")) == 0
+    assert fake_redis.zcard(leases.allocation_heartbeat_key("svc")) == 0
+
+
+def test_only_head_of_queue_may_claim(fake_redis):
+    leases.claim_service_instance("svc", instances("a"), "dag-0", 60, strategy="first")
+    head = {"id": "w1", "score": 1}
+    behind = {"id": "w2", "score": 2}
+    leases.claim_service_instance("svc", instances("a"), "dag-1", 60, strategy="first", waiter=head)
+    leases.claim_service_instance("svc", instances("a"), "dag-2", 60, strategy="first", waiter=behind)
+    leases.release_service_instance("a", "dag-0")
+
+    assert leases.claim_service_instance("svc", instances("a"), "dag-2", 60, strategy="first", waiter=behind) is None
+    assert leases.claim_service_instance("svc", instances("a"), "dag-1", 60, strategy="first", waiter=head) is not None
+
+
+def test_waiter_with_expired_heartbeat_is_pruned(fake_redis):
+    fake_redis.zadd(leases.allocation_queue_key("svc"), {"gone": 0})
+    fake_redis.zadd(leases.allocation_heartbeat_key("svc"), {"gone": 0})  # 心跳早已過期
+
+    instance, _ = leases.claim_service_instance("svc", instances("a"), "dag-1", 60, strategy="first")
+
+    assert instance["ServiceID"] == "a"
+    assert fake_redis.zcard(leases.allocation_queue_key("svc")) == 0
+
+
+def test_queue_depth_gauge_follows_waiters(fake_redis, monkeypatch):
+    from prometheus_client import REGISTRY
+    from controller import allocation, consul
+
+    class Catalog:
+        async def aget(self, service_name):
+            return instances("a")
+
+    def depth():
+        return REGISTRY.get_sample_value("ml_serving_allocation_queue_depth", {"service": "svc-depth"})
+
+    monkeypatch.setattr(consul, "consul_catalog", Catalog())
+    monkeypatch.setattr(allocation, "ALLOCATION_QUEUE_POLL_INTERVAL", 0.05)
+    leases.claim_service_instance("svc-depth", instances("a"), "dag-0", 60, strategy="first")
+
+    async def scenario():
+        queue = allocation.AllocationQueue()
+        queue.start(asyncio.get_running_loop())
+        waiter = asyncio.create_task(queue.wait("svc-depth", "dag", "dag_1", 60, timeout=0.3, strategy="first"))
+        await asyncio.sleep(0.1)
+        during = depth()
+        result = await waiter
+        queue.stop()
+        return during, result
+
+    during, result = asyncio.run(scenario())
+    assert (during, result, depth()) == (1, None, 0)
@@ -0,0 +1,73 @@
+import pytest
+from kubernetes import client
+
+from controller import locality
+from controller.informers import node_informer, pod_informer
+from controller.locality import node_locality, preferred_node_affinity
+
+IMAGE = "harbor.pdc.tw/moa_ncu/x:v1"
+
+
+def make_node(name, images=(), gpus=0, unschedulable=False):
+    return client.V1Node(
+        metadata=client.V1ObjectMeta(name=name),
+        spec=client.V1NodeSpec(unschedulable=unschedulable),
+        status=client.V1NodeStatus(
+            allocatable={"nvidia.com/gpu": str(gpus)},
+            images=[client.V1ContainerImage(names=list(images))] if images else [],
+        ),
+    )
+
+
+def make_pod(name, node_name, gpus=0, pvc=None, phase="Running"):
+    volumes = [client.V1Volume(name="data", persistent_volume_claim=client.V1PersistentVolumeClaimVolumeSource(claim_name=pvc))] if pvc else None
+    return client.V1Pod(
+        metadata=client.V1ObjectMeta(name=name),
+        spec=client.V1PodSpec(node_name=node_name, volumes=volumes, containers=[client.V1Container(
+            name="main", image="busybox", resources=client.V1ResourceRequirements(limits={"nvidia.com/gpu": str(gpus)}),
+        )]),
+        status=client.V1PodStatus(phase=phase),
+    )
+
+
+@pytest.fixture
+def cluster(informer_cache):
+    informer_cache(
+        node_informer,
+        make_node("n-image", images=[IMAGE], gpus=1),
+        make_node("n-pvc", gpus=4),
+        make_node("n-gpu", gpus=2),
+        make_node("n-cordoned", images=[IMAGE], gpus=8, unschedulable=True),
+    )
+    informer_cache(
+        pod_informer,
+        make_pod("mlpod-a", "n-pvc", gpus=4, pvc="mlpod-a-pvc"),
+        make_pod("finished", "n-gpu", gpus=2, phase="Succeeded"),
+    )
+
+
+def test_locality_scores_image_pvc_and_free_gpus(cluster):
+    nodes = {item["node"]: item for item in node_locality(IMAGE, pvc_name="mlpod-a-pvc", gpu=2)}
+
+    assert "n-cordoned" not in nodes
+    assert (nodes["n-image"]["score"], nodes["n-image"]["gpu_free"]) == (locality.LOCALITY_IMAGE_WEIGHT, 1)
+    assert (nodes["n-pvc"]["score"], nodes["n-pvc"]["gpu_free"]) == (locality.LOCALITY_PVC_WEIGHT, 0)
+    # 已結束的 Pod 不佔用 GPU
+    assert (nodes["n-gpu"]["score"], nodes["n-gpu"]["gpu_free"]) == (locality.LOCALITY_GPU_WEIGHT, 2)
+
+
+def test_affinity_is_preferred_and_grouped_by_score(cluster):
+    affinity = preferred_node_affinity(IMAGE, pvc_name="mlpod-a-pvc", gpu=2)
+    terms = affinity["nodeAffinity"]["preferredDuringSchedulingIgnoredDuringExecution"]
+
+    assert [(term["weight"], term["preference"]["matchFields"][0]["values"]) for term in terms] == [
+        (50, ["n-image"]), (30, ["n-pvc"]), (20, ["n-gpu"]),
+    ]
+    assert "requiredDuringSchedulingIgnoredDuringExecution" not in affinity["nodeAffinity"]
+
+
+def test_no_affinity_without_locality_or_synced_cache(cluster, monkeypatch):
+    assert preferred_node_affinity("harbor.pdc.tw/moa_ncu/unknown:v1") is None
+
+    monkeypatch.setattr(locality, "LOCALITY_ENABLED", False)
+    assert preferred_node_affinity(IMAGE) is None
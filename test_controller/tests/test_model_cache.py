@@ -0,0 +1,57 @@
+import asyncio
+import json
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+
+from controller import model_cache as model_cache_module
+from controller.informers import job_informer
+from controller.model_cache import MODEL_CACHE_KEY, ModelCache
+
+
+def make_fetch_job(name, active=1):
+    return SimpleNamespace(
+        metadata=SimpleNamespace(name=name, labels={}, annotations={}),
+        status=SimpleNamespace(active=active, succeeded=None, failed=None, conditions=None),
+    )
+
+
+@pytest.fixture
+def fetching(monkeypatch, fake_redis):
+    """ 已有其他 replica 建立的 fetch Job 正在下載 """
+    monkeypatch.setattr(model_cache_module, "MODEL_FETCH_TIMEOUT", 5)
+    monkeypatch.setattr(job_informer, "_store", {})
+    monkeypatch.setattr(job_informer, "_async_waiters", {})
+    monkeypatch.setattr(job_informer, "_synced", threading.Event())
+    job_informer._synced.set()
+    entry = {"state": "fetching", "uri": "models:/m/1", "job": "model-fetch-m-1", "size": 0, "created_at": time.time()}
+    fake_redis.hset(MODEL_CACHE_KEY, "m-1", json.dumps(entry))
+    return entry
+
+
+def test_ensure_wakes_when_fetch_job_is_deleted(fetching):
+    job_informer._apply("ADDED", make_fetch_job(fetching["job"]))
+
+    async def scenario():
+        waiter = asyncio.create_task(ModelCache().ensure({"key": "m-1", "uri": fetching["uri"]}, "image"))
+        await asyncio.sleep(0.05)
+        assert not waiter.done()
+        # Job 在結束前被刪除，不應等到 MODEL_FETCH_TIMEOUT
+        job_informer._apply("DELETED", make_fetch_job(fetching["job"]))
+        return await asyncio.wait_for(waiter, timeout=1)
+
+    with pytest.raises(HTTPException) as excinfo:
+        asyncio.run(scenario())
+    assert excinfo.value.status_code == 502
+    assert ModelCache().get("m-1")["state"] == "failed"
+
+
+def test_fresh_fetch_job_not_yet_in_informer_is_not_treated_as_deleted(fetching):
+    predicate = model_cache_module.fetch_job_finished(fetching)
+    assert not predicate(None)
+    assert not predicate(make_fetch_job(fetching["job"]))
+    assert predicate(None)
+    assert model_cache_module.fetch_job_finished({**fetching, "created_at": 0})(None)
@@ -0,0 +1,55 @@
+import json
+import logging
+import sys
+
+import pytest
+from kubernetes import client
+from prometheus_client import REGISTRY
+
+from controller import observability
+from controller.observability import error_label, JsonLogFormatter, observe_call
+
+
+def sample(name, labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+def test_observe_call_records_latency_and_errors_by_status():
+    labels = {"system": "kubernetes", "operation": "test_create"}
+    calls, errors = sample("ml_serving_dependency_request_seconds_count", labels), \
+        sample("ml_serving_dependency_errors_total", {**labels, "error": "409"})
+
+    with observe_call("kubernetes", "test_create"):
+        pass
+    with pytest.raises(client.exceptions.ApiException):
+        with observe_call("kubernetes", "test_create"):
+            raise client.exceptions.ApiException(status=409)
+
+    assert sample("ml_serving_dependency_request_seconds_count", labels) == calls + 2
+    assert sample("ml_serving_dependency_errors_total", {**labels, "error": "409"}) == errors + 1
+
+
+def test_error_label_falls_back_to_exception_type():
+    assert error_label(client.exceptions.ApiException(status=500)) == "500"
+    assert error_label(TimeoutError()) == "TimeoutError"
+
+
+def test_json_log_formatter_keeps_extra_fields_and_exceptions():
+    try:
+        raise ValueError("boom")
+    except ValueError:
+        record = logging.getLogger("test").makeRecord(
+            "test", logging.ERROR, __file__, 1, "Pod failed", None, sys.exc_info(), extra={"pod_name": "mlpod-a"})
+
+    entry = json.loads(JsonLogFormatter().format(record))
+
+    assert (entry["level"], entry["msg"], entry["pod_name"]) == ("ERROR", "Pod failed", "mlpod-a")
+    assert "ValueError: boom" in entry["exc"]
+
+
+def test_metrics_endpoint_exposes_controller_metrics(monkeypatch):
+    monkeypatch.delenv("PROMETHEUS_MULTIPROC_DIR", raising=False)
+    body = observability.metrics().body.decode()
+
+    assert "ml_serving_provision_seconds" in body
+    assert "ml_serving_allocation_queue_depth" in body
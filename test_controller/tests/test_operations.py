@@ -0,0 +1,55 @@
+import asyncio
+
+import pytest
+
+from controller import operations as operations_module
+from controller.operations import operations, start_create_pod_operation
+from controller.provisioning import PodCreateRequest
+
+
+@pytest.fixture
+def fake_provisioning(monkeypatch, fake_redis):
+    """ plan 固定為 mlpod-planned；warm 指定 warm pool 取用的結果，provision 記錄被建立的 plan """
+    state = {"warm": None, "provisioned": []}
+
+    def build_plan(image_name, image_tag, export_port, dag_id, model_uri=None):
+        return {"pod_name": "mlpod-planned"}
+
+    async def provision(plan, report):
+        await report("pod_creating", {"pod_name": plan["pod_name"]})
+        state["provisioned"].append(plan["pod_name"])
+        return {"pod_name": plan["pod_name"]}
+
+    monkeypatch.setattr(operations_module, "build_serving_pod_plan", build_plan)
+    monkeypatch.setattr(operations_module, "provision_serving_pod", provision)
+    monkeypatch.setattr(operations_module.warm_pool, "acquire", lambda *args: state["warm"])
+    return state
+
+
+async def create_and_wait(request):
+    response = await start_create_pod_operation(request)
+    await asyncio.gather(*operations._tasks)
+    return response, await operations.get(response["operation_id"])
+
+
+def make_request():
+    return PodCreateRequest(image_name="moa_ncu/x", image_tag="v1", export_port=8000)
+
+
+def test_operation_response_does_not_guess_the_pod_name(fake_provisioning):
+    fake_provisioning["warm"] = {"pod_name": "mlpod-warm"}
+
+    response, operation = asyncio.run(create_and_wait(make_request()))
+
+    assert "pod_name" not in response
+    assert response["status_url"] == f"/operations/{response['operation_id']}"
+    assert (operation["status"], operation["pod_name"]) == ("succeeded", "mlpod-warm")
+    assert operation["result"] == {"pod_name": "mlpod-warm"}
+    assert fake_provisioning["provisioned"] == []
+
+
+def test_operation_reports_planned_pod_on_warm_pool_miss(fake_provisioning):
+    response, operation = asyncio.run(create_and_wait(make_request()))
+
+    assert (operation["status"], operation["pod_name"]) == ("succeeded", "mlpod-planned")
+    assert fake_provisioning["provisioned"] == ["mlpod-planned"]
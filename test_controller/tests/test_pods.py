@@ -0,0 +1,198 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import httpx
+import pytest
+from fastapi import FastAPI, HTTPException
+from kubernetes import client
+
+from controller import kube, pods as pods_module
+from controller.informers import DAG_LABEL, pod_informer, pvc_informer, ROLE_LABEL, service_informer
+
+T0 = datetime(2026, 1, 1)
+
+
+def make_pod(name, minutes=0, image="harbor.pdc.tw/moa_ncu/x:v1", dag_id=None, phase="Running", role="serving"):
+    labels = {ROLE_LABEL: role}
+    if dag_id:
+        labels[DAG_LABEL] = dag_id
+    return client.V1Pod(
+        metadata=client.V1ObjectMeta(name=name, labels=labels, creation_timestamp=T0 + timedelta(minutes=minutes)),
+        spec=client.V1PodSpec(containers=[client.V1Container(name="serving", image=image)]),
+        status=client.V1PodStatus(phase=phase, pod_ip="10.0.0.1"),
+    )
+
+
+@pytest.fixture
+def pods(informer_cache):
+    informer_cache(
+        pod_informer,
+        make_pod("mlpod-a", 0, dag_id="dag-1"),
+        make_pod("mlpod-b", 1, image="harbor.pdc.tw/moa_ncu/y:v2", phase="Pending"),
+        make_pod("mlpod-c", 2, dag_id="dag-1"),
+        make_pod("fetch-job-pod", 3, role="model-fetch"),
+    )
+    informer_cache(service_informer, client.V1Service(metadata=client.V1ObjectMeta(name="mlpod-a-svc")))
+    informer_cache(pvc_informer)
+    app = FastAPI()
+    app.include_router(pods_module.router)
+    return app
+
+
+def get(app, params):
+    async def request():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://controller") as http:
+            return await http.get("/list_pods", params=params)
+    return asyncio.run(request())
+
+
+def list_pods(app, **params):
+    response = get(app, params)
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+def names(result):
+    return [pod["pod_name"] for pod in result["pods"]]
+
+
+def test_list_pods_filters_through_indices(pods):
+    assert names(list_pods(pods)) == ["mlpod-a", "mlpod-b", "mlpod-c"]
+    assert names(list_pods(pods, image="moa_ncu/x")) == ["mlpod-a", "mlpod-c"]
+    assert names(list_pods(pods, dag_id="dag-1", phase="Running")) == ["mlpod-a", "mlpod-c"]
+    assert names(list_pods(pods, phase="Pending")) == ["mlpod-b"]
+    assert list_pods(pods)["pods"][0]["pod_service"] == "mlpod-a-svc.ml-serving.svc.cluster.local"
+
+
+def test_list_pods_paginates_with_continue_token(pods):
+    first = list_pods(pods, limit=2)
+    second = list_pods(pods, limit=2, **{"continue": first["continue"]})
+
+    assert (names(first), first["total"]) == (["mlpod-a", "mlpod-b"], 3)
+    assert (names(second), second["continue"]) == (["mlpod-c"], None)
+
+
+def test_list_pods_rejects_bad_input(pods):
+    assert get(pods, {"continue": "not-a-token"}).status_code == 400
+    assert get(pods, {"limit": 0}).status_code == 400
+
+
+class FakeDeletes:
+    """ 記錄同時進行中的 delete_namespaced_pod 數量；missing 中的名稱回 404，broken 回 500 """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = 0
+        self.max_active = 0
+        self.deleted = []
+        self.missing = set()
+        self.broken = set()
+
+    def _delete(self, name):
+        if name in self.missing:
+            raise client.exceptions.ApiException(status=404)
+        if name in self.broken:
+            raise client.exceptions.ApiException(status=500)
+
+    def delete_namespaced_pod(self, name, namespace, propagation_policy):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(0.02)
+        with self.lock:
+            self.active -= 1
+            self.deleted.append(name)
+        self._delete(name)
+
+    def delete_namespaced_persistent_volume_claim(self, name, namespace, propagation_policy):
+        self._delete(name)
+
+    def delete_namespaced_service(self, name, namespace, propagation_policy):
+        self._delete(name)
+
+
+@pytest.fixture
+def fake_deletes(monkeypatch):
+    fake = FakeDeletes()
+    executor = ThreadPoolExecutor(max_workers=16)
+    monkeypatch.setattr(kube, "v1", fake)
+    monkeypatch.setattr(kube, "k8s_executor", executor)
+    yield fake
+    executor.shutdown(wait=True)
+
+
+def post(app, path, body):
+    async def request():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://controller") as http:
+            return await http.post(path, json=body)
+    return asyncio.run(request())
+
+
+@pytest.mark.parametrize("selector, expected", [
+    ("ml-serving/role=serving", True),
+    ("ml-serving/role==serving,team", True),
+    ("ml-serving/role!=serving", False),
+    ("!team", False),
+    ("missing", False),
+])
+def test_match_label_selector(selector, expected):
+    assert pods_module.match_label_selector({"ml-serving/role": "serving", "team": "a"}, selector) is expected
+
+
+def test_delete_pods_resolves_targets_from_cache_with_bounded_parallelism(pods, fake_deletes, informer_cache):
+    idle = make_pod("mlpod-idle", 4, dag_id="dag-1")
+    idle.metadata.labels["warm-pool"] = "idle"
+    informer_cache(pod_informer, *pod_informer.list(), idle)
+    fake_deletes.missing.add("mlpod-c-svc")
+
+    response = post(pods, "/delete_pods", {"label_selector": f"{DAG_LABEL}=dag-1", "pod_names": ["mlpod-b"], "concurrency": 2})
+
+    assert response.status_code == 200
+    body = response.json()
+    assert [result["pod_name"] for result in body["results"]] == ["mlpod-a", "mlpod-b", "mlpod-c"]
+    assert body["deleted"] == 3 and body["results"][2]["results"]["service"] == "not_found"
+    assert fake_deletes.max_active <= 2
+
+
+def test_delete_pods_reports_failures_per_pod(pods, fake_deletes):
+    fake_deletes.broken.add("mlpod-b-pvc")
+
+    body = post(pods, "/delete_pods", {"pod_names": ["mlpod-a", "mlpod-b"]}).json()
+
+    assert (body["deleted"], body["failed"]) == (1, 1)
+    assert list(body["results"][1]["errors"]) == ["pvc"]
+
+
+def test_create_pods_bounds_concurrency_and_isolates_failures(pods, monkeypatch):
+    state = {"active": 0, "max_active": 0}
+
+    def build_plan(image_name, image_tag, export_port, dag_id=None, model_uri=None):
+        if image_tag == "broken":
+            raise HTTPException(status_code=400, detail="Invalid Image Name.")
+        return {"pod_name": f"mlpod-{image_tag}"}
+
+    async def provision(plan):
+        state["active"] += 1
+        state["max_active"] = max(state["max_active"], state["active"])
+        await asyncio.sleep(0.02)
+        state["active"] -= 1
+        return {"pod_name": plan["pod_name"]}
+
+    monkeypatch.setattr(pods_module, "build_serving_pod_plan", build_plan)
+    monkeypatch.setattr(pods_module, "provision_serving_pod", provision)
+    monkeypatch.setattr(pods_module.warm_pool, "acquire", lambda *args: None)
+    items = [{"image_name": "moa_ncu/x", "image_tag": tag, "export_port": 8000} for tag in ("v1", "v2", "broken", "v3", "v4")]
+
+    body = post(pods, "/create_pods", {"pods": items, "concurrency": 2}).json()
+
+    assert (body["created"], body["failed"]) == (4, 1)
+    assert body["results"][2] == {"index": 2, "status": "failed", "image_name": "moa_ncu/x", "detail": "Invalid Image Name."}
+    assert state["max_active"] == 2
+
+
+def test_bulk_concurrency_is_validated(pods):
+    assert post(pods, "/create_pods", {"pods": [], "concurrency": 0}).status_code == 400
+    assert post(pods, "/delete_pods", {"pod_names": []}).status_code == 400
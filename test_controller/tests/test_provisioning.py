@@ -0,0 +1,195 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+from kubernetes import client
+from prometheus_client import REGISTRY
+
+from controller import kube, provisioning
+from controller.provisioning import ProvisioningSaga
+
+
+class FakeCoreV1:
+    """ 記錄 create / delete 呼叫；fail 指定的 method 丟出 ApiException(status) """
+
+    def __init__(self, fail=None):
+        self.calls = []
+        self.fail = fail or {}
+
+    def _call(self, method, name):
+        self.calls.append((method, name))
+        if method in self.fail:
+            raise client.exceptions.ApiException(status=self.fail[method])
+
+    def create_namespaced_pod(self, namespace, body):
+        self._call("create_namespaced_pod", body["metadata"]["name"])
+        return SimpleNamespace(metadata=SimpleNamespace(name=body["metadata"]["name"], uid="pod-uid"))
+
+    def create_namespaced_persistent_volume_claim(self, namespace, body):
+        self._call("create_namespaced_persistent_volume_claim", body["metadata"]["name"])
+
+    def create_namespaced_service(self, namespace, body):
+        self._call("create_namespaced_service", body["metadata"]["name"])
+
+    def delete_namespaced_pod(self, name, namespace, propagation_policy=None):
+        self._call("delete_namespaced_pod", name)
+
+    def delete_namespaced_persistent_volume_claim(self, name, namespace, propagation_policy=None):
+        self._call("delete_namespaced_persistent_volume_claim", name)
+
+    def delete_namespaced_service(self, name, namespace, propagation_policy=None):
+        self._call("delete_namespaced_service", name)
+
+
+def make_plan():
+    return {
+        "pod_name": "mlpod-x", "pvc_name": "mlpod-x-pvc", "service_name": "mlpod-x-svc", "provisioning_id": "p-1",
+        "full_image_name": "harbor.pdc.tw/moa_ncu/x:v1", "export_port": 8000, "model": None,
+        "pod_manifest": {"metadata": {"name": "mlpod-x"}},
+        "pvc_manifest": {"metadata": {"name": "mlpod-x-pvc"}},
+        "service_manifest": {"metadata": {"name": "mlpod-x-svc"}},
+    }
+
+
+def rollbacks(result):
+    return REGISTRY.get_sample_value("ml_serving_provision_rollbacks_total", {"result": result}) or 0.0
+
+
+def running_pod():
+    return SimpleNamespace(status=SimpleNamespace(pod_ip="10.0.0.7"))
+
+
+@pytest.fixture
+def fake_v1(monkeypatch):
+    fake = FakeCoreV1()
+    executor = ThreadPoolExecutor(max_workers=2)
+    monkeypatch.setattr(kube, "v1", fake)
+    monkeypatch.setattr(kube, "k8s_executor", executor)
+    yield fake
+    executor.shutdown(wait=True)
+
+
+def deletes(fake):
+    return [call for call in fake.calls if call[0].startswith("delete")]
+
+
+def test_rollback_deletes_in_reverse_order(fake_v1):
+    saga = ProvisioningSaga(make_plan())
+    saga.completed("pod", fake_v1.delete_namespaced_pod, "mlpod-x")
+    saga.completed("pvc", fake_v1.delete_namespaced_persistent_volume_claim, "mlpod-x-pvc")
+    saga.completed("service", fake_v1.delete_namespaced_service, "mlpod-x-svc")
+    before = rollbacks("succeeded")
+
+    saga.rollback_sync(RuntimeError("boom"))
+
+    assert deletes(fake_v1) == [
+        ("delete_namespaced_service", "mlpod-x-svc"),
+        ("delete_namespaced_persistent_volume_claim", "mlpod-x-pvc"),
+        ("delete_namespaced_pod", "mlpod-x"),
+    ]
+    assert rollbacks("succeeded") == before + 1
+
+
+def test_rollback_ignores_already_deleted_objects(fake_v1):
+    fake_v1.fail["delete_namespaced_persistent_volume_claim"] = 404
+    saga = ProvisioningSaga(make_plan())
+    saga.completed("pod", fake_v1.delete_namespaced_pod, "mlpod-x")
+    saga.completed("pvc", fake_v1.delete_namespaced_persistent_volume_claim, "mlpod-x-pvc")
+    before = rollbacks("succeeded")
+
+    saga.rollback_sync(RuntimeError("boom"))
+
+    assert rollbacks("succeeded") == before + 1
+
+
+def test_rollback_continues_after_a_failed_delete(fake_v1):
+    fake_v1.fail["delete_namespaced_persistent_volume_claim"] = 500
+    saga = ProvisioningSaga(make_plan())
+    saga.completed("pod", fake_v1.delete_namespaced_pod, "mlpod-x")
+    saga.completed("pvc", fake_v1.delete_namespaced_persistent_volume_claim, "mlpod-x-pvc")
+    before = rollbacks("failed")
+
+    asyncio.run(saga.rollback(RuntimeError("boom")))
+
+    assert deletes(fake_v1) == [
+        ("delete_namespaced_persistent_volume_claim", "mlpod-x-pvc"),
+        ("delete_namespaced_pod", "mlpod-x"),
+    ]
+    assert rollbacks("failed") == before + 1
+
+
+def test_rollback_without_created_objects_is_a_no_op(fake_v1):
+    before = rollbacks("succeeded"), rollbacks("failed")
+    ProvisioningSaga(make_plan()).rollback_sync(RuntimeError("boom"))
+    assert deletes(fake_v1) == []
+    assert (rollbacks("succeeded"), rollbacks("failed")) == before
+
+
+def test_sync_provisioning_rolls_back_when_service_creation_fails(fake_v1, monkeypatch):
+    fake_v1.fail["create_namespaced_service"] = 409
+    monkeypatch.setattr(provisioning, "wait_for_serving_pod_sync", lambda plan: running_pod())
+    plan = make_plan()
+
+    with pytest.raises(client.exceptions.ApiException):
+        provisioning.provision_serving_pod_sync(plan)
+
+    assert deletes(fake_v1) == [
+        ("delete_namespaced_persistent_volume_claim", "mlpod-x-pvc"),
+        ("delete_namespaced_pod", "mlpod-x"),
+    ]
+    assert plan["pvc_manifest"]["metadata"]["ownerReferences"][0]["uid"] == "pod-uid"
+
+
+def test_async_provisioning_rolls_back_on_readiness_timeout(fake_v1, monkeypatch):
+    async def timeout(plan):
+        raise provisioning.pod_ready_timeout(plan, "pod_running")
+
+    monkeypatch.setattr(provisioning, "wait_for_serving_pod", timeout)
+    phases = []
+
+    async def report(phase, detail):
+        phases.append(phase)
+
+    with pytest.raises(HTTPException):
+        asyncio.run(provisioning.provision_serving_pod(make_plan(), report))
+
+    assert phases[-1] == "rolling_back"
+    assert deletes(fake_v1) == [
+        ("delete_namespaced_persistent_volume_claim", "mlpod-x-pvc"),
+        ("delete_namespaced_pod", "mlpod-x"),
+    ]
+
+
+def test_async_provisioning_rolls_back_when_cancelled(fake_v1, monkeypatch):
+    async def _run():
+        started = asyncio.Event()
+
+        async def wait_forever(plan):
+            started.set()
+            await asyncio.sleep(3600)
+
+        monkeypatch.setattr(provisioning, "wait_for_serving_pod", wait_forever)
+        task = asyncio.create_task(provisioning.provision_serving_pod(make_plan()))
+        await started.wait()
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(_run())
+
+    assert deletes(fake_v1) == [
+        ("delete_namespaced_persistent_volume_claim", "mlpod-x-pvc"),
+        ("delete_namespaced_pod", "mlpod-x"),
+    ]
+
+
+def test_successful_provisioning_keeps_every_object(fake_v1, monkeypatch):
+    monkeypatch.setattr(provisioning, "wait_for_serving_pod_sync", lambda plan: running_pod())
+
+    assert provisioning.provision_serving_pod_sync(make_plan()).status.pod_ip == "10.0.0.7"
+    assert deletes(fake_v1) == []
+    assert [method for method, _ in fake_v1.calls] == [
+        "create_namespaced_pod", "create_namespaced_persistent_volume_claim", "create_namespaced_service",
+    ]
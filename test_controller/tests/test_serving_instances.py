@@ -0,0 +1,167 @@
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import pytest
+from fastapi import FastAPI, HTTPException
+from kubernetes import client
+
+from controller import kube, serving_instances
+from controller.informers import node_informer, pod_informer, pvc_informer, service_informer
+from controller.serving_instances import (
+    serving_instance_pod_name, serving_reconciler, serving_spec_hash, SERVING_INSTANCE_LABEL, SERVING_INSTANCES_KEY,
+    SPEC_HASH_ANNOTATION,
+)
+
+SPEC = {"image_name": "moa_ncu/x", "image_tag": "v1", "export_port": 8000, "dag_id": "dag-1", "model_uri": None}
+
+
+def managed(kind, name, instance="web", annotations=None, port=None):
+    metadata = client.V1ObjectMeta(name=name, labels={SERVING_INSTANCE_LABEL: instance}, annotations=annotations)
+    if kind == "pod":
+        return client.V1Pod(metadata=metadata, spec=client.V1PodSpec(containers=[client.V1Container(name="serving", image="busybox")]),
+                            status=client.V1PodStatus(phase="Running"))
+    if kind == "service":
+        return client.V1Service(metadata=metadata, spec=client.V1ServiceSpec(ports=[client.V1ServicePort(port=port or 8000)]))
+    return client.V1PersistentVolumeClaim(metadata=metadata)
+
+
+class FakeCoreV1:
+    def __init__(self, conflict=()):
+        self.calls = []
+        self.conflict = set(conflict)
+
+    def _record(self, action, name):
+        self.calls.append((action, name))
+        if action in self.conflict:
+            raise client.exceptions.ApiException(status=409)
+
+    def create_namespaced_persistent_volume_claim(self, namespace, body):
+        self._record("create_pvc", body["metadata"]["name"])
+
+    def create_namespaced_service(self, namespace, body):
+        self._record("create_service", body["metadata"]["name"])
+
+    def create_namespaced_pod(self, namespace, body):
+        self._record("create_pod", body["metadata"]["name"])
+        self.pod = body
+
+    def delete_namespaced_pod(self, name, namespace, propagation_policy=None):
+        self._record("delete_pod", name)
+
+    def delete_namespaced_service(self, name, namespace, propagation_policy=None):
+        self._record("delete_service", name)
+
+    def delete_namespaced_persistent_volume_claim(self, name, namespace, propagation_policy=None):
+        self._record("delete_pvc", name)
+
+
+@pytest.fixture
+def cluster(monkeypatch, fake_redis, informer_cache):
+    executor = ThreadPoolExecutor(max_workers=2)
+    monkeypatch.setattr(kube, "k8s_executor", executor)
+    informer_cache(node_informer)
+
+    def load(*objs, conflict=()):
+        fake = FakeCoreV1(conflict)
+        monkeypatch.setattr(kube, "v1", fake)
+        for informer, kind in ((pod_informer, client.V1Pod), (pvc_informer, client.V1PersistentVolumeClaim),
+                               (service_informer, client.V1Service)):
+            informer_cache(informer, *[obj for obj in objs if isinstance(obj, kind)])
+        return fake
+
+    yield load
+    executor.shutdown(wait=True)
+
+
+def store_spec(fake_redis, name="web", **overrides):
+    spec = {**SPEC, **overrides}
+    spec["hash"] = serving_spec_hash(spec)
+    fake_redis.hset(SERVING_INSTANCES_KEY, name, json.dumps(spec))
+    return spec
+
+
+async def request(method, path, **kwargs):
+    app = FastAPI()
+    app.include_router(serving_instances.router)
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as http:
+        return await http.request(method, path, **kwargs)
+
+
+def test_spec_hash_covers_only_spec_fields():
+    assert serving_spec_hash(SPEC) == serving_spec_hash({**SPEC, "generation": 3, "recreations": 1})
+    assert serving_spec_hash(SPEC) != serving_spec_hash({**SPEC, "image_tag": "v2"})
+
+
+def test_put_stores_desired_state_and_bumps_generation_on_change(cluster, fake_redis):
+    cluster()
+    body = {key: value for key, value in SPEC.items() if value is not None}
+
+    first = asyncio.run(request("PUT", "/serving_instances/web", json=body))
+    again = asyncio.run(request("PUT", "/serving_instances/web", json=body))
+    changed = asyncio.run(request("PUT", "/serving_instances/web", json={**body, "image_tag": "v2"}))
+
+    assert first.status_code == 202
+    assert (first.json()["generation"], again.json()["generation"], changed.json()["generation"]) == (1, 1, 2)
+    assert first.json()["state"] == "progressing"
+    stored = json.loads(fake_redis.hget(SERVING_INSTANCES_KEY, "web"))
+    assert stored["hash"] == serving_spec_hash({**SPEC, "image_tag": "v2"})
+
+    invalid = asyncio.run(request("PUT", "/serving_instances/Bad_Name", json=body))
+    assert invalid.status_code == 400
+
+
+def test_reconcile_creates_missing_resources(cluster, fake_redis):
+    fake = cluster()
+    spec = store_spec(fake_redis)
+
+    asyncio.run(serving_reconciler.reconcile("web"))
+
+    pod_name = serving_instance_pod_name("web")
+    assert fake.calls == [("create_pvc", f"{pod_name}-pvc"), ("create_service", f"{pod_name}-svc"), ("create_pod", pod_name)]
+    assert fake.pod["metadata"]["labels"][SERVING_INSTANCE_LABEL] == "web"
+    assert fake.pod["metadata"]["annotations"][SPEC_HASH_ANNOTATION] == spec["hash"]
+
+
+def test_reconcile_replaces_pod_only_when_spec_hash_differs(cluster, fake_redis):
+    spec = store_spec(fake_redis)
+    pod_name = serving_instance_pod_name("web")
+    existing = (managed("pvc", f"{pod_name}-pvc"), managed("service", f"{pod_name}-svc"))
+
+    fake = cluster(managed("pod", pod_name, annotations={SPEC_HASH_ANNOTATION: spec["hash"]}), *existing)
+    asyncio.run(serving_reconciler.reconcile("web"))
+    assert fake.calls == []
+
+    fake = cluster(managed("pod", pod_name, annotations={SPEC_HASH_ANNOTATION: "stale"}), *existing)
+    asyncio.run(serving_reconciler.reconcile("web"))
+    assert fake.calls == [("delete_pod", pod_name)]
+
+
+def test_reconcile_treats_conflicts_as_done_and_refuses_foreign_objects(cluster, fake_redis):
+    store_spec(fake_redis)
+    pod_name = serving_instance_pod_name("web")
+
+    fake = cluster(conflict={"create_pvc", "create_service", "create_pod"})
+    asyncio.run(serving_reconciler.reconcile("web"))
+    assert [action for action, _ in fake.calls] == ["create_pvc", "create_service", "create_pod"]
+
+    fake = cluster(managed("pod", pod_name, instance="other"))
+    with pytest.raises(HTTPException) as excinfo:
+        asyncio.run(serving_reconciler.reconcile("web"))
+    assert excinfo.value.status_code == 409
+    assert fake.calls == []
+
+
+def test_deleting_instance_removes_resources_then_record(cluster, fake_redis):
+    store_spec(fake_redis, deleting=True)
+    pod_name = serving_instance_pod_name("web")
+
+    fake = cluster(managed("pod", pod_name), managed("service", f"{pod_name}-svc"), managed("pvc", f"{pod_name}-pvc"))
+    asyncio.run(serving_reconciler.reconcile("web"))
+    assert [action for action, _ in fake.calls] == ["delete_pod", "delete_service", "delete_pvc"]
+    assert fake_redis.hexists(SERVING_INSTANCES_KEY, "web")
+
+    cluster()
+    asyncio.run(serving_reconciler.reconcile("web"))
+    assert not fake_redis.hexists(SERVING_INSTANCES_KEY, "web")
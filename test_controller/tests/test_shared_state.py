@@ -0,0 +1,75 @@
+from types import SimpleNamespace
+
+from prometheus_client import REGISTRY
+
+from controller import allocation, images, kube, leases, store, warm_pool
+
+
+def test_stats_are_accumulated_in_redis(fake_redis):
+    store.incr_stats("stats", {"hits": 1, "seconds": 0.5})
+    pipe = fake_redis.pipeline(transaction=False)
+    store.incr_stats("stats", {"hits": 2, "seconds": 1.0}, pipe)
+    pipe.execute()
+
+    assert store.load_stats("stats", ("hits", "seconds", "misses")) == {"hits": 3, "seconds": 1.5, "misses": 0}
+
+
+def test_lease_events_are_visible_from_every_process(fake_redis):
+    # 兩個 LeaseReaper 代表兩個 worker：一個發出事件，另一個的 /leases/events 也看得到
+    emitter, reader = leases.LeaseReaper(), leases.LeaseReaper()
+    emitter.emit("released", leases.instance_lock_key("a"), "dag-1|7|svc|0")
+    emitter.emit("expired", leases.instance_lock_key("b"), "")
+
+    events = reader.recent_events()
+    assert [(event["type"], event["service_instance_id"]) for event in events] == [("released", "a"), ("expired", "b")]
+    assert events[0]["fencing_token"] == 7
+    assert reader.counts() == {"expired": 1, "released": 1}
+
+
+def test_lease_event_stream_is_bounded(fake_redis):
+    reaper = leases.LeaseReaper()
+    for index in range(5):
+        reaper.emit("expired", leases.instance_lock_key(str(index)), "")
+
+    assert [event["service_instance_id"] for event in reaper.recent_events(limit=2)] == ["3", "4"]
+
+
+def test_allocation_queue_stats_track_the_longest_wait(fake_redis):
+    for waited in (0.5, 2.0, 1.0):
+        allocation.record_allocation_wait_script(keys=[allocation.ALLOCATION_QUEUE_STATS_KEY], args=[waited], client=fake_redis)
+
+    snapshot = allocation.AllocationQueue().snapshot()
+    assert (snapshot["served"], snapshot["wait_seconds_sum"], snapshot["wait_seconds_max"]) == (3, 3.5, 2)
+    assert snapshot["wait_seconds_avg"] == 3.5 / 3
+
+
+def test_warm_pool_stats_are_shared(fake_redis):
+    before = REGISTRY.get_sample_value("ml_serving_warm_pool_requests_total", {"result": "unconfigured"}) or 0
+    warm_pool.WarmPool().acquire("moa_ncu/x", "v1", 8000)
+
+    assert warm_pool.WarmPool().snapshot()["misses"] == 1
+    assert REGISTRY.get_sample_value("ml_serving_warm_pool_requests_total", {"result": "unconfigured"}) == before + 1
+
+
+class FakeAppsV1:
+    def __init__(self):
+        self.created = []
+
+    def create_namespaced_daemon_set(self, namespace, body):
+        self.created.append(body["metadata"]["name"])
+
+
+def test_prepull_runs_are_shared(fake_redis, monkeypatch):
+    apps = FakeAppsV1()
+    monkeypatch.setattr(kube, "apps_v1", apps)
+    monkeypatch.setattr(images.node_informer, "_store", {"node-1": SimpleNamespace(metadata=SimpleNamespace(name="node-1", labels={}))})
+
+    first = images.ImagePrePuller().request(["moa_ncu/x:v1"], {})
+    # 另一個 process 收到相同的 request：沿用進行中的 run，不重複建立 DaemonSet
+    second = images.ImagePrePuller().request(["moa_ncu/x:v1"], {})
+
+    assert apps.created == [first["name"]]
+    assert second == first
+    snapshot = images.ImagePrePuller().snapshot()
+    assert snapshot["started"] == 1
+    assert [run["name"] for run in snapshot["runs"]] == [first["name"]]
@@ -0,0 +1,94 @@
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+
+from controller import kube, sweeps
+from controller.informers import job_informer
+from controller.jobs import JOB_COMPLETION_INDEX_ANNOTATION, JOB_RESOURCE_ANNOTATION, sweep_index_view
+from controller.job_queue import job_queue
+from controller.sweeps import expand_sweep_parameters, submit_sweep_job, SweepJobRequest, sweep_env_file
+
+
+class FakeCoreV1:
+    def __init__(self):
+        self.configmaps = {}
+
+    def create_namespaced_config_map(self, namespace, body):
+        self.configmaps[body["metadata"]["name"]] = body
+
+
+@pytest.fixture
+def fake_core(monkeypatch, fake_redis):
+    fake = FakeCoreV1()
+    executor = ThreadPoolExecutor(max_workers=2)
+    monkeypatch.setattr(kube, "v1", fake)
+    monkeypatch.setattr(kube, "k8s_executor", executor)
+    monkeypatch.setattr(job_informer, "_store", {})
+    monkeypatch.setattr(job_queue, "kick", lambda: None)
+    yield fake
+    executor.shutdown(wait=True)
+
+
+def test_grid_and_parameter_lists_are_combined():
+    configs = expand_sweep_parameters([{"SEED": 1}, {"SEED": 2}], {"LR": [0.1, 0.01]})
+
+    assert configs == [{"LR": 0.1, "SEED": 1}, {"LR": 0.01, "SEED": 1}, {"LR": 0.1, "SEED": 2}, {"LR": 0.01, "SEED": 2}]
+    assert expand_sweep_parameters([], {}) == [{}]
+
+
+def test_env_file_quotes_values_and_rejects_bad_names():
+    assert sweep_env_file({"NAME": "it's", "LAYERS": [1, 2]}) == "NAME='it'\\''s'\nLAYERS='[1, 2]'\n"
+    with pytest.raises(HTTPException):
+        sweep_env_file({"bad-name": 1})
+
+
+def test_sweep_is_one_indexed_job_with_a_parameter_configmap(fake_core):
+    req = SweepJobRequest(execution_id="run_1", image_name="moa_ncu/train:v1", gpu=1, dag_id="dag-1",
+                          grid={"LR": [0.1, 0.01, 0.001]}, parallelism=2, command=["python", "train.py"])
+
+    response = asyncio.run(submit_sweep_job(req))
+
+    assert (response["job_name"], response["indexes"], response["parallelism"]) == ("sweep-run-1", 3, 2)
+    configmap = fake_core.configmaps["sweep-run-1-params"]["data"]
+    assert json.loads(configmap["2.json"]) == {"LR": 0.001}
+    item = job_queue.get("sweep-run-1")
+    spec = item["manifest"]["spec"]
+    assert (spec["completionMode"], spec["completions"], spec["parallelism"], spec["backoffLimit"]) == ("Indexed", 3, 2, 3)
+    # quota 以同時執行的 parallelism 個 Pod 計算
+    assert item["demand"]["gpu"] == 2 and item["demand"]["jobs"] == 1
+    assert json.loads(item["manifest"]["metadata"]["annotations"][JOB_RESOURCE_ANNOTATION]) == item["demand"]
+    env = {entry["name"]: entry.get("value") for entry in spec["template"]["spec"]["containers"][0]["env"]}
+    assert env["EXECUTION_ID"] == "sweep-run-1-$(JOB_COMPLETION_INDEX)"
+    assert spec["template"]["spec"]["containers"][0]["command"][-2:] == ["python", "train.py"]
+
+
+def test_sweep_rejects_too_many_indexes(fake_core, monkeypatch):
+    monkeypatch.setattr(sweeps, "SWEEP_MAX_INDEXES", 2)
+    req = SweepJobRequest(execution_id="run_2", image_name="moa_ncu/train:v1", grid={"LR": [1, 2, 3]})
+
+    with pytest.raises(HTTPException) as excinfo:
+        asyncio.run(submit_sweep_job(req))
+    assert excinfo.value.status_code == 400
+    assert fake_core.configmaps == {}
+
+
+def test_index_view_combines_job_status_and_pods():
+    job = SimpleNamespace(
+        spec=SimpleNamespace(completions=4),
+        status=SimpleNamespace(completed_indexes="0,2", failed_indexes=None),
+    )
+
+    def pod(name, index, phase):
+        return SimpleNamespace(
+            metadata=SimpleNamespace(name=name, annotations={JOB_COMPLETION_INDEX_ANNOTATION: str(index)}),
+            status=SimpleNamespace(phase=phase, container_statuses=None),
+        )
+
+    view = sweep_index_view(job, [pod("p0", 0, "Succeeded"), pod("p1-a", 1, "Failed"), pod("p1-b", 1, "Running")])
+
+    assert (view["total"], view["succeeded"], view["running"], view["pending"]) == (4, 2, 1, 1)
+    assert view["items"][1] == {"index": 1, "state": "running", "attempts": 2, "exit_code": None, "pod_name": "p1-b"}
@@ -0,0 +1,88 @@
+from types import SimpleNamespace
+
+import pytest
+from kubernetes import client
+
+from controller import kube, warm_pool
+from controller.informers import pod_informer, service_informer
+from controller.warm_pool import WARM_POOL_LAST_USED_KEY, WarmPool, warm_pool_key_label
+
+KEY = ("moa_ncu/x", "v1", 8000)
+
+
+def make_warm_pod(name, ready=True):
+    return SimpleNamespace(
+        metadata=SimpleNamespace(
+            name=name, resource_version=f"rv-{name}", deletion_timestamp=None, annotations={},
+            labels={"warm-pool": "idle", "warm-pool-key": warm_pool_key_label(*KEY)},
+        ),
+        spec=SimpleNamespace(containers=[SimpleNamespace(image="harbor.pdc.tw/moa_ncu/x:v1", ports=[SimpleNamespace(container_port=8000)])]),
+        status=SimpleNamespace(phase="Running" if ready else "Pending", pod_ip="10.0.0.7" if ready else None),
+    )
+
+
+class FakeCoreV1:
+    def __init__(self):
+        self.patches = []
+        self.conflicts = set()
+
+    def patch_namespaced_pod(self, name, namespace, body):
+        self.patches.append((name, body))
+        if name in self.conflicts:
+            raise client.exceptions.ApiException(status=409)
+
+
+@pytest.fixture
+def warm(monkeypatch, fake_redis):
+    """ 回傳 (WarmPool, FakeCoreV1, 放入 informer 的函式) """
+    fake = FakeCoreV1()
+    monkeypatch.setattr(kube, "v1", fake)
+    monkeypatch.setattr(pod_informer, "_store", {})
+    monkeypatch.setattr(pod_informer, "_indices", {name: {} for name in pod_informer._indices})
+    monkeypatch.setattr(service_informer, "_store", {})
+    monkeypatch.setattr(warm_pool.random, "shuffle", lambda items: items.sort(key=lambda pod: pod.metadata.name))
+
+    def add(pod, with_service=True):
+        pod_informer._store[pod.metadata.name] = pod
+        pod_informer._index_object("warm_pool", pod.metadata.name, pod)
+        if with_service:
+            service_informer._store[f"{pod.metadata.name}-svc"] = SimpleNamespace()
+
+    pool = WarmPool()
+    pool.configure(*KEY, size=2)
+    return pool, fake, add
+
+
+def test_acquire_hands_out_ready_warm_pod(warm, fake_redis):
+    pool, fake, add = warm
+    add(make_warm_pod("mlpod-warm-a"))
+
+    response = pool.acquire(*KEY, dag_id="dag-1")
+
+    assert response["pod_name"] == "mlpod-warm-a" and response["warm_pool"] is True
+    assert response["pod_ip"] == "10.0.0.7"
+    name, body = fake.patches[0]
+    # resourceVersion 讓多個 replica 同時搶同一個 Pod 時只有一個會成功
+    assert body["metadata"]["resourceVersion"] == "rv-mlpod-warm-a"
+    assert body["metadata"]["labels"]["warm-pool"] == "assigned"
+    assert fake_redis.hexists(WARM_POOL_LAST_USED_KEY, warm_pool_key_label(*KEY))
+    assert pool.snapshot()["hits"] == 1
+
+
+def test_acquire_skips_pods_taken_by_another_replica(warm):
+    pool, fake, add = warm
+    add(make_warm_pod("mlpod-warm-a"))
+    add(make_warm_pod("mlpod-warm-b"))
+    fake.conflicts.add("mlpod-warm-a")
+
+    assert pool.acquire(*KEY)["pod_name"] == "mlpod-warm-b"
+
+
+def test_acquire_misses_when_no_complete_warm_pod(warm):
+    pool, fake, add = warm
+    add(make_warm_pod("mlpod-warm-a", ready=False))
+    add(make_warm_pod("mlpod-warm-b"), with_service=False)
+
+    assert pool.acquire(*KEY) is None
+    assert fake.patches == []
+    assert pool.snapshot()["misses"] == 1
@@ -4,9 +4,11 @@ from fastapi import FastAPI, HTTPException
 from kubernetes import client, config
 import os
 from fastapi import FastAPI, HTTPException
-import redis
 import json
 from datetime import datetime
+import time
+import threading
+import logging
 
 
 app = FastAPI()
@@ -18,12 +20,55 @@ v1 = client.CoreV1Api()
 # FASTAPI_SERVICE_URL = "http://fastapi-service.default.svc:80"  # fastapi-server Service
 
 
-# Redis 用來實現機器 Lock
-REDIS_HOST = "localhost"
-REDIS_PORT = 6379
-redis_lock = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=0, decode_responses=True)
+##############################################################
+# 活動回報：收到非 /health 的 request 時通知 controller，供 idle reaper 判斷是否閒置 (每 ACTIVITY_REPORT_INTERVAL 秒最多一次)
+CONTROLLER_URL = os.getenv("CONTROLLER_URL", "http://ml-serving-pod-controller-service.ml-serving.svc.cluster.local:8000")
+ACTIVITY_REPORT_INTERVAL = int(os.getenv("ACTIVITY_REPORT_INTERVAL", "30"))
+POD_NAME = os.getenv("HOSTNAME", "")
+_activity_seen = threading.Event()
+logger = logging.getLogger("activity-reporter")
+
+
+def report_activity_loop():
+    """ 單一背景 thread：上次回報後有新的 request 才回報，兩次回報至少間隔 ACTIVITY_REPORT_INTERVAL 秒 """
+    session = requests.Session()
+    while True:
+        _activity_seen.wait()
+        _activity_seen.clear()
+        try:
+            session.post(f"{CONTROLLER_URL}/pods/{POD_NAME}/activity", timeout=3).raise_for_status()
+        except requests.RequestException as e:
+            logger.warning("Failed to report activity: %s", e)
+        time.sleep(ACTIVITY_REPORT_INTERVAL)
+
+
+@app.on_event("startup")
+def start_activity_reporter():
+    if POD_NAME:
+        threading.Thread(target=report_activity_loop, name="activity-reporter", daemon=True).start()
+
+
+@app.middleware("http")
+async def track_activity(request, call_next):
+    if request.url.path != "/health":
+        _activity_seen.set()
+    return await call_next(request)
+
+
+##############################################################
+# Machine lease：一律透過 controller 的 /allocate_service、/release_service 取得 / 釋放，
+# 與 controller 共用同一組 Lua script (lease_info、lease_expiry、fencing token)，這裡不直接寫 locked_dag_* key
+# lease 只有 MACHINE_LEASE_TTL 秒：DAG 執行期間需每 lease_ttl / 3 秒呼叫一次 /renew_server (heartbeat)，
+# DAG crash 後停止續約，機器在 MACHINE_LEASE_TTL 秒內就會被 controller 回收
+MACHINE_LEASE_TTL = int(os.getenv("MACHINE_LEASE_TTL", "60"))
+
+
+def controller_post(path: str, payload: dict):
+    try:
+        return requests.post(f"{CONTROLLER_URL}{path}", json=payload, timeout=10)
+    except requests.RequestException as e:
+        raise HTTPException(status_code=502, detail=f"❌ 無法連線 controller: {e}")
 
-CONSUL_HOST = "http://localhost:8500"
 SERVICE_NAME = "preprocessing"
 
 @app.get("/health")
@@ -48,7 +93,8 @@ def create_new_pod():
             "namespace": "ml-serving",
             "labels": {
                 "app": "task-pod",
-                "type": "gpu"
+                "type": "gpu",
+                "ml-serving/parent-pod": POD_NAME
             }
         },
         "spec": {
@@ -56,10 +102,26 @@ def create_new_pod():
             "nodeSelector": {
                 "gpu-node": "true"
             },
+            # 盡量與 parent ML serving Pod 排在同一個 node：共用 PVC 的 NFS page cache，task-pod image 也已 pre-pull
+            "affinity": {
+                "podAffinity": {
+                    "preferredDuringSchedulingIgnoredDuringExecution": [
+                        {
+                            "weight": 100,
+                            "podAffinityTerm": {
+                                "labelSelector": {"matchLabels": {"app": POD_NAME}},
+                                "topologyKey": "kubernetes.io/hostname"
+                            }
+                        }
+                    ]
+                }
+            },
             "containers": [
                 {
                     "name": "task-container",
                     "image": "harbor.pdc.tw/moa_ncu/task-pod:latest",
+                    # controller 會定期把此 image pre-pull 到 GPU node (PREPULL_IMAGES)
+                    "imagePullPolicy": "IfNotPresent",
                     "ports": [{"containerPort": 8002}],
                     "volumeMounts": [
                         {
@@ -89,7 +151,7 @@ def create_new_pod():
 
 
 @app.post("/allocate_server/{service_name}")
-async def allocate_preprocessing_server(dag_id: str, execution_id: str, service_name:str):
+def allocate_preprocessing_server(dag_id: str, execution_id: str, service_name:str):
     """
     DAG 來請求 Preprocessing Server：
     1. 查詢 Consul 獲取所有可用的機器
@@ -100,57 +162,55 @@ async def allocate_preprocessing_server(dag_id: str, execution_id: str, service_
 
     service_name = service_name
 
-    # 1️⃣ 查詢 Consul，獲取所有註冊的 Server
-    response = requests.get(f"{CONSUL_HOST}/v1/catalog/service/{service_name}")
+    # 1️⃣ ~ 3️⃣ 由 controller 查詢 Consul 並以 Lua script 原子地鎖定第一台未被鎖定的機器
+    response = controller_post(
+        f"/allocate_service/{service_name}",
+        {"dag_id": dag_id, "execution_id": execution_id, "lease_ttl": MACHINE_LEASE_TTL},
+    )
+    if response.status_code == 404:
+        raise HTTPException(status_code=404, detail=response.json().get("detail"))
     if response.status_code != 200:
-        raise HTTPException(status_code=500, detail="❌ 無法從 Consul 獲取可用機器")
-
-    machines = response.json()
-
-    if not machines:
-        raise HTTPException(status_code=404, detail="❌ 沒有可用的 Preprocessing Server")
-
-    # 2️⃣ 過濾出未被鎖定的機器
-    for machine in machines:
-        machine_id = machine["ServiceID"]
-        machine_ip = machine["ServiceAddress"]
-        machine_port = machine["ServicePort"]
-
-        # 檢查是否已經被其他 DAG 鎖定
-        locked_dag = redis_lock.get(f"locked_dag_{machine_id}")
-        if locked_dag:
-            continue  # 跳過這台機器，因為它已被鎖定
-
-        # 3️⃣ 鎖定該機器 && return sever info
-        redis_lock.setex(f"locked_dag_{machine_id}", 3600, dag_unique_id)  # 設定 TTL 1 小時
+        raise HTTPException(status_code=500, detail="❌ 無法從 controller 取得可用機器")
+
+    lease = response.json()
+    return {
+        "assigned_machine": lease["assigned_service_instance_id"],
+        "assigned_ip": lease["assigned_service_instance_ip"],
+        "assigned_port": lease["assigned_service_instance_port"],
+        "execution_id": dag_unique_id,
+        "fencing_token": lease["fencing_token"],
+        "lease_ttl": lease["lease_ttl"],
+        "renew_interval": max(lease["lease_ttl"] // 3, 1),
+    }
 
-        return {
-            "assigned_machine": machine_id,
-            "assigned_ip": machine_ip,
-            "assigned_port": machine_port,
-            "execution_id": dag_unique_id
-        }
 
-    raise HTTPException(status_code=404, detail="所有 Preprocessing Server 皆被鎖定，請稍後重試")
+@app.post("/renew_server")
+def renew_preprocessing_server(dag_id: str, execution_id: str, assigned_machine: str, fencing_token: int):
+    """
+    DAG 執行期間的 heartbeat：延長 lease；回應 409 代表 lease 已過期或被重新分配，DAG 應停止使用這台機器
+    """
+    response = controller_post(
+        f"/renew_service/{assigned_machine}",
+        {"dag_id": dag_id, "execution_id": execution_id, "fencing_token": fencing_token, "lease_ttl": MACHINE_LEASE_TTL},
+    )
+    if response.status_code == 409:
+        raise HTTPException(status_code=409, detail=response.json().get("detail"))
+    if response.status_code != 200:
+        raise HTTPException(status_code=500, detail="❌ 無法透過 controller 續約機器")
+    return response.json()
 
 
 @app.post("/release_server")
-async def release_preprocessing_server(dag_id: str, execution_id: str, assigned_machine: str):
+def release_preprocessing_server(dag_id: str, execution_id: str, assigned_machine: str, fencing_token: int):
     """
     DAG 完成後，釋放  Server
     """
     dag_unique_id = f"{dag_id}_{execution_id}"
-    locked_dag = redis_lock.get(f"locked_dag_{assigned_machine}")
-
-    if not locked_dag:
-        return {"status": "No Lock Exists", "message": "目前沒有鎖定的機器"}
-
-    if locked_dag != dag_unique_id:
-        return {
-            "status": "Unauthorized",
-            "message": f"機器 {assigned_machine} 目前被 {locked_dag} 鎖定，{dag_unique_id} 無法解除鎖。"
-        }
-
-    # 解除鎖定
-    redis_lock.delete(f"locked_dag_{assigned_machine}")
-    return {"status": "Unlocked", "message": f"機器 {assigned_machine} 已釋放，由 {dag_unique_id} 釋放"}
\ No newline at end of file
+    # 比對 owner / token 與解除鎖定由 controller 在同一個 Lua script 內完成
+    response = controller_post(
+        f"/release_service/{assigned_machine}",
+        {"dag_id": dag_id, "execution_id": execution_id, "fencing_token": fencing_token},
+    )
+    if response.status_code != 200:
+        raise HTTPException(status_code=500, detail="❌ 無法透過 controller 釋放機器")
+    return response.json()
\ No newline at end of file
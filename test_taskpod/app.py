@@ -1,5 +1,9 @@
 import requests
 import uuid
+import os
+import time
+import threading
+import logging
 from fastapi import FastAPI
 from kubernetes import client, config
 
@@ -11,6 +15,41 @@ v1 = client.CoreV1Api()
 
 FASTAPI_SERVICE_URL = "http://fastapi-service.default.svc:80"  # fastapi-server Service
 
+##############################################################
+# 活動回報：收到非 /health 的 request 時通知 controller，供 idle reaper 判斷是否閒置 (每 ACTIVITY_REPORT_INTERVAL 秒最多一次)
+CONTROLLER_URL = os.getenv("CONTROLLER_URL", "http://ml-serving-pod-controller-service.ml-serving.svc.cluster.local:8000")
+ACTIVITY_REPORT_INTERVAL = int(os.getenv("ACTIVITY_REPORT_INTERVAL", "30"))
+POD_NAME = os.getenv("HOSTNAME", "")
+_activity_seen = threading.Event()
+logger = logging.getLogger("activity-reporter")
+
+
+def report_activity_loop():
+    """ 單一背景 thread：上次回報後有新的 request 才回報，兩次回報至少間隔 ACTIVITY_REPORT_INTERVAL 秒 """
+    session = requests.Session()
+    while True:
+        _activity_seen.wait()
+        _activity_seen.clear()
+        try:
+            session.post(f"{CONTROLLER_URL}/pods/{POD_NAME}/activity", timeout=3).raise_for_status()
+        except requests.RequestException as e:
+            logger.warning("Failed to report activity: %s", e)
+        time.sleep(ACTIVITY_REPORT_INTERVAL)
+
+
+@app.on_event("startup")
+def start_activity_reporter():
+    if POD_NAME:
+        threading.Thread(target=report_activity_loop, name="activity-reporter", daemon=True).start()
+
+
+@app.middleware("http")
+async def track_activity(request, call_next):
+    if request.url.path != "/health":
+        _activity_seen.set()
+    return await call_next(request)
+
+
 @app.get("/health")
 def health_check():
     return {"status": "Task Pod is running!"}